@@ -0,0 +1,260 @@
+import csv
+import io
+from collections import defaultdict
+from datetime import datetime
+from cache import Session
+
+# Отмена позже чем за столько секунд до начала считается поздней
+LATE_CANCEL = 3 * 3600
+# Строк на одно чтение при выгрузке; между пачками читатель возвращается в пул
+EXPORT_BATCH = 1000
+# Сколько популярных слотов показывать
+TOP_SLOTS = 5
+
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+# Одна строка session_stats на тренировку. Счётчики только растут и обновляются
+# в той же транзакции, что и само событие, поэтому статистика не требует
+# join по registrations/cancellations. Тип, время и вместимость копируются
+# из schedules при каждом событии: строка переживает удаление тренировки.
+_BUMP = '''
+    INSERT INTO session_stats (schedule_id, workout_type, starts_at, capacity,
+                               booked, cancelled, late_cancelled, removed, waitlist_peak)
+    SELECT id, workout_type, starts_at, capacity,
+           ?, ?, ? * (starts_at - ? < ?), ?,
+           (SELECT COUNT(*) FROM waitlist WHERE schedule_id = s.id)
+    FROM schedules s WHERE id = ?
+    ON CONFLICT(schedule_id) DO UPDATE SET
+        workout_type = excluded.workout_type,
+        starts_at = excluded.starts_at,
+        capacity = excluded.capacity,
+        booked = booked + excluded.booked,
+        cancelled = cancelled + excluded.cancelled,
+        late_cancelled = late_cancelled + excluded.late_cancelled,
+        removed = removed + excluded.removed,
+        waitlist_peak = MAX(waitlist_peak, excluded.waitlist_peak)
+'''
+
+# Выгрузки CSV. Каждая ветка — одна таблица (живая или архив) со своим ключом
+# (k1, k2): по нему ветка читается страницами по индексу, а ветки сливаются
+# в общий порядок уже в Python. Ключ идёт первыми двумя колонками.
+# k2 везде — INTEGER PRIMARY KEY (rowid), он входит в любой индекс таблицы.
+EXPORTS = {
+    'registrations': {
+        'header': ('starts_at', 'registration_id', 'user_id', 'username', 'schedule_id', 'workout_type', 'status'),
+        'branches': (
+            {
+                'select': '''
+                    SELECT s.starts_at, r.id, r.user_id, u.username, s.id, s.workout_type, 'active'
+                    FROM schedules s
+                    JOIN registrations r ON r.schedule_id = s.id
+                    LEFT JOIN users u ON r.user_id = u.user_id
+                ''',
+                'key': ('s.starts_at', 'r.id'),
+            },
+            {
+                'select': '''
+                    SELECT a.starts_at, a.id, a.user_id, u.username, a.schedule_id, a.workout_type, 'archived'
+                    FROM registrations_archive a
+                    LEFT JOIN users u ON a.user_id = u.user_id
+                ''',
+                'key': ('a.starts_at', 'a.id'),
+            },
+        ),
+        'times': (0,),
+    },
+    'cancellations': {
+        'header': ('created_at', 'cancellation_id', 'user_id', 'username', 'schedule_id', 'workout_type', 'starts_at'),
+        'branches': (
+            {
+                'select': '''
+                    SELECT c.created_at, c.id, c.user_id, u.username, s.id, s.workout_type, s.starts_at
+                    FROM cancellations c
+                    JOIN schedules s ON c.schedule_id = s.id
+                    LEFT JOIN users u ON c.user_id = u.user_id
+                ''',
+                'key': ('c.created_at', 'c.id'),
+            },
+            {
+                'select': '''
+                    SELECT a.created_at, a.id, a.user_id, u.username, a.schedule_id, a.workout_type, a.starts_at
+                    FROM cancellations_archive a
+                    LEFT JOIN users u ON a.user_id = u.user_id
+                ''',
+                'key': ('a.created_at', 'a.id'),
+            },
+        ),
+        'times': (0, 6),
+    },
+    # Как Analytics.sessions: агрегаты плюс тренировки без единого события
+    'sessions': {
+        'header': ('starts_at', 'schedule_id', 'workout_type', 'capacity', 'booked', 'cancelled',
+                   'late_cancelled', 'removed', 'seats', 'waitlist_peak'),
+        'branches': (
+            {
+                'select': '''
+                    SELECT starts_at, schedule_id, workout_type, capacity, booked, cancelled,
+                           late_cancelled, removed, booked - cancelled - removed, waitlist_peak
+                    FROM session_stats
+                ''',
+                'key': ('starts_at', 'schedule_id'),
+            },
+            {
+                'select': '''
+                    SELECT starts_at, id, workout_type, capacity, 0, 0, 0, 0, 0, 0
+                    FROM schedules s
+                ''',
+                'key': ('starts_at', 'id'),
+                'where': "NOT EXISTS (SELECT 1 FROM session_stats WHERE schedule_id = s.id)",
+            },
+        ),
+        'times': (0,),
+    },
+}
+
+
+# Следующая страница ветки после ключа (k1, k2) и до until. Условие на k1 —
+# диапазон по индексу, без row value: их SQLite не всегда сводит к индексу в join
+def _page_sql(branch):
+    k1, k2 = branch['key']
+    where = f"{k1} >= ? AND ({k1} > ? OR {k2} > ?) AND {k1} < ?"
+    if 'where' in branch:
+        where += f" AND {branch['where']}"
+    return f"{branch['select']} WHERE {where} ORDER BY {k1}, {k2} LIMIT ?"
+
+
+# Статистика посещаемости по агрегатам session_stats и выгрузки истории в CSV.
+# capacity_for — та же функция вместимости, что у записи (SeatBook.capacity_for).
+class Analytics:
+    def __init__(self, database, tz, capacity_for, late_cancel=LATE_CANCEL):
+        self.database = database
+        self.tz = tz
+        self.capacity_for = capacity_for
+        self.late_cancel = late_cancel
+
+    # --- Вызываются внутри транзакций записи ---
+
+    async def _bump(self, db, sch_id, booked=0, cancelled=0, now=0, removed=0):
+        await db.execute(_BUMP, (booked, cancelled, cancelled, now, self.late_cancel, removed, sch_id))
+
+    async def booked(self, db, sch_id, count=1):
+        await self._bump(db, sch_id, booked=count)
+
+    async def cancelled(self, db, sch_id, now):
+        await self._bump(db, sch_id, cancelled=1, now=now)
+
+    # Запись отменена администратором
+    async def removed(self, db, sch_id):
+        await self._bump(db, sch_id, removed=1)
+
+    # Лист ожидания вырос или тренировку изменили — обновить копию полей
+    async def touch(self, db, sch_id):
+        await self._bump(db, sch_id)
+
+    # Тренировку удалил администратор — она не должна попадать в статистику
+    async def forget(self, db, sch_id):
+        await db.execute("DELETE FROM session_stats WHERE schedule_id = ?", (sch_id,))
+
+    # --- Чтение ---
+
+    # Тренировки в [since, until): агрегаты плюс тренировки без единого события
+    async def sessions(self, since, until):
+        return await self.database.fetchall('''
+            SELECT schedule_id, workout_type, starts_at, capacity,
+                   booked, cancelled, late_cancelled, removed, waitlist_peak
+            FROM session_stats
+            WHERE starts_at >= ? AND starts_at < ?
+            UNION ALL
+            SELECT id, workout_type, starts_at, capacity, 0, 0, 0, 0, 0
+            FROM schedules s
+            WHERE starts_at >= ? AND starts_at < ?
+              AND NOT EXISTS (SELECT 1 FROM session_stats WHERE schedule_id = s.id)
+        ''', (since, until, since, until))
+
+    # Сводка по типам тренировок и самые наполненные слоты (день недели, время, тип)
+    async def summary(self, since, until):
+        types = defaultdict(lambda: defaultdict(int))
+        slots = defaultdict(lambda: [0, 0, 0])      # слот -> [тренировок, мест, вместимость]
+        rows = await self.sessions(since, until)
+        for sch_id, workout_type, starts_at, capacity, booked, cancelled, late, removed, peak in rows:
+            seats = booked - cancelled - removed
+            limit = self.capacity_for(Session(sch_id, workout_type, starts_at, capacity))
+            t = types[workout_type]
+            t['sessions'] += 1
+            t['seats'] += seats
+            t['booked'] += booked
+            t['cancelled'] += cancelled
+            t['late'] += late
+            t['removed'] += removed
+            t['waitlisted'] += peak > 0
+            if limit:
+                t['limited'] += 1
+                t['limited_seats'] += seats
+                t['capacity'] += limit
+
+            local = datetime.fromtimestamp(starts_at, self.tz)
+            slot = slots[(local.weekday(), local.hour * 60 + local.minute, workout_type)]
+            slot[0] += 1
+            slot[1] += seats
+            slot[2] += limit or 0
+
+        top = sorted(slots.items(), key=lambda item: item[1][1] / item[1][0], reverse=True)[:TOP_SLOTS]
+        return {
+            'sessions': len(rows),
+            'types': {k: dict(v) for k, v in types.items()},
+            'slots': [
+                (weekday, minute, workout_type, seats / count, seats / capacity if capacity else None)
+                for (weekday, minute, workout_type), (count, seats, capacity) in top
+            ],
+        }
+
+    # --- Выгрузка ---
+
+    def _format_time(self, ts):
+        return datetime.fromtimestamp(ts, self.tz).strftime('%Y-%m-%d %H:%M')
+
+    # Строки одной ветки выгрузки по порядку ключа, страницами по EXPORT_BATCH
+    async def _branch_rows(self, branch, since, until):
+        sql = _page_sql(branch)
+        k1, k2 = since, -1
+        while True:
+            rows = await self.database.fetchall(sql, (k1, k1, k2, until, EXPORT_BATCH))
+            for row in rows:
+                yield row
+            if len(rows) < EXPORT_BATCH:
+                return
+            k1, k2 = rows[-1][0], rows[-1][1]
+
+    # Асинхронный генератор кусков CSV за [since, until). Каждая ветка читается
+    # по своему индексу, ветки сливаются по ключу; память не зависит от размера истории.
+    async def export_csv(self, kind, since, until):
+        spec = EXPORTS[kind]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(spec['header'])
+        streams = [self._branch_rows(branch, since, until) for branch in spec['branches']]
+        heads = {}
+        for stream in streams:
+            row = await anext(stream, None)
+            if row is not None:
+                heads[stream] = row
+        written = 0
+        while heads:
+            stream = min(heads, key=lambda s: heads[s][:2])
+            row = list(heads[stream])
+            for i in spec['times']:
+                row[i] = self._format_time(row[i])
+            writer.writerow(row)
+            written += 1
+            following = await anext(stream, None)
+            if following is None:
+                del heads[stream]
+            else:
+                heads[stream] = following
+            if written % EXPORT_BATCH == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        chunk = buffer.getvalue()
+        if chunk:
+            yield chunk
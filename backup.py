@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from collections import Counter
+from metrics import JOB_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Страниц за шаг backup API: при странице 4 КБ — 4 МБ за шаг
+STEP_PAGES = 1024
+# Пауза между шагами, секунды: диск и GIL достаются и обработчикам бота
+STEP_PAUSE = 0.01
+# Если базу меняют между шагами, SQLite начинает копию заново. После стольких
+# перезапусков остаток копируется одним шагом: в WAL это только снимок для чтения,
+# писатель бота не ждёт
+MAX_RESTARTS = 3
+CHUNK = 1024 * 1024
+MANIFEST = 'manifest.json'
+PARTIAL = '.partial'
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+# Копия одной базы через backup API на отдельном соединении только для чтения.
+# Выполняется в потоке, event loop не блокируется. Возвращает (шагов, перезапусков)
+def _copy_database(source, target, pages=STEP_PAGES, pause=STEP_PAUSE):
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    stats = {'steps': 0, 'restarts': 0, 'remaining': None}
+
+    def progress(status, remaining, total):
+        stats['steps'] += 1
+        if stats['remaining'] is not None and remaining > stats['remaining']:
+            stats['restarts'] += 1
+            if stats['restarts'] > MAX_RESTARTS:
+                raise _TooManyRestarts()
+        stats['remaining'] = remaining
+        if remaining and pause:
+            time.sleep(pause)
+
+    try:
+        for step in (pages, -1):
+            stats['remaining'] = None
+            dst = sqlite3.connect(target)
+            try:
+                src.backup(dst, pages=step, progress=progress)
+                # Копия самодостаточна: без WAL рядом и с проверенной структурой
+                dst.execute("PRAGMA journal_mode = DELETE")
+                if dst.execute("PRAGMA quick_check").fetchone()[0] != 'ok':
+                    raise sqlite3.DatabaseError(f"Копия {source} не прошла quick_check")
+                return stats['steps'], stats['restarts']
+            except _TooManyRestarts:
+                logger.info("Бэкап %s: база меняется быстрее копирования, копируем одним шагом", source)
+            finally:
+                dst.close()
+    finally:
+        src.close()
+
+
+# Сжимает файл gzip-ом; возвращает sha256 и размер исходного файла
+def _compress(path, target):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f, gzip.open(target, 'wb', compresslevel=6) as out:
+        while chunk := f.read(CHUNK):
+            digest.update(chunk)
+            size += len(chunk)
+            out.write(chunk)
+    return digest.hexdigest(), size
+
+
+# Распаковывает и проверяет sha256; возвращает размер
+def _decompress(path, target, sha256):
+    digest = hashlib.sha256()
+    size = 0
+    with gzip.open(path, 'rb') as f, open(target, 'wb') as out:
+        while chunk := f.read(CHUNK):
+            digest.update(chunk)
+            size += len(chunk)
+            out.write(chunk)
+    if digest.hexdigest() != sha256:
+        raise ValueError(f"Контрольная сумма {path} не совпадает")
+    return size
+
+
+# Имя файла в снимке: номер базы в снимке и имя исходного файла. У шардов в
+# разных каталогах имена файлов могут совпадать, поэтому одного имени мало;
+# исходный путь хранится в manifest
+def _snapshot_name(index, source):
+    return f"{index:03d}_{os.path.basename(source)}"
+
+
+def _snapshot_file(source, workdir, name):
+    raw = os.path.join(workdir, name)
+    started = time.perf_counter()
+    steps, restarts = _copy_database(source, raw)
+    sha256, size = _compress(raw, raw + '.gz')
+    os.remove(raw)
+    return name + '.gz', {
+        'source': source,
+        'sha256': sha256,
+        'size': size,
+        'compressed': os.path.getsize(raw + '.gz'),
+        'steps': steps,
+        'restarts': restarts,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+# Снимки всех баз бота в каталоге directory, раз в interval секунд.
+# Снимок — подкаталог с меткой времени: 000_base.db.gz на каждую базу и
+# manifest.json с исходным путём, sha256 несжатой копии, размерами и временем.
+# Пока снимок пишется, каталог называется *.partial и в список не попадает.
+# Базы копируются по очереди, каждая согласована сама по себе (не между базами).
+# Хранятся keep последних снимков.
+# sources() возвращает пути баз на момент снимка (реестр и шарды студий).
+class BackupManager:
+    def __init__(self, directory, sources, interval=6 * 3600, keep=14):
+        self.directory = directory
+        self.sources = sources
+        self.interval = interval
+        self.keep = keep
+        self.last = None            # manifest последнего снимка
+        self._task = None
+
+    def snapshots(self):
+        return list_snapshots(self.directory)
+
+    async def run(self):
+        started = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        final = os.path.join(self.directory, stamp)
+        if os.path.exists(final):
+            # Второй снимок в ту же секунду (ручной запуск)
+            stamp += f"-{time.time_ns() // 1_000_000 % 1000:03d}"
+            final = os.path.join(self.directory, stamp)
+        workdir = final + PARTIAL
+        os.makedirs(workdir, exist_ok=True)
+        manifest = {'created_at': int(time.time()), 'files': {}}
+        try:
+            sources = [source for source in dict.fromkeys(self.sources()) if os.path.exists(source)]
+            for index, source in enumerate(sources):
+                name, info = await asyncio.to_thread(_snapshot_file, source, workdir, _snapshot_name(index, source))
+                manifest['files'][name] = info
+            manifest['seconds'] = round(time.perf_counter() - started, 3)
+            with open(os.path.join(workdir, MANIFEST), 'w') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(workdir, final)
+        except BaseException:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        self.last = manifest
+        removed = await asyncio.to_thread(self._prune)
+        JOB_SECONDS.observe(time.perf_counter() - started, 'backup')
+        return {'snapshot': stamp, 'files': len(manifest['files']), 'seconds': manifest['seconds'], 'removed': removed}
+
+    # Старые снимки сверх keep и недописанные после падения
+    def _prune(self):
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(PARTIAL):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        for stamp, _ in self.snapshots()[self.keep:]:
+            shutil.rmtree(os.path.join(self.directory, stamp), ignore_errors=True)
+            removed += 1
+        return removed
+
+    # --- Фоновый запуск ---
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        snapshots = self.snapshots()
+        if snapshots:
+            self.last = snapshots[0][1]
+        while True:
+            # После рестарта не делаем снимок сразу, а ждём срока от последнего
+            last_at = self.last['created_at'] if self.last else 0
+            delay = last_at + self.interval - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                stats = await self.run()
+                logger.info("Бэкап: %s", stats)
+            except Exception:
+                logger.exception("Бэкап не удался")
+                await asyncio.sleep(min(self.interval, 600))
+
+
+# [(метка, manifest)] от новых к старым
+def list_snapshots(directory):
+    if not os.path.isdir(directory):
+        return []
+    result = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name, MANIFEST)
+        if name.endswith(PARTIAL) or not os.path.exists(path):
+            continue
+        with open(path) as f:
+            result.append((name, json.load(f)))
+    result.sort(key=lambda item: item[0], reverse=True)
+    return result
+
+
+# Восстановление снимка на место исходных баз (или в target_dir).
+# Бот при этом должен быть остановлен. Каждая база сначала распаковывается
+# рядом во временный файл и проверяется (sha256, quick_check), только потом
+# заменяет текущую; прежние -wal и -shm удаляются.
+# В target_dir база получает имя исходного файла, а если такое имя в снимке
+# не одно — имя файла снимка (000_studio.db). Возвращает [(исходный путь, куда)]
+def restore(directory, stamp, target_dir=None, only=None):
+    snapshot = os.path.join(directory, stamp)
+    with open(os.path.join(snapshot, MANIFEST)) as f:
+        manifest = json.load(f)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    basenames = Counter(os.path.basename(info['source']) for info in manifest['files'].values())
+    restored = []
+    for name, info in manifest['files'].items():
+        source = info['source']
+        basename = os.path.basename(source)
+        if only and not {source, basename, name[:-len('.gz')]} & set(only):
+            continue
+        if target_dir:
+            target = os.path.join(target_dir, basename if basenames[basename] == 1 else name[:-len('.gz')])
+        else:
+            target = source
+        tmp = target + '.restore'
+        try:
+            _decompress(os.path.join(snapshot, name), tmp, info['sha256'])
+            conn = sqlite3.connect(tmp)
+            try:
+                if conn.execute("PRAGMA quick_check").fetchone()[0] != 'ok':
+                    raise sqlite3.DatabaseError(f"{name} не прошёл quick_check")
+            finally:
+                conn.close()
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(target + suffix):
+                os.remove(target + suffix)
+        os.replace(tmp, target)
+        restored.append((source, target))
+    return restored
+
+
+# Базы бота по реестру студий: сам реестр и шард каждой студии
+def registry_sources(registry_path):
+    paths = [registry_path]
+    if os.path.exists(registry_path):
+        conn = sqlite3.connect(f"file:{registry_path}?mode=ro", uri=True)
+        try:
+            paths += [path for (path,) in conn.execute("SELECT db_path FROM studios ORDER BY id")]
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            conn.close()
+    return paths
+
+
+# Из командной строки (restore — только при остановленном боте):
+#   python backup.py run
+#   python backup.py list
+#   python backup.py restore 20260101-030000 [--only studio_yoga.db] [--target-dir /tmp/check]
+def main():
+    parser = argparse.ArgumentParser(description="Снимки баз бота")
+    parser.add_argument("--dir", default=os.getenv("BACKUP_DIR", "backups"), help="каталог снимков")
+    parser.add_argument("--registry", default=os.getenv("REGISTRY_DB", "studios.db"), help="файл базы реестра")
+    parser.add_argument("--keep", type=int, default=int(os.getenv("BACKUP_KEEP", 14)))
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="сделать снимок сейчас")
+    commands.add_parser("list", help="список снимков")
+    restore_cmd = commands.add_parser("restore", help="восстановить снимок")
+    restore_cmd.add_argument("snapshot", help="метка снимка из list")
+    restore_cmd.add_argument("--only", action="append", help="только эта база (путь, имя файла или имя в снимке)")
+    restore_cmd.add_argument("--target-dir", help="распаковать сюда, не трогая рабочие базы")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'run':
+        manager = BackupManager(args.dir, lambda: registry_sources(args.registry), keep=args.keep)
+        print(asyncio.run(manager.run()))
+    elif args.command == 'list':
+        for stamp, manifest in list_snapshots(args.dir):
+            size = sum(f['compressed'] for f in manifest['files'].values())
+            print(f"{stamp}\t{len(manifest['files'])} баз\t{size // 1024} КБ\t{manifest['seconds']} с")
+    else:
+        for source, path in restore(args.dir, args.snapshot, args.target_dir, args.only):
+            print(f"Восстановлено: {source} -> {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+"""Нагрузочный прогон бота без Telegram.
+
+Синтетические пользователи проходят типичный сценарий записи, администратор
+листает свои экраны. Апдейты подаются в dp напрямую и/или через FastAPI-вебхук,
+Bot API подменён локальной сессией с задержкой и случайными RetryAfter.
+Бот работает с отдельной временной БД.
+
+    python bench.py --users 200 --sessions 100 --prefill 2000 --out bench.json
+    python bench.py --users 200 --compare bench.json
+    python bench.py --users 200 --backup --compare bench.json   # p99 на фоне снимков БД
+    python bench.py --users 200 --double-tap 0.3 --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+# main читает TOKEN при импорте; реестр и база студии создаются в текущей папке
+os.environ.setdefault("TOKEN", "123456:BENCHMARK")
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+
+# Подмена сессии Bot API: считает вызовы, ждёт latency и иногда отвечает RetryAfter
+def make_session(latency, jitter, retry_after_rate, rng):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.exceptions import TelegramRetryAfter
+    from aiogram.methods import EditMessageText, SendMessage
+    from aiogram.types import Message
+
+    class FakeSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+            self.retry_after = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] += 1
+            if latency:
+                await asyncio.sleep(latency * rng.uniform(1 - jitter, 1 + jitter))
+            if rng.random() < retry_after_rate:
+                self.retry_after += 1
+                raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+            if isinstance(method, (SendMessage, EditMessageText)):
+                return Message.model_validate({
+                    "message_id": getattr(method, 'message_id', None) or 1,
+                    "date": int(time.time()),
+                    "chat": {"id": method.chat_id or 1, "type": "private"},
+                    "text": method.text,
+                })
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return FakeSession()
+
+
+class Recorder:
+    def __init__(self):
+        self.handler_of = {}            # update_id -> имя хэндлера
+        self.done = {}                  # update_id -> asyncio.Event
+        self.latency = defaultdict(list)
+        self.errors = Counter()
+
+    # Внутренний middleware: какой хэндлер обработал апдейт и упал ли он.
+    # Имя берётся из контекста метрик: колбэки идут через один хэндлер
+    # callbacks.CallbackRouter, настоящее имя известно только после него
+    async def inner(self, handler, event, data):
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            name = data.get('metrics', {}).get('handler', '?')
+            self.handler_of[data['event_update'].update_id] = name
+            if failed:
+                self.errors[name] += 1
+
+    # Внешний middleware: апдейт обработан (нужно для пути через вебхук).
+    # Нажатия, отсечённые throttle до хэндлера, во внутренний не попадают
+    async def outer(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            self.handler_of.setdefault(event.update_id, data.get('metrics', {}).get('handler', '?'))
+            done = self.done.get(event.update_id)
+            if done is not None:
+                done.set()
+
+    def record(self, update_id, seconds):
+        self.latency[self.handler_of.pop(update_id, 'unhandled')].append(seconds)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+# Задержки из Recorder: по каждому хэндлеру и в целом за прогон
+def summarize(rec, elapsed):
+    handlers = {}
+    for name, values in sorted(rec.latency.items()):
+        handlers[name] = {
+            'count': len(values),
+            'errors': rec.errors[name],
+            'mean_ms': round(sum(values) / len(values) * 1000, 2),
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+        }
+    everything = [v for values in rec.latency.values() for v in values]
+    return {
+        'updates': len(everything),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(everything) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(everything, 50) * 1000, 2) if everything else 0,
+        'p95_ms': round(percentile(everything, 95) * 1000, 2) if everything else 0,
+        'p99_ms': round(percentile(everything, 99) * 1000, 2) if everything else 0,
+        'errors': sum(rec.errors.values()),
+        'handlers': handlers,
+    }
+
+
+class Bench:
+    def __init__(self, main, args):
+        self.main = main
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.update_id = 0
+        self.rec = Recorder()
+        # Прогон идёт на студии по умолчанию
+        self.studio = None
+
+    def update(self, user_id, text=None, data=None):
+        from aiogram.types import Update
+        self.update_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"}
+        chat = {"id": user_id, "type": "private"}
+        if text is not None:
+            payload = {"message_id": self.update_id, "date": int(time.time()), "chat": chat, "from": user, "text": text}
+            raw = {"update_id": self.update_id, "message": payload}
+        else:
+            message = {"message_id": user_id % 1000 + 1, "date": int(time.time()), "chat": chat, "text": "…"}
+            raw = {"update_id": self.update_id, "callback_query": {
+                "id": str(self.update_id), "from": user, "chat_instance": "bench", "data": data, "message": message,
+            }}
+        return Update.model_validate(raw, context={"bot": self.main.bot})
+
+    # --- Подача апдейтов ---
+
+    async def send_direct(self, update):
+        started = time.perf_counter()
+        try:
+            await self.main.dp.feed_update(self.main.bot, update)
+        except Exception:
+            pass
+        self.rec.record(update.update_id, time.perf_counter() - started)
+
+    async def send_webhook(self, update):
+        done = self.rec.done[update.update_id] = asyncio.Event()
+        body = update.model_dump_json(exclude_none=True).encode()
+        started = time.perf_counter()
+        status = await asgi_post(self.main.app, f"/webhook/{self.main.TOKEN}", body)
+        if status == 200:
+            await done.wait()
+        else:
+            self.rec.handler_of[update.update_id] = f"http_{status}"
+        self.rec.record(update.update_id, time.perf_counter() - started)
+        del self.rec.done[update.update_id]
+
+    # Нажатие кнопки; с вероятностью --double-tap та же кнопка нажимается дважды подряд
+    async def tap(self, user_id, send, data):
+        if self.rng.random() < self.args.double_tap:
+            await asyncio.gather(send(self.update(user_id, data=data)), send(self.update(user_id, data=data)))
+        else:
+            await send(self.update(user_id, data=data))
+
+    # --- Сценарии ---
+
+    async def user_flow(self, user_id, send):
+        studio = self.studio
+        pack = self.main.callbacks.pack
+        await send(self.update(user_id, text="/start"))
+        await self.tap(user_id, send, pack('book'))
+        index = self.rng.randrange(len(studio.workout_types))
+        workout_type = studio.workout_types[index]
+        await self.tap(user_id, send, pack('book_type', index, studio=studio.id))
+        sessions = await studio.cache.sessions_between(studio.database, int(time.time()), workout_type=workout_type)
+        if sessions:
+            session = self.rng.choice(sessions[:20])
+            await self.tap(user_id, send, pack('book_to', session.id, studio=studio.id))
+        await self.tap(user_id, send, pack('my'))
+        await self.tap(user_id, send, pack('cancel'))
+        if self.rng.random() < self.args.cancel_rate:
+            regs = await studio.cache.user_registrations(studio.database, user_id)
+            if regs:
+                await self.tap(user_id, send, pack('cancel_to', regs[0][0], studio=studio.id))
+        await self.tap(user_id, send, pack('week'))
+
+    async def admin_flow(self, send):
+        admin = min(self.studio.config.admins)
+        pack = self.main.callbacks.pack
+        screens = (pack('a_regs'), pack('pg', 'reg', 'n', 0, 0, 'a', 'a', studio=self.studio.id), pack('a_cancels'),
+                   pack('a_week'), pack('a_unbook'), pack('a_edit'), pack('home'))
+        await send(self.update(admin, text="/start"))
+        for _ in range(self.args.admin_rounds):
+            for data in screens:
+                await send(self.update(admin, data=data))
+
+    # Снимки БД без перерыва, пока идёт прогон
+    async def backup_loop(self, durations):
+        while True:
+            started = time.perf_counter()
+            await self.main.backups.run()
+            durations.append(time.perf_counter() - started)
+
+    async def run(self, mode, first_user):
+        main = self.main
+        send = self.send_direct if mode == 'direct' else self.send_webhook
+        self.rec.latency.clear()
+        self.rec.errors.clear()
+        session = main.bot.session
+        calls_before = sum(session.calls.values())
+        retry_before = session.retry_after
+        if mode == 'webhook':
+            main.update_queue.start()
+
+        backups = []
+        backup_task = asyncio.create_task(self.backup_loop(backups)) if self.args.backup else None
+        started = time.perf_counter()
+        flows = [self.user_flow(first_user + i, send) for i in range(self.args.users)]
+        flows.append(self.admin_flow(send))
+        await asyncio.gather(*flows)
+        elapsed = time.perf_counter() - started
+        if backup_task is not None:
+            backup_task.cancel()
+            await asyncio.gather(backup_task, return_exceptions=True)
+
+        if mode == 'webhook':
+            await main.update_queue.stop()
+
+        result = summarize(self.rec, elapsed)
+        result.update({
+            'api_calls': sum(session.calls.values()) - calls_before,
+            'retry_after': session.retry_after - retry_before,
+            'backup': {
+                'runs': len(backups),
+                'mean_s': round(sum(backups) / len(backups), 3),
+                'max_s': round(max(backups), 3),
+            } if backups else None,
+        })
+        return result
+
+
+async def asgi_post(app, path, body):
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    status = {}
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status['code'] = message["status"]
+
+    scope = {
+        "type": "http", "method": "POST", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "headers": [(b"content-type", b"application/json")], "http_version": "1.1", "scheme": "http",
+        "server": ("bench", 80), "client": ("bench", 1), "root_path": "",
+    }
+    await app(scope, receive, send)
+    return status.get('code')
+
+
+# Расписание на sessions тренировок вперёд и prefill записей, не больше вместимости
+async def populate(studio, sessions, prefill, rng):
+    now = int(time.time())
+    types = studio.workout_types
+    async with studio.database.write() as db:
+        await db.executemany(
+            "INSERT INTO schedules (workout_type, starts_at) VALUES (?, ?)",
+            [(types[i % len(types)], now + 3600 + i * 3 * 3600) for i in range(sessions)]
+        )
+        cursor = await db.execute("SELECT id, workout_type FROM schedules WHERE starts_at > ?", (now,))
+        rows = await cursor.fetchall()
+        taken = Counter()
+        regs = []
+        for i in range(prefill if rows else 0):
+            sch_id, workout_type = rng.choice(rows)
+            capacity = studio.config.workouts.get(workout_type)
+            if capacity is not None and taken[sch_id] >= capacity:
+                continue
+            taken[sch_id] += 1
+            regs.append((10_000_000 + i, sch_id))
+        await db.executemany("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
+                             [(u, f"prefill{u}") for u, _ in regs])
+        await db.executemany("INSERT OR IGNORE INTO registrations (user_id, schedule_id) VALUES (?, ?)", regs)
+    await studio.cache.load(studio.database)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(mode, result, baseline=None):
+    print(f"\n== {mode}: {result['updates']} апдейтов за {result['seconds']} с, "
+          f"{result['throughput']} апд/с, ошибок {result['errors']}, "
+          f"вызовов API {result['api_calls']}, RetryAfter {result['retry_after']}")
+    print(f"{'handler':34} {'count':>6} {'err':>4} {'p50':>8} {'p95':>8} {'p99':>8}  {'Δp95':>8}")
+    for name, h in result['handlers'].items():
+        delta = ''
+        old = (baseline or {}).get('handlers', {}).get(name)
+        if old:
+            delta = f"{(h['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100:+.0f}%" if old['p95_ms'] else ''
+        print(f"{name:34} {h['count']:>6} {h['errors']:>4} {h['p50_ms']:>8} {h['p95_ms']:>8} {h['p99_ms']:>8}  {delta:>8}")
+    if result.get('backup'):
+        b = result['backup']
+        print(f"снимков БД за прогон: {b['runs']}, в среднем {b['mean_s']} с, максимум {b['max_s']} с")
+    if baseline:
+        print(f"throughput: {baseline['throughput']} -> {result['throughput']} апд/с, "
+              f"p95: {baseline['p95_ms']} -> {result['p95_ms']} мс, "
+              f"p99: {baseline['p99_ms']} -> {result['p99_ms']} мс")
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="fitnes_bench_")
+    os.chdir(workdir)
+    # Синтетические пользователи жмут быстрее людей: ограничение частоты выключено,
+    # слияние повторных нажатий работает (см. --double-tap)
+    os.environ.setdefault("THROTTLE_RATE", "0")
+    import main
+
+    # Ошибки хэндлеров (например, от RetryAfter) считаются в отчёте, трассировки не нужны
+    for name in ('aiogram', 'ingest'):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+
+    rng = random.Random(args.seed)
+    main.bot.session = make_session(args.latency / 1000, args.jitter, args.retry_after, rng)
+    # Очереди исходящих запросов и метрики Bot API — как у настоящей сессии
+    main.outbound.setup(main.bot, main.outbound_scheduler)
+    main.bot.session.middleware(main.metrics.ApiMetricsMiddleware())
+    bench = Bench(main, args)
+    main.dp.update.outer_middleware(bench.rec.outer)
+    main.dp.message.middleware(bench.rec.inner)
+    main.dp.callback_query.middleware(bench.rec.inner)
+
+    await main.registry.open(main.DEFAULT_STUDIO)
+    studio = bench.studio = main.registry.studios()[0]
+    await studio.database.open()
+    await populate(studio, args.sessions, args.prefill, rng)
+    # Прогрев из lifespan не запускается: вебхук принимает апдейты только после ready.
+    # Из фоновых задач студии нужны только подписчики событий, как в боевом процессе;
+    # started — чтобы первый апдейт не запустил остальные
+    studio.events.start()
+    studio.started = True
+    main.ready.set()
+
+    results = {}
+    try:
+        modes = ['direct', 'webhook'] if args.mode == 'both' else [args.mode]
+        for i, mode in enumerate(modes):
+            # Свои пользователи на каждый режим, чтобы записи не пересекались
+            results[mode] = await bench.run(mode, first_user=1_000_000 * (i + 1))
+    finally:
+        await studio.stop()
+        await main.fsm_storage.close()
+        await main.shard_pool.close_all()
+        await main.registry_db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на поддельном Bot API")
+    parser.add_argument("--users", type=int, default=100, help="одновременных пользователей")
+    parser.add_argument("--sessions", type=int, default=60, help="тренировок в расписании")
+    parser.add_argument("--prefill", type=int, default=500, help="записей в БД до начала прогона")
+    parser.add_argument("--mode", choices=("direct", "webhook", "both"), default="both")
+    parser.add_argument("--latency", type=float, default=30.0, help="задержка Bot API, мс")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс задержки, доля")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="доля ответов RetryAfter")
+    parser.add_argument("--cancel-rate", type=float, default=0.3, help="доля пользователей, отменяющих запись")
+    parser.add_argument("--admin-rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--double-tap", type=float, default=0.0, help="доля двойных нажатий кнопок")
+    parser.add_argument("--backup", action="store_true", help="всё время прогона снимать бэкапы БД")
+    parser.add_argument("--out", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out) if args.out else None
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = asyncio.run(run(args))
+    for mode, result in results.items():
+        print_report(mode, result, (baseline or {}).get('modes', {}).get(mode))
+
+    if out:
+        params = {k: v for k, v in vars(args).items() if k not in ('out', 'compare')}
+        with open(out, 'w') as f:
+            json.dump({'commit': git_commit(), 'created_at': int(time.time()), 'params': params, 'modes': results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты: {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Микробенчмарк разбора нажатий кнопок.
+
+Сравнивает цепочку фильтров aiogram (F.data == ... / F.data.startswith(...),
+как было в main.py) с callbacks.CallbackRouter при разном числе хэндлеров.
+Апдейт подаётся в dp.feed_update, хэндлеры ничего не делают, Bot API не вызывается.
+Нажимается последняя зарегистрированная кнопка — худший случай для цепочки.
+
+    python bench_callbacks.py
+    python bench_callbacks.py --handlers 10 100 1000 --updates 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Update
+from callbacks import CallbackRouter
+
+
+async def noop(call, *args, **kwargs):
+    pass
+
+
+# Как было: половина хэндлеров — точное имя, половина — префикс с id
+def linear_dispatcher(n):
+    dp = Dispatcher()
+    for i in range(n):
+        if i % 2:
+            dp.callback_query.register(noop, F.data.startswith(f'handler_{i}_'))
+        else:
+            dp.callback_query.register(noop, F.data == f'handler_{i}')
+    last = n - 1
+    return dp, f'handler_{last}_42' if last % 2 else f'handler_{last}'
+
+
+def router_dispatcher(n):
+    dp = Dispatcher()
+    router = CallbackRouter()
+    for i in range(n):
+        if i % 2:
+            router.route(f'h{i}', int)(noop)
+        else:
+            router.route(f'h{i}')(noop)
+    router.setup(dp.callback_query)
+    last = n - 1
+    return dp, router.pack(f'h{last}', 42) if last % 2 else router.pack(f'h{last}')
+
+
+def callback_update(bot, update_id, data):
+    user = {"id": 1, "is_bot": False, "first_name": "Bench"}
+    message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "…"}
+    return Update.model_validate({"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user, "chat_instance": "bench", "data": data, "message": message,
+    }}, context={"bot": bot})
+
+
+async def measure(bot, dp, data, updates):
+    batch = [callback_update(bot, i, data) for i in range(updates)]
+    # Прогрев: кэши aiogram и первый проход по хэндлерам
+    for update in batch[:100]:
+        await dp.feed_update(bot, update)
+    started = time.perf_counter()
+    for update in batch:
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / updates * 1e6
+
+
+async def run(args):
+    bot = Bot(token="123456:BENCHMARK")
+    print(f"{'handlers':>8} {'filters, мкс':>14} {'router, мкс':>13} {'x':>6}")
+    try:
+        for n in args.handlers:
+            linear = await measure(bot, *linear_dispatcher(n), args.updates)
+            routed = await measure(bot, *router_dispatcher(n), args.updates)
+            print(f"{n:>8} {linear:>14.1f} {routed:>13.1f} {linear / routed:>6.1f}")
+    finally:
+        await bot.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Стоимость выбора хэндлера колбэка")
+    parser.add_argument("--handlers", type=int, nargs="+", default=[10, 30, 100, 300])
+    parser.add_argument("--updates", type=int, default=500, help="нажатий на каждый замер")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
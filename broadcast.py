@@ -0,0 +1,219 @@
+import asyncio
+import time
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from metrics import JOB_SECONDS
+import outbound
+
+# Лимит Telegram: 1 сообщение в секунду в один чат.
+# Общий лимит в секунду держит outbound.OutboundScheduler для всех исходящих запросов
+PER_CHAT_INTERVAL = 1.0
+CONCURRENCY = 20
+MAX_ATTEMPTS = 5
+# Как часто сохраняем прогресс в БД и обновляем сообщение администратору
+FLUSH_EVERY = 50
+PROGRESS_INTERVAL = 3.0
+
+# Ошибки BadRequest, после которых писать пользователю бесполезно
+PERMANENT_BAD_REQUESTS = ('chat not found', 'user is deactivated', 'peer_id_invalid')
+
+
+# Фоновые рассылки с ограничением скорости и сохранением прогресса.
+# Каждая рассылка — строка в broadcasts и по строке на получателя
+# в broadcast_recipients; после рестарта продолжаем с неотправленных.
+class Broadcaster:
+    def __init__(self, bot, database, concurrency=CONCURRENCY):
+        self.bot = bot
+        self.database = database
+        self.concurrency = concurrency
+        self._chat_next = {}        # chat_id -> monotonic-время, раньше которого не пишем
+        self._pause_until = 0.0     # глобальная пауза после RetryAfter
+        self._tasks = {}
+
+    # Создаёт рассылку внутри уже открытой транзакции
+    async def create(self, db, text, user_ids, kind='announce', report_chat_id=None):
+        cursor = await db.execute('''
+            INSERT INTO broadcasts (kind, text, status, report_chat_id, created_at)
+            VALUES (?, ?, 'running', ?, ?)
+        ''', (kind, text, report_chat_id, int(time.time())))
+        job_id = cursor.lastrowid
+        await db.executemany('''
+            INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id, status)
+            SELECT ?, ?, 'pending'
+            WHERE NOT EXISTS (SELECT 1 FROM blocked_users WHERE user_id = ?)
+        ''', [(job_id, uid, uid) for uid in user_ids])
+        await db.execute('''
+            UPDATE broadcasts
+            SET total = (SELECT COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ?)
+            WHERE id = ?
+        ''', (job_id, job_id))
+        return job_id
+
+    async def submit(self, text, user_ids, kind='announce', report_chat_id=None):
+        async with self.database.write() as db:
+            job_id = await self.create(db, text, user_ids, kind, report_chat_id)
+        self.start(job_id)
+        return job_id
+
+    def start(self, job_id):
+        if job_id not in self._tasks:
+            self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+            self._tasks[job_id].add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    # Продолжаем рассылки, прерванные рестартом
+    async def resume(self):
+        rows = await self.database.fetchall("SELECT id FROM broadcasts WHERE status = 'running'")
+        for (job_id,) in rows:
+            self.start(job_id)
+
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def _run(self, job_id):
+        # Рассылка идёт в полосе bulk: ответы пользователям её обгоняют.
+        # У задачи своя копия контекста, так что значение не утекает наружу
+        outbound.current_lane.set(outbound.BULK)
+        row = await self.database.fetchone('''
+            SELECT text, report_chat_id, progress_message_id, total, sent, failed
+            FROM broadcasts WHERE id = ?
+        ''', (job_id,))
+        if row is None:
+            return
+        text, report_chat_id, progress_message_id, total, sent, failed = row
+        pending = [uid for (uid,) in await self.database.fetchall('''
+            SELECT user_id FROM broadcast_recipients
+            WHERE broadcast_id = ? AND status = 'pending'
+        ''', (job_id,))]
+
+        job = {
+            'id': job_id, 'text': text, 'total': total,
+            'sent': sent, 'failed': failed,
+            'results': [], 'blocked': [],
+            'started': time.monotonic(), 'done_now': 0,
+            'report_chat_id': report_chat_id,
+            'progress_message_id': progress_message_id,
+            'reported_at': 0.0,
+        }
+        if report_chat_id and progress_message_id is None:
+            await self._report(job, force=True)
+
+        queue = asyncio.Queue()
+        for uid in pending:
+            queue.put_nowait(uid)
+
+        async def worker():
+            while True:
+                try:
+                    uid = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                status, reason = await self._deliver(uid, text)
+                job['results'].append((status, job_id, uid))
+                job['done_now'] += 1
+                if status == 'sent':
+                    job['sent'] += 1
+                else:
+                    job['failed'] += 1
+                    if reason:
+                        job['blocked'].append((uid, reason, int(time.time())))
+                if len(job['results']) >= FLUSH_EVERY:
+                    await self._flush(job)
+                await self._report(job)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, len(pending)) or 1)]
+        finished = False
+        try:
+            await asyncio.gather(*workers)
+            finished = True
+        finally:
+            for w in workers:
+                w.cancel()
+            await self._flush(job, finished=finished)
+        await self._report(job, force=True, finished=True)
+        JOB_SECONDS.observe(time.monotonic() - job['started'], 'broadcast')
+
+    # Возвращает ('sent' | 'failed', причина постоянной ошибки или None)
+    async def _deliver(self, chat_id, text):
+        for attempt in range(MAX_ATTEMPTS):
+            await self._wait_turn(chat_id)
+            try:
+                await self.bot.send_message(chat_id, text)
+                return 'sent', None
+            except TelegramRetryAfter as e:
+                # Flood control: ставим на паузу все отправки, с нарастающим запасом
+                delay = e.retry_after * (1 + 0.5 * attempt)
+                self._pause_until = max(self._pause_until, time.monotonic() + delay)
+            except TelegramForbiddenError as e:
+                return 'failed', e.message
+            except TelegramBadRequest as e:
+                if any(m in e.message.lower() for m in PERMANENT_BAD_REQUESTS):
+                    return 'failed', e.message
+                return 'failed', None
+            except TelegramAPIError:
+                await asyncio.sleep(2 ** attempt)
+        return 'failed', None
+
+    async def _wait_turn(self, chat_id):
+        while True:
+            now = time.monotonic()
+            wait = max(self._pause_until, self._chat_next.get(chat_id, 0.0)) - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._chat_next[chat_id] = time.monotonic() + PER_CHAT_INTERVAL
+        if len(self._chat_next) > 10000:
+            now = time.monotonic()
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+    async def _flush(self, job, finished=False):
+        results, job['results'] = job['results'], []
+        blocked, job['blocked'] = job['blocked'], []
+        async with self.database.write() as db:
+            if results:
+                await db.executemany('''
+                    UPDATE broadcast_recipients SET status = ?
+                    WHERE broadcast_id = ? AND user_id = ?
+                ''', results)
+            if blocked:
+                await db.executemany('''
+                    INSERT OR REPLACE INTO blocked_users (user_id, reason, created_at)
+                    VALUES (?, ?, ?)
+                ''', blocked)
+            await db.execute('''
+                UPDATE broadcasts SET sent = ?, failed = ?, status = ?
+                WHERE id = ?
+            ''', (job['sent'], job['failed'], 'done' if finished else 'running', job['id']))
+
+    async def _report(self, job, force=False, finished=False):
+        chat_id = job['report_chat_id']
+        if not chat_id:
+            return
+        now = time.monotonic()
+        if not force and now - job['reported_at'] < PROGRESS_INTERVAL:
+            return
+        job['reported_at'] = now
+        elapsed = max(now - job['started'], 1e-6)
+        title = "Рассылка завершена" if finished else "Рассылка идёт"
+        text = (
+            f"{title}: отправлено {job['sent']} из {job['total']}, "
+            f"ошибок {job['failed']}, {job['done_now'] / elapsed:.1f} сообщ./с"
+        )
+        try:
+            if job['progress_message_id'] is None:
+                msg = await self.bot.send_message(chat_id, text)
+                job['progress_message_id'] = msg.message_id
+                async with self.database.write() as db:
+                    await db.execute(
+                        "UPDATE broadcasts SET progress_message_id = ? WHERE id = ?",
+                        (msg.message_id, job['id'])
+                    )
+            else:
+                await self.bot.edit_message_text(text, chat_id=chat_id, message_id=job['progress_message_id'])
+        except TelegramAPIError:
+            pass
@@ -0,0 +1,136 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+
+# capacity — вместимость именно этой тренировки, None — по типу
+Session = namedtuple('Session', 'id workout_type starts_at capacity', defaults=(None,))
+
+
+# Кэш расписания в памяти процесса.
+# Сессии и число занятых мест грузятся целиком при старте,
+# записи пользователей — лениво при первом обращении.
+# Все пути записи обновляют кэш сразу после коммита (write-through):
+# хэндлеры — через слушателей событий (events.EventBus.listen).
+class ScheduleCache:
+    def __init__(self):
+        self.sessions = {}      # schedule_id -> Session
+        self._order = []        # отсортированный список (starts_at, schedule_id)
+        self.seats = {}         # schedule_id -> число записей
+        self.user_regs = {}     # user_id -> {reg_id: schedule_id}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self, database):
+        async with database.read() as db:
+            cursor = await db.execute('''
+                SELECT s.id, s.workout_type, s.starts_at, s.capacity, COUNT(r.id)
+                FROM schedules s
+                LEFT JOIN registrations r ON r.schedule_id = s.id
+                GROUP BY s.id
+            ''')
+            rows = await cursor.fetchall()
+
+        self.sessions = {}
+        self.seats = {}
+        for sch_id, t, starts_at, capacity, count in rows:
+            self.sessions[sch_id] = Session(sch_id, t, starts_at, capacity)
+            self.seats[sch_id] = count
+        self._order = sorted((s.starts_at, s.id) for s in self.sessions.values())
+        self.user_regs = {}
+        self.loaded = True
+
+    async def _ensure_loaded(self, database):
+        if self.loaded:
+            self.hits += 1
+        else:
+            self.misses += 1
+            await self.load(database)
+
+    # --- Чтение ---
+
+    async def sessions_between(self, database, start, end=None, workout_type=None):
+        await self._ensure_loaded(database)
+        lo = bisect_right(self._order, (start, float('inf')))
+        hi = len(self._order) if end is None else bisect_right(self._order, (end, float('inf')))
+        result = []
+        for _, sch_id in self._order[lo:hi]:
+            session = self.sessions[sch_id]
+            if workout_type is None or session.workout_type == workout_type:
+                result.append(session)
+        return result
+
+    def seat_count(self, sch_id):
+        return self.seats.get(sch_id, 0)
+
+    # Записи пользователя: [(reg_id, Session)] по времени тренировки
+    async def user_registrations(self, database, user_id):
+        await self._ensure_loaded(database)
+        regs = self.user_regs.get(user_id)
+        if regs is None:
+            self.misses += 1
+            regs = await self._load_user(database, user_id)
+        else:
+            self.hits += 1
+        result = [(reg_id, self.sessions[sch_id]) for reg_id, sch_id in regs.items() if sch_id in self.sessions]
+        result.sort(key=lambda item: item[1].starts_at)
+        return result
+
+    async def _load_user(self, database, user_id):
+        async with database.read() as db:
+            cursor = await db.execute(
+                "SELECT id, schedule_id FROM registrations WHERE user_id = ?", (user_id,)
+            )
+            rows = await cursor.fetchall()
+        regs = {reg_id: sch_id for reg_id, sch_id in rows}
+        self.user_regs[user_id] = regs
+        return regs
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'sessions': len(self.sessions),
+            'users': len(self.user_regs),
+        }
+
+    # --- Write-through ---
+
+    def add_session(self, sch_id, workout_type, starts_at, capacity=None):
+        self.sessions[sch_id] = Session(sch_id, workout_type, starts_at, capacity)
+        self.seats.setdefault(sch_id, 0)
+        insort(self._order, (starts_at, sch_id))
+
+    # Поля тренировки целиком, как они в базе после изменения: capacity=None —
+    # вместимость сброшена на значение по типу, а не «не менялась»
+    def update_session(self, sch_id, workout_type, starts_at, capacity):
+        old = self.sessions.get(sch_id)
+        if old is None:
+            return
+        new = Session(sch_id, workout_type, starts_at, capacity)
+        self.sessions[sch_id] = new
+        if new.starts_at != old.starts_at:
+            self._order.pop(bisect_left(self._order, (old.starts_at, sch_id)))
+            insort(self._order, (new.starts_at, sch_id))
+
+    def remove_session(self, sch_id):
+        session = self.sessions.pop(sch_id, None)
+        if session is None:
+            return
+        self._order.pop(bisect_left(self._order, (session.starts_at, sch_id)))
+        self.seats.pop(sch_id, None)
+        for regs in self.user_regs.values():
+            for reg_id in [r for r, s in regs.items() if s == sch_id]:
+                del regs[reg_id]
+
+    def add_registration(self, reg_id, user_id, sch_id):
+        self.seats[sch_id] = self.seats.get(sch_id, 0) + 1
+        regs = self.user_regs.get(user_id)
+        if regs is not None:
+            regs[reg_id] = sch_id
+
+    def remove_registration(self, reg_id, user_id, sch_id):
+        if sch_id in self.seats:
+            self.seats[sch_id] = max(self.seats[sch_id] - 1, 0)
+        regs = self.user_regs.get(user_id)
+        if regs is not None:
+            regs.pop(reg_id, None)
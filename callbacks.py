@@ -0,0 +1,112 @@
+from collections import namedtuple
+from aiogram.dispatcher.event.handler import CallableObject
+
+# callback_data: <версия><имя>[:<студия>][:<аргумент>...], например "2book_to:1:42".
+# Версия меняется, когда меняются имена или аргументы: кнопки старых
+# сообщений тогда уходят в fallback, а не в чужой хэндлер.
+VERSION = '2'
+SEP = ':'
+# Предел Telegram на callback_data, в байтах
+MAX_DATA = 64
+
+Route = namedtuple('Route', 'name handler types scoped admin')
+
+
+# Маршрутизатор колбэков: один хэндлер aiogram на все нажатия.
+# Хэндлер находится одним поиском в словаре по имени, аргументы
+# разбираются по типам из route() один раз до вызова:
+#     @callbacks.route('book_to', int, scoped=True)
+#     async def register_to_workout(call, sch_id, studio): ...
+#     kb.button(text=..., callback_data=callbacks.pack('book_to', sch_id, studio=studio.id))
+# Остальные аргументы хэндлера (state, studio и т. п.) aiogram подставляет
+# по именам, как обычно.
+# Проверки в dispatch, по data['studio'] из studio_router:
+#  - scoped=True — аргументы указывают на строки базы студии: в callback_data
+#    пишется и id студии, и кнопка со старого сообщения после смены студии не
+#    трогает строку с тем же номером в базе другой студии;
+#  - admin=True — только для администраторов этой студии, какую бы клавиатуру
+#    пользователь ни получил.
+class CallbackRouter:
+    def __init__(self, version=VERSION):
+        self.version = version
+        self.routes = {}            # имя -> Route
+        self._fallback = None
+        self._rejected = None
+        self.foreign = 0
+        self.forbidden = 0
+
+    def route(self, name, *types, scoped=False, admin=False):
+        if not name or SEP in name or name in self.routes:
+            raise ValueError(f"Недопустимое или повторное имя колбэка: {name!r}")
+
+        def decorator(fn):
+            self.routes[name] = Route(name, CallableObject(fn), types, scoped, admin)
+            return fn
+        return decorator
+
+    # Для callback_data, которые не разобрались: старый формат, неизвестное имя, неверные аргументы
+    def fallback(self, fn):
+        self._fallback = CallableObject(fn)
+        return fn
+
+    # Для нажатий, не прошедших проверку: reason — 'studio' или 'admin'
+    def rejected(self, fn):
+        self._rejected = CallableObject(fn)
+        return fn
+
+    def pack(self, name, *args, studio=None):
+        route = self.routes.get(name)
+        if route is not None and route.scoped:
+            if studio is None:
+                raise ValueError(f"Колбэку {name} нужна студия")
+            args = (studio, *args)
+        data = self.version + SEP.join((name, *map(str, args)))
+        if len(data.encode()) > MAX_DATA:
+            raise ValueError(f"callback_data длиннее {MAX_DATA} байт: {data}")
+        return data
+
+    # (Route, аргументы, id студии или None) или None
+    def unpack(self, data):
+        if not data or not data.startswith(self.version):
+            return None
+        name, *parts = data[len(self.version):].split(SEP)
+        route = self.routes.get(name)
+        if route is None or len(parts) != len(route.types) + route.scoped:
+            return None
+        try:
+            studio_id = int(parts.pop(0)) if route.scoped else None
+            return route, [t(part) for t, part in zip(route.types, parts)], studio_id
+        except ValueError:
+            return None
+
+    async def dispatch(self, call, **data):
+        resolved = self.unpack(call.data)
+        if resolved is None:
+            if self._fallback is not None:
+                return await self._fallback.call(call, **data)
+            return await call.answer()
+        route, args, studio_id = resolved
+        # Для bot_handler_seconds: имя настоящего хэндлера, а не dispatch
+        ctx = data.get('metrics')
+        if ctx is not None:
+            ctx['handler'] = route.handler.callback.__name__
+
+        studio = data.get('studio')
+        if route.scoped and (studio is None or studio.id != studio_id):
+            self.foreign += 1
+            return await self._reject(call, 'studio', data)
+        if route.admin and (studio is None or not studio.is_admin(call.from_user.id)):
+            self.forbidden += 1
+            return await self._reject(call, 'admin', data)
+        return await route.handler.call(call, *args, **data)
+
+    async def _reject(self, call, reason, data):
+        if self._rejected is not None:
+            return await self._rejected.call(call, reason, **data)
+        return await call.answer()
+
+    def stats(self):
+        return {'foreign_studio': self.foreign, 'not_admin': self.forbidden}
+
+    def setup(self, observer):
+        observer.register(self.dispatch)
@@ -0,0 +1,297 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import aiosqlite
+from metrics import SQL_ROWS, SQL_SECONDS, statement_label
+
+# Прагмы, которые выставляются на каждом соединении
+PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",       # ~16 МБ страничного кэша на соединение
+    "PRAGMA mmap_size = 134217728",     # 128 МБ memory-mapped I/O
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+)
+
+# Сколько подготовленных выражений держит sqlite3 на каждом соединении
+STATEMENT_CACHE_SIZE = 256
+
+
+# Обёртки соединения и курсора, которые замеряют каждый запрос.
+# Для SELECT время и число строк учитываются при выборке результата:
+# sqlite3 выполняет запрос по мере чтения строк.
+class TimedCursor:
+    def __init__(self, cursor, label, started):
+        self._cursor = cursor
+        self._label = label
+        self._started = started
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _observe(self, rows):
+        if self._started is not None:
+            SQL_SECONDS.observe(time.perf_counter() - self._started, self._label)
+            SQL_ROWS.observe(rows, self._label)
+            self._started = None
+
+    async def fetchone(self):
+        row = await self._cursor.fetchone()
+        self._observe(0 if row is None else 1)
+        return row
+
+    async def fetchall(self):
+        rows = await self._cursor.fetchall()
+        self._observe(len(rows))
+        return rows
+
+
+class TimedConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _run(self, method, sql, params):
+        label = statement_label(sql)
+        started = time.perf_counter()
+        cursor = await method(sql, params)
+        if cursor.description is not None:
+            return TimedCursor(cursor, label, started)
+        SQL_SECONDS.observe(time.perf_counter() - started, label)
+        SQL_ROWS.observe(max(cursor.rowcount, 0), label)
+        return cursor
+
+    async def execute(self, sql, params=()):
+        return await self._run(self._conn.execute, sql, params)
+
+    async def executemany(self, sql, params):
+        return await self._run(self._conn.executemany, sql, params)
+
+
+# Долгоживущие соединения с БД: один писатель и пул читателей.
+# WAL позволяет читателям работать параллельно с записью.
+class Database:
+    def __init__(self, path, readers=4):
+        self.path = path
+        self.readers_count = readers
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+
+    async def _connect(self):
+        # isolation_level=None: транзакциями управляем сами через BEGIN/COMMIT
+        conn = await aiosqlite.connect(
+            self.path,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma in PRAGMAS:
+            cursor = await conn.execute(pragma)
+            await cursor.close()
+        return TimedConnection(conn)
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        try:
+            # В новой базе, пока нет ни одной таблицы, включаем incremental_vacuum:
+            # потом этот режим ставится только полным VACUUM (python maintenance.py convert)
+            cursor = await self._writer.execute("PRAGMA page_count")
+            if (await cursor.fetchone())[0] == 0:
+                await self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await cursor.close()
+            # Режим журнала хранится в самом файле, достаточно выставить один раз
+            cursor = await self._writer.execute("PRAGMA journal_mode = WAL")
+            await cursor.close()
+            for _ in range(self.readers_count):
+                conn = await self._connect()
+                self._all_readers.append(conn)
+                self._readers.put_nowait(conn)
+        except BaseException:
+            await self.close()
+            raise
+
+    async def close(self):
+        if self._writer is None:
+            return
+        async with self._write_lock:
+            # Сбрасываем WAL в основной файл перед выходом
+            await self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            await self._writer.close()
+            self._writer = None
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+
+    # Транзакция на запись: коммит при успехе, откат при исключении.
+    # foreign_keys=False нужен миграциям, которые пересоздают таблицы.
+    @asynccontextmanager
+    async def write(self, foreign_keys=True):
+        async with self._write_lock:
+            conn = self._writer
+            if not foreign_keys:
+                await conn.execute("PRAGMA foreign_keys = OFF")
+            try:
+                await conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield conn
+                except BaseException:
+                    await conn.execute("ROLLBACK")
+                    raise
+                else:
+                    await conn.execute("COMMIT")
+            finally:
+                if not foreign_keys:
+                    await conn.execute("PRAGMA foreign_keys = ON")
+
+    # Соединение писателя вне транзакции — для прагм обслуживания
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self._write_lock:
+            yield self._writer
+
+    # Соединение только для чтения из пула
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def fetchall(self, sql, params=()):
+        async with self.read() as conn:
+            cursor = await conn.execute(sql, params)
+            return await cursor.fetchall()
+
+    async def fetchone(self, sql, params=()):
+        async with self.read() as conn:
+            cursor = await conn.execute(sql, params)
+            return await cursor.fetchone()
+
+
+# Ограниченный LRU открытых баз-шардов (по базе на студию).
+# Открытая база — писатель и readers читателей. Сверх max_open закрывается
+# давно не использованная база, с которой сейчас никто не работает; если заняты
+# все, предел временно превышается. prepare(database) выполняется после каждого
+# открытия (миграции).
+class ShardPool:
+    def __init__(self, max_open=32, readers=2):
+        self.max_open = max_open
+        self.readers = readers
+        self._open = OrderedDict()      # путь -> Database, от давно использованных к недавним
+        self._users = {}                # путь -> сколько задач сейчас работает с базой
+        self._locks = {}                # путь -> Lock открытия и закрытия
+        self.opened = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._open)
+
+    def _lock(self, path):
+        lock = self._locks.get(path)
+        if lock is None:
+            lock = self._locks[path] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def use(self, path, prepare=None):
+        self._users[path] = self._users.get(path, 0) + 1
+        try:
+            database = self._open.get(path)
+            if database is None:
+                database = await self._open_shard(path, prepare)
+            else:
+                self._open.move_to_end(path)
+            yield database
+        finally:
+            self._users[path] -= 1
+            if not self._users[path]:
+                del self._users[path]
+        await self._evict()
+
+    async def _open_shard(self, path, prepare):
+        async with self._lock(path):
+            database = self._open.get(path)
+            if database is not None:
+                return database
+            database = Database(path, readers=self.readers)
+            await database.open()
+            try:
+                if prepare is not None:
+                    await prepare(database)
+            except BaseException:
+                await database.close()
+                raise
+            self._open[path] = database
+            self.opened += 1
+            return database
+
+    async def _evict(self):
+        while len(self._open) > self.max_open:
+            path = next((p for p in self._open if p not in self._users), None)
+            if path is None:
+                return
+            await self.close(path)
+            self.evicted += 1
+
+    async def close(self, path):
+        async with self._lock(path):
+            database = self._open.pop(path, None)
+            if database is not None:
+                await database.close()
+
+    async def close_all(self):
+        for path in list(self._open):
+            await self.close(path)
+
+
+# База одного шарда с тем же интерфейсом, что у Database: каждое обращение
+# берёт соединение из ShardPool на время работы, поэтому компоненты студии
+# (кэш, напоминания, рассылки) не держат базу открытой между обращениями.
+class ShardDatabase:
+    def __init__(self, pool, path, prepare=None):
+        self.pool = pool
+        self.path = path
+        self.prepare = prepare
+
+    # Открывает шард заранее (и прогоняет миграции)
+    async def open(self):
+        async with self.pool.use(self.path, self.prepare):
+            pass
+
+    async def close(self):
+        await self.pool.close(self.path)
+
+    @asynccontextmanager
+    async def write(self, foreign_keys=True):
+        async with self.pool.use(self.path, self.prepare) as database:
+            async with database.write(foreign_keys) as db:
+                yield db
+
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self.pool.use(self.path, self.prepare) as database:
+            async with database.exclusive() as db:
+                yield db
+
+    @asynccontextmanager
+    async def read(self):
+        async with self.pool.use(self.path, self.prepare) as database:
+            async with database.read() as db:
+                yield db
+
+    async def fetchall(self, sql, params=()):
+        async with self.pool.use(self.path, self.prepare) as database:
+            return await database.fetchall(sql, params)
+
+    async def fetchone(self, sql, params=()):
+        async with self.pool.use(self.path, self.prepare) as database:
+            return await database.fetchone(sql, params)
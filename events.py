@@ -0,0 +1,259 @@
+import asyncio
+import json
+import logging
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from metrics import EVENT_ERRORS, EVENT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Доменные события. Поля — только числа, строки и флаги: событие хранится в outbox как JSON.
+#  promoted    — место получено из листа ожидания;
+#  at          — момент отмены (epoch);
+#  by_admin    — запись отменил администратор;
+#  SessionChanged несёт тренировку после изменения (или создания),
+#  rescheduled — изменилось время начала.
+RegistrationCreated = namedtuple('RegistrationCreated', 'registration_id user_id schedule_id promoted')
+RegistrationCancelled = namedtuple('RegistrationCancelled', 'registration_id user_id schedule_id at by_admin')
+WaitlistJoined = namedtuple('WaitlistJoined', 'schedule_id user_id')
+SessionChanged = namedtuple('SessionChanged', 'schedule_id workout_type starts_at capacity rescheduled')
+SessionDeleted = namedtuple('SessionDeleted', 'schedule_id')
+
+EVENT_TYPES = {
+    cls.__name__: cls
+    for cls in (RegistrationCreated, RegistrationCancelled, WaitlistJoined, SessionChanged, SessionDeleted)
+}
+
+# Строк outbox за один проход доставки
+BATCH = 200
+# После стольких неудач строка остаётся в outbox с available_at = NULL
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 3600
+# На столько секунд строка закрепляется за процессом, который отправляет её вне транзакции
+LEASE = 60
+# Предел ожидания: раз в столько секунд перепроверяем outbox в любом случае
+MAX_SLEEP = 300
+
+Subscriber = namedtuple('Subscriber', 'name handler in_transaction after_commit')
+
+
+# Подписки на события: общие для всех шин (у каждой студии своя шина).
+# Обработчики первым аргументом получают context шины — студию.
+class EventRoutes:
+    def __init__(self):
+        self.subscribers = {}       # имя -> Subscriber
+        self.routes = {}            # тип события -> [имена подписчиков]
+        self.listeners = {}         # тип события -> [функции]
+
+    # Синхронный слушатель fn(context, event) в памяти процесса. Не переживает
+    # рестарт — только для того, что при старте всё равно восстанавливается из БД.
+    def listen(self, *event_types):
+        def decorator(fn):
+            for event_type in event_types:
+                self.listeners.setdefault(event_type, []).append(fn)
+            return fn
+        return decorator
+
+    # Постоянный подписчик; имя хранится в outbox и не должно меняться.
+    # in_transaction=True: fn(context, db, event) выполняется в транзакции записи
+    # вместе с удалением строки outbox — ровно один раз. Иначе fn(context, event)
+    # вызывается вне транзакции (Bot API) — хотя бы один раз, после сбоя возможен
+    # повтор. after_commit(context) вызывается после каждой доставленной пачки.
+    def subscribe(self, name, *event_types, in_transaction=False, after_commit=None):
+        def decorator(fn):
+            self.subscribers[name] = Subscriber(name, fn, in_transaction, after_commit)
+            for event_type in event_types:
+                self.routes.setdefault(event_type, []).append(name)
+            return fn
+        return decorator
+
+
+# Шина доменных событий одной базы.
+# Хэндлер открывает транзакцию через write(), меняет данные и публикует события.
+# Для каждого постоянного подписчика событие пишется строкой в outbox в той же
+# транзакции, поэтому после коммита оно будет доставлено даже при падении процесса;
+# при откате исчезает вместе с изменениями. Доставляет фоновая задача: подписчики
+# работают параллельно друг другу, события одного подписчика идут по порядку.
+# Слушатели — для состояния в памяти (кэш): вызываются сразу после коммита.
+class EventBus:
+    def __init__(self, database, routes, context=None):
+        self.database = database
+        self.routes = routes
+        self.context = context
+        self._pending = None        # события текущей транзакции write()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    # --- Публикация ---
+
+    # Транзакция записи, в которой можно публиковать события
+    @asynccontextmanager
+    async def write(self):
+        async with self.database.write() as db:
+            self._pending = []
+            try:
+                yield db
+            finally:
+                pending, self._pending = self._pending, None
+        self._committed(pending)
+
+    async def publish(self, db, event):
+        if self._pending is None:
+            raise RuntimeError("События публикуются только внутри EventBus.write()")
+        self._pending.append(event)
+        names = self.routes.routes.get(type(event))
+        if names:
+            now = int(time.time())
+            payload = json.dumps(event._asdict(), ensure_ascii=False)
+            await db.executemany('''
+                INSERT INTO outbox (subscriber, event_type, payload, created_at, available_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(name, type(event).__name__, payload, now, now) for name in names])
+
+    def _committed(self, events):
+        durable = False
+        for event in events:
+            for fn in self.routes.listeners.get(type(event), ()):
+                try:
+                    fn(self.context, event)
+                except Exception:
+                    logger.exception("Слушатель %s упал на %s", fn.__name__, event)
+            durable = durable or type(event) in self.routes.routes
+        if durable:
+            self._wakeup.set()
+
+    # --- Доставка ---
+
+    # Один проход по наступившим строкам outbox; возвращает число взятых строк
+    async def deliver_due(self):
+        rows = await self.database.fetchall('''
+            SELECT id, subscriber, event_type, payload, attempts FROM outbox
+            WHERE available_at <= ?
+            ORDER BY id
+            LIMIT ?
+        ''', (int(time.time()), BATCH))
+        groups = {}
+        orphans = []
+        for out_id, name, event_type, payload, attempts in rows:
+            subscriber = self.routes.subscribers.get(name)
+            if subscriber is None or event_type not in EVENT_TYPES:
+                orphans.append((out_id,))
+                continue
+            event = EVENT_TYPES[event_type](**json.loads(payload))
+            groups.setdefault(subscriber, []).append((out_id, attempts, event))
+        if orphans:
+            # Подписчика убрали из кода — доставлять некому
+            logger.warning("Outbox: %d строк без подписчика удалено", len(orphans))
+            async with self.database.write() as db:
+                await db.executemany("DELETE FROM outbox WHERE id = ?", orphans)
+
+        await asyncio.gather(*(
+            self._deliver_in_transaction(s, items) if s.in_transaction else self._deliver(s, items)
+            for s, items in groups.items()
+        ))
+        return len(rows)
+
+    def _failure(self, subscriber, out_id, attempts, event, error):
+        EVENT_ERRORS.inc(subscriber.name, type(error).__name__)
+        attempts += 1
+        if attempts >= MAX_ATTEMPTS:
+            logger.error("Событие %s для %s не доставлено после %d попыток: %r",
+                         event, subscriber.name, attempts, error)
+            available_at = None
+        else:
+            logger.warning("Событие %s для %s: %r, повтор", event, subscriber.name, error)
+            available_at = int(time.time()) + min(5 * 2 ** attempts, MAX_BACKOFF)
+        return attempts, available_at, repr(error)[:500], out_id
+
+    async def _deliver_in_transaction(self, subscriber, items):
+        delivered = 0
+        async with self.database.write() as db:
+            for out_id, attempts, event in items:
+                # Точка сохранения на событие: ошибка одного не откатывает остальные
+                await db.execute("SAVEPOINT event")
+                started = time.perf_counter()
+                try:
+                    cursor = await db.execute(
+                        "DELETE FROM outbox WHERE id = ? AND available_at IS NOT NULL", (out_id,)
+                    )
+                    if cursor.rowcount:
+                        # Иначе строку уже доставил другой процесс
+                        await subscriber.handler(self.context, db, event)
+                        delivered += 1
+                except Exception as e:
+                    await db.execute("ROLLBACK TO event")
+                    await db.execute(
+                        "UPDATE outbox SET attempts = ?, available_at = ?, last_error = ? WHERE id = ?",
+                        self._failure(subscriber, out_id, attempts, event, e)
+                    )
+                else:
+                    EVENT_SECONDS.observe(time.perf_counter() - started, subscriber.name)
+                await db.execute("RELEASE event")
+        if delivered and subscriber.after_commit:
+            subscriber.after_commit(self.context)
+
+    async def _deliver(self, subscriber, items):
+        now = int(time.time())
+        claimed = []
+        async with self.database.write() as db:
+            for item in items:
+                cursor = await db.execute(
+                    "UPDATE outbox SET available_at = ? WHERE id = ? AND available_at <= ?",
+                    (now + LEASE, item[0], now)
+                )
+                if cursor.rowcount:
+                    claimed.append(item)
+
+        done, failed = [], []
+        for out_id, attempts, event in claimed:
+            started = time.perf_counter()
+            try:
+                await subscriber.handler(self.context, event)
+            except Exception as e:
+                failed.append(self._failure(subscriber, out_id, attempts, event, e))
+            else:
+                EVENT_SECONDS.observe(time.perf_counter() - started, subscriber.name)
+                done.append((out_id,))
+
+        async with self.database.write() as db:
+            await db.executemany("DELETE FROM outbox WHERE id = ?", done)
+            await db.executemany(
+                "UPDATE outbox SET attempts = ?, available_at = ?, last_error = ? WHERE id = ?", failed
+            )
+        if done and subscriber.after_commit:
+            subscriber.after_commit(self.context)
+
+    # --- Фоновый запуск ---
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            next_at = None
+            try:
+                if await self.deliver_due():
+                    continue
+                row = await self.database.fetchone("SELECT MIN(available_at) FROM outbox")
+                next_at = row[0] if row else None
+            except Exception:
+                logger.exception("Доставка событий не удалась")
+            delay = MAX_SLEEP if next_at is None else min(next_at - time.time(), MAX_SLEEP)
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, time as dtime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Как часто досоздаём расписание (секунды)
+GENERATE_INTERVAL = 3600
+
+
+# Регулярное расписание по шаблонам из schedule_templates (день недели, время, тип, вместимость).
+# Генератор создаёт только недостающие тренировки на weeks недель вперёд:
+#  - по каждому шаблону помнит, до какого момента уже всё создано (generated_until),
+#    поэтому удалённая администратором тренировка не появится снова;
+#  - не вставляет тренировку, если такая же (тип и время) уже есть;
+#  - ничего не удаляет — существующие записи не трогаются;
+#  - шаблоны типов, которых нет в каталоге студии (workout_types), пропускает.
+# Все новые тренировки вставляются одним executemany в одной транзакции.
+class ScheduleGenerator:
+    def __init__(self, database, cache, tz, weeks=2, workout_types=None):
+        self.database = database
+        self.cache = cache
+        self.tz = tz
+        self.weeks = weeks
+        self.workout_types = workout_types
+        self._task = None
+
+    def _occurrences(self, weekday, start_minute, since, until):
+        day = datetime.fromtimestamp(since, self.tz).date()
+        day += timedelta(days=(weekday - day.weekday()) % 7)
+        at = dtime(start_minute // 60, start_minute % 60)
+        while True:
+            starts_at = int(datetime.combine(day, at, tzinfo=self.tz).timestamp())
+            if starts_at >= until:
+                return
+            if starts_at >= since:
+                yield starts_at
+            day += timedelta(days=7)
+
+    # Возвращает число созданных тренировок
+    async def generate(self):
+        now = int(time.time())
+        horizon = int((datetime.now(self.tz) + timedelta(weeks=self.weeks)).timestamp())
+        async with self.database.write() as db:
+            cursor = await db.execute('''
+                SELECT id, weekday, start_minute, workout_type, capacity, generated_until
+                FROM schedule_templates
+                WHERE active = 1 AND COALESCE(generated_until, 0) < ?
+            ''', (horizon,))
+            templates = [
+                t for t in await cursor.fetchall()
+                if self.workout_types is None or t[3] in self.workout_types
+            ]
+
+            rows = []
+            for template_id, weekday, start_minute, workout_type, capacity, generated_until in templates:
+                since = max(now, generated_until or 0)
+                for starts_at in self._occurrences(weekday, start_minute, since, horizon):
+                    rows.append((template_id, workout_type, starts_at, capacity, workout_type, starts_at))
+            created = 0
+            if rows:
+                cursor = await db.executemany('''
+                    INSERT OR IGNORE INTO schedules (template_id, workout_type, starts_at, capacity)
+                    SELECT ?, ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM schedules WHERE workout_type = ? AND starts_at = ?)
+                ''', rows)
+                created = cursor.rowcount
+            await db.executemany(
+                "UPDATE schedule_templates SET generated_until = ? WHERE id = ?",
+                [(horizon, t[0]) for t in templates]
+            )
+
+        if created:
+            await self.cache.load(self.database)
+        return created
+
+    # --- Шаблоны ---
+    # Шаблон: (weekday, start_minute, workout_type, capacity). Управление — tenants.py template-*
+
+    async def templates(self):
+        return await self.database.fetchall('''
+            SELECT id, weekday, start_minute, workout_type, capacity, active
+            FROM schedule_templates ORDER BY weekday, start_minute, workout_type
+        ''')
+
+    def _check_type(self, workout_type):
+        if self.workout_types is not None and workout_type not in self.workout_types:
+            raise ValueError(f"Типа {workout_type!r} нет в каталоге студии")
+
+    # Возвращает id шаблона; такой же (день, время, тип) уже есть — ValueError
+    async def add_template(self, weekday, start_minute, workout_type, capacity=None):
+        self._check_type(workout_type)
+        async with self.database.write() as db:
+            cursor = await db.execute('''
+                INSERT OR IGNORE INTO schedule_templates (weekday, start_minute, workout_type, capacity)
+                VALUES (?, ?, ?, ?)
+            ''', (weekday, start_minute, workout_type, capacity))
+            if not cursor.rowcount:
+                raise ValueError("Такой шаблон уже есть")
+            return cursor.lastrowid
+
+    # Созданные по шаблону тренировки остаются, новые не создаются
+    async def remove_template(self, template_id):
+        async with self.database.write() as db:
+            cursor = await db.execute("DELETE FROM schedule_templates WHERE id = ?", (template_id,))
+            return cursor.rowcount > 0
+
+    # Начальные шаблоны студии: только в пустую таблицу, чтобы не вернуть
+    # шаблоны, которые администратор уже удалил. Возвращает число добавленных
+    async def seed(self, templates):
+        for template in templates:
+            self._check_type(template[2])
+        async with self.database.write() as db:
+            cursor = await db.execute("SELECT 1 FROM schedule_templates LIMIT 1")
+            if await cursor.fetchone():
+                return 0
+            cursor = await db.executemany('''
+                INSERT OR IGNORE INTO schedule_templates (weekday, start_minute, workout_type, capacity)
+                VALUES (?, ?, ?, ?)
+            ''', templates)
+            return cursor.rowcount
+
+    # --- Фоновый запуск ---
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.generate()
+            except Exception:
+                logger.exception("Не удалось досоздать расписание")
+            await asyncio.sleep(GENERATE_INTERVAL)
@@ -0,0 +1,261 @@
+import csv
+import io
+from collections import namedtuple
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Ограничения на загружаемый файл
+MAX_FILE_SIZE = 1024 * 1024
+MAX_ROWS = 2000
+
+# Строка файла после разбора; line — номер строки в файле для сообщений об ошибках
+ImportRow = namedtuple('ImportRow', 'line workout_type starts_at capacity')
+
+CSV_DATETIME_FORMATS = ('%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M')
+CSV_DELIMITERS = (',', ';', '\t')
+
+
+# Итог сравнения файла с расписанием.
+#  create    — новые тренировки;
+#  update    — (schedule_id, строка, прежняя вместимость): меняется вместимость;
+#  unchanged — такие тренировки уже есть;
+#  errors    — (номер строки, текст): при любой ошибке файл не применяется.
+class ImportPlan:
+    def __init__(self, errors=()):
+        self.create = []
+        self.update = []
+        self.unchanged = []
+        self.errors = list(errors)
+        self.applied = False
+
+    def as_dict(self, format_ts):
+        return {
+            'applied': self.applied,
+            'create': [
+                {'line': r.line, 'workout_type': r.workout_type, 'starts_at': format_ts(r.starts_at), 'capacity': r.capacity}
+                for r in self.create
+            ],
+            'update': [
+                {'line': r.line, 'schedule_id': sch_id, 'workout_type': r.workout_type,
+                 'starts_at': format_ts(r.starts_at), 'capacity': [old, r.capacity]}
+                for sch_id, r, old in self.update
+            ],
+            'unchanged': len(self.unchanged),
+            'errors': [{'line': line, 'error': text} for line, text in self.errors],
+        }
+
+
+# Импорт расписания из CSV или iCalendar.
+# CSV: дата;время;тип[;вместимость] или "дата время";тип[;вместимость],
+# разделитель , ; или табуляция, строка заголовка и строки с # пропускаются.
+# ICS: каждое VEVENT — тренировка, SUMMARY — тип, DTSTART — начало.
+# Тренировка определяется типом и временем начала: совпадающая обновляет вместимость
+# (если она указана), другой тип в то же время — конфликт. Всё применяется одной транзакцией.
+class ScheduleImporter:
+    def __init__(self, database, tz, workout_types):
+        self.database = database
+        self.tz = tz
+        self.workout_types = {t.lower(): t for t in workout_types}
+
+    # --- Разбор ---
+
+    # Возвращает (строки, ошибки)
+    def parse(self, content):
+        if len(content) > MAX_FILE_SIZE:
+            return [], [(0, f"Файл больше {MAX_FILE_SIZE // 1024} КБ")]
+        try:
+            text = content.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            # Excel сохраняет CSV в cp1251
+            text = content.decode('cp1251', errors='replace')
+        if text.lstrip().upper().startswith('BEGIN:VCALENDAR'):
+            rows, errors = self._parse_ics(text)
+        else:
+            rows, errors = self._parse_csv(text)
+        if len(rows) > MAX_ROWS:
+            return [], [(0, f"Больше {MAX_ROWS} тренировок в одном файле")]
+        if not rows and not errors:
+            errors.append((0, "В файле нет тренировок"))
+        return rows, errors
+
+    def _workout_type(self, value):
+        return self.workout_types.get(value.strip().lower())
+
+    def _parse_csv(self, text):
+        # Разделитель — самый частый из допустимых в первой строке
+        first = text.lstrip().partition('\n')[0]
+        delimiter = max(CSV_DELIMITERS, key=first.count)
+        reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+        rows, errors = [], []
+        for cells in reader:
+            line = reader.line_num
+            cells = [c.strip() for c in cells]
+            if not any(cells) or cells[0].startswith('#'):
+                continue
+            starts_at, rest = self._csv_datetime(cells)
+            if starts_at is None:
+                # Заголовок — первая непустая строка без даты
+                if not rows and not errors and line == 1:
+                    continue
+                errors.append((line, "Неверная дата или время, ожидается 01.02.2026 10:00"))
+                continue
+            if not rest:
+                errors.append((line, "Не указан тип тренировки"))
+                continue
+            workout_type = self._workout_type(rest[0])
+            if workout_type is None:
+                errors.append((line, f"Неизвестный тип тренировки: {rest[0]}"))
+                continue
+            capacity = None
+            if len(rest) > 1 and rest[1]:
+                if not rest[1].isdigit() or int(rest[1]) < 1:
+                    errors.append((line, f"Вместимость должна быть целым числом больше нуля: {rest[1]}"))
+                    continue
+                capacity = int(rest[1])
+            rows.append(ImportRow(line, workout_type, starts_at, capacity))
+        return rows, errors
+
+    # Дата и время одной ячейкой или двумя; возвращает (epoch, остальные ячейки)
+    def _csv_datetime(self, cells):
+        for width in (1, 2):
+            value = ' '.join(cells[:width])
+            for fmt in CSV_DATETIME_FORMATS:
+                try:
+                    dt = datetime.strptime(value, fmt)
+                except ValueError:
+                    continue
+                return int(dt.replace(tzinfo=self.tz).timestamp()), cells[width:]
+        return None, cells
+
+    def _parse_ics(self, text):
+        # Склеиваем перенесённые строки (RFC 5545: продолжение начинается с пробела)
+        lines = []
+        for number, raw in enumerate(text.splitlines(), 1):
+            if raw[:1] in (' ', '\t') and lines:
+                lines[-1][1] += raw[1:]
+            else:
+                lines.append([number, raw])
+
+        rows, errors = [], []
+        event = None
+        for number, raw in lines:
+            name, _, value = raw.partition(':')
+            name, *params = name.split(';')
+            name = name.upper()
+            if name == 'BEGIN' and value.upper() == 'VEVENT':
+                event = {'line': number}
+            elif name == 'END' and value.upper() == 'VEVENT' and event is not None:
+                row = self._ics_event(event, errors)
+                if row is not None:
+                    rows.append(row)
+                event = None
+            elif event is not None and name in ('DTSTART', 'SUMMARY', 'STATUS', 'RRULE'):
+                event[name] = (params, value)
+        return rows, errors
+
+    def _ics_event(self, event, errors):
+        line = event['line']
+        if 'STATUS' in event and event['STATUS'][1].strip().upper() == 'CANCELLED':
+            return None
+        if 'RRULE' in event:
+            errors.append((line, "Повторяющиеся события не поддерживаются, нужна каждая тренировка отдельно"))
+            return None
+        if 'DTSTART' not in event or 'SUMMARY' not in event:
+            errors.append((line, "У события нет DTSTART или SUMMARY"))
+            return None
+
+        summary = event['SUMMARY'][1].replace('\\,', ',').replace('\\;', ';')
+        workout_type = self._workout_type(summary)
+        if workout_type is None:
+            errors.append((line, f"Неизвестный тип тренировки: {summary}"))
+            return None
+
+        params, value = event['DTSTART']
+        params = dict(p.split('=', 1) for p in params if '=' in p)
+        value = value.strip()
+        try:
+            if value.endswith('Z'):
+                dt = datetime.strptime(value, '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+            else:
+                tz = ZoneInfo(params['TZID']) if 'TZID' in params else self.tz
+                dt = datetime.strptime(value, '%Y%m%dT%H%M%S').replace(tzinfo=tz)
+        except (ValueError, ZoneInfoNotFoundError):
+            errors.append((line, f"Неверное время начала: {value}"))
+            return None
+        return ImportRow(line, workout_type, int(dt.timestamp()), None)
+
+    # --- Сравнение и запись ---
+
+    async def _plan(self, db, rows, errors, now):
+        plan = ImportPlan(errors)
+        if not rows:
+            return plan
+        cursor = await db.execute('''
+            SELECT s.id, s.workout_type, s.starts_at, s.capacity,
+                   (SELECT COUNT(*) FROM registrations WHERE schedule_id = s.id)
+            FROM schedules s
+            WHERE starts_at BETWEEN ? AND ?
+        ''', (min(r.starts_at for r in rows), max(r.starts_at for r in rows)))
+        existing = {}
+        for sch_id, workout_type, starts_at, capacity, seats in await cursor.fetchall():
+            existing.setdefault(starts_at, []).append((sch_id, workout_type, capacity, seats))
+
+        seen = {}
+        for row in rows:
+            if row.starts_at < now:
+                plan.errors.append((row.line, "Время уже прошло"))
+                continue
+            if row.starts_at in seen:
+                other = seen[row.starts_at]
+                if other.workout_type == row.workout_type:
+                    plan.errors.append((row.line, f"Повтор строки {other.line}"))
+                else:
+                    plan.errors.append((row.line, f"В это же время уже {other.workout_type} (строка {other.line})"))
+                continue
+            seen[row.starts_at] = row
+
+            same = None
+            for sch_id, workout_type, capacity, seats in existing.get(row.starts_at, ()):
+                if workout_type == row.workout_type:
+                    same = (sch_id, capacity, seats)
+                else:
+                    plan.errors.append((row.line, f"В это же время в расписании уже {workout_type}"))
+                    same = False
+                    break
+            if same is False:
+                continue
+            if same is None:
+                plan.create.append(row)
+                continue
+            sch_id, capacity, seats = same
+            if row.capacity is None or row.capacity == capacity:
+                plan.unchanged.append(row)
+            elif row.capacity < seats:
+                plan.errors.append((row.line, f"Уже записано {seats}, вместимость {row.capacity} меньше"))
+            else:
+                plan.update.append((sch_id, row, capacity))
+        plan.errors.sort()
+        return plan
+
+    # Предпросмотр: ничего не записывает
+    async def preview(self, rows, errors, now):
+        async with self.database.read() as db:
+            return await self._plan(db, rows, errors, now)
+
+    # Внутри транзакции записи: сравнение повторяется на соединении писателя,
+    # и изменения применяются, только если ошибок нет
+    async def apply(self, db, rows, now):
+        plan = await self._plan(db, rows, [], now)
+        if plan.errors or not (plan.create or plan.update):
+            return plan
+        if plan.create:
+            await db.executemany('''
+                INSERT INTO schedules (workout_type, starts_at, capacity) VALUES (?, ?, ?)
+            ''', [(r.workout_type, r.starts_at, r.capacity) for r in plan.create])
+        if plan.update:
+            await db.executemany(
+                "UPDATE schedules SET capacity = ? WHERE id = ?",
+                [(r.capacity, sch_id) for sch_id, r, _ in plan.update]
+            )
+        plan.applied = True
+        return plan
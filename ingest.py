@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Что делать, когда очередь заполнена:
+#   reject      — не принимать апдейт, вебхук отвечает 503 и Telegram повторит его позже
+#   drop_oldest — выбросить самый старый апдейт из той же очереди
+#   block       — ждать свободного места (ответ вебхука задерживается)
+POLICIES = ('reject', 'drop_oldest', 'block')
+
+
+# Очередь входящих апдейтов вебхука.
+# Апдейты раскладываются по очередям воркеров по user_id: апдейты одного
+# пользователя обрабатываются строго по порядку, разных — параллельно.
+# Повторы с тем же update_id в пределах окна отбрасываются.
+class UpdateQueue:
+    def __init__(self, dp, bot, workers=4, maxsize=1000, dedup_window=10000, policy='reject'):
+        if policy not in POLICIES:
+            raise ValueError(f"Неизвестная политика очереди: {policy}")
+        self.dp = dp
+        self.bot = bot
+        self.policy = policy
+        self.dedup_window = dedup_window
+        per_worker = max(maxsize // workers, 1)
+        self._queues = [asyncio.Queue(maxsize=per_worker) for _ in range(workers)]
+        self._seen = OrderedDict()
+        self._workers = []
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'capacity': sum(q.maxsize for q in self._queues),
+            'workers': len(self._queues),
+            'policy': self.policy,
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+    def _shard(self, update):
+        try:
+            user = getattr(update.event, 'from_user', None)
+        except Exception:
+            # Тип апдейта, которого aiogram не знает
+            user = None
+        key = user.id if user else update.update_id
+        return self._queues[key % len(self._queues)]
+
+    def _remember(self, update_id):
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedup_window:
+            self._seen.popitem(last=False)
+
+    # Возвращает False, если апдейт не принят и Telegram стоит попросить повторить
+    async def submit(self, update):
+        if update.update_id in self._seen:
+            self.duplicates += 1
+            return True
+
+        queue = self._shard(update)
+        if queue.full():
+            if self.policy == 'reject':
+                self.rejected += 1
+                return False
+            if self.policy == 'drop_oldest':
+                try:
+                    queue.get_nowait()
+                    queue.task_done()
+                    self.dropped += 1
+                except asyncio.QueueEmpty:
+                    pass
+
+        self._remember(update.update_id)
+        if self.policy == 'block':
+            await queue.put(update)
+        else:
+            queue.put_nowait(update)
+        self.accepted += 1
+        return True
+
+    @property
+    def running(self):
+        return bool(self._workers) and not any(task.done() for task in self._workers)
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    # drain=True — сначала дообрабатываем то, что уже в очереди
+    async def stop(self, drain=True):
+        if drain:
+            await asyncio.gather(*(q.join() for q in self._queues))
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Ошибка при обработке апдейта %s", update.update_id)
+            finally:
+                queue.task_done()
@@ -1,690 +1,1431 @@
+# Отсчёт холодного старта — до всех тяжёлых импортов
+import time
+STARTED_AT = time.perf_counter()
+
 import asyncio
+import logging
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, CallbackQuery, Update
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.filters import Command
-import aiosqlite
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 import os
-from fastapi import FastAPI, Request
-import uvicorn
+import secrets
+from functools import lru_cache
+from fastapi import APIRouter, FastAPI, Header, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
+from db import Database, ShardPool, ShardDatabase
+from cache import ScheduleCache
+from broadcast import Broadcaster
+from reminders import ReminderScheduler
+from migrations import migrate
+from tenants import StudioRegistry
+from ingest import UpdateQueue
+from callbacks import CallbackRouter
+from throttle import ThrottleMiddleware
+from backup import BackupManager
+from recorder import UpdateRecorder
+from storage import SQLiteStorage
+from views import ScreenCache
+from generator import ScheduleGenerator
+from maintenance import Maintenance
+from seats import SeatBook, RESERVED, ALREADY, FULL, WAITLISTED, GONE, STARTED
+from analytics import Analytics, EXPORTS, WEEKDAYS
+from importer import ScheduleImporter, ImportRow, MAX_FILE_SIZE
+from events import (
+    EventBus, EventRoutes, RegistrationCreated, RegistrationCancelled, WaitlistJoined, SessionChanged, SessionDeleted,
+)
+import metrics
+import outbound
+
+logger = logging.getLogger(__name__)
 
 # Настройки
 TOKEN = os.getenv("TOKEN")
-ADMIN_ID = 2021080653
-TIMEZONE = ZoneInfo('Asia/Yekaterinburg')
+# Внешний адрес сервера: если задан, вебхук регистрируется после прогрева
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+# Сколько секунд ждать ответа БД в /readyz
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", 2.0))
+# За сколько минут до тренировки напоминать, например "1440,120" — за сутки и за 2 часа
+REMINDER_OFFSETS = tuple(int(m) for m in os.getenv("REMINDER_OFFSETS", "1440,120").split(","))
+
+# Студия, которая создаётся в пустом реестре: прежние настройки бота
+# и его прежняя база. Остальные студии добавляются через tenants.py.
+# workouts — типы тренировок и вместимость (None — без ограничения),
+# templates — регулярное расписание: (день недели, 0 — понедельник; минуты от полуночи; тип; вместимость)
+DEFAULT_STUDIO = {
+    'slug': 'main',
+    'name': "Фитнес-студия",
+    'timezone': 'Asia/Yekaterinburg',
+    'admins': [2021080653],
+    'workouts': [('Джампинг', 15), ('Жиротопка', None)],
+    'db_path': 'fitness_bot.db',
+    'templates': [
+        (0, 10 * 60, 'Джампинг', None), (0, 19 * 60 + 30, 'Джампинг', None),
+        (2, 10 * 60, 'Джампинг', None), (2, 19 * 60 + 30, 'Жиротопка', None),
+        (4, 10 * 60, 'Джампинг', None), (4, 19 * 60 + 30, 'Джампинг', None),
+        (5, 13 * 60, 'Жиротопка', None),
+    ],
+}
+# На сколько недель вперёд создавать тренировки по шаблонам
+SCHEDULE_WEEKS = int(os.getenv("SCHEDULE_WEEKS", 2))
+# Сколько дней хранить отписки и прошедшие тренировки до переноса в архив
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 180))
+# Лист ожидания на заполненные тренировки: "0" — выключить
+WAITLIST = os.getenv("WAITLIST", "1") == "1"
+# Ключ для выгрузки и импорта через HTTP (заголовок X-Api-Token); без него они выключены
+API_TOKEN = os.getenv("API_TOKEN")
+# Снимки баз: каталог, раз в сколько часов (0 — выключить) и сколько последних хранить.
+# Восстановление — python backup.py restore <снимок> при остановленном боте
+BACKUP_DIR = os.getenv("BACKUP_DIR", 'backups')
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", 6))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 14))
+# Нажатий кнопок в секунду на пользователя (0 — без ограничения) и сколько подряд
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", 2.0))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", 8))
+# Журнал входящих апдейтов для replay.py: каталог (пусто — не писать), соль
+# псевдонимов (та же нужна replay.py --salt) и размер файла в МБ
+RECORD_DIR = os.getenv("RECORD_DIR", "")
+RECORD_SALT = os.getenv("RECORD_SALT")
+RECORD_FILE_MB = int(os.getenv("RECORD_FILE_MB", 64))
+
+# Базы: реестр студий (студии, привязка пользователей к студиям, состояния FSM)
+# и по базе-шарду на каждую студию. Открытых шардов не больше SHARDS_OPEN:
+# давно не использованные закрываются и открываются снова при обращении.
+REGISTRY_DB = os.getenv("REGISTRY_DB", 'studios.db')
+DB_READERS = int(os.getenv("DB_READERS", 2))
+registry_db = Database(REGISTRY_DB, readers=DB_READERS)
+shard_pool = ShardPool(max_open=int(os.getenv("SHARDS_OPEN", 32)), readers=DB_READERS)
+
+# Состояния FSM хранятся в базе реестра и переживают рестарт.
+# FSM_CACHE_TTL — сколько секунд доверять кэшу; при нескольких процессах держать маленьким.
+fsm_storage = SQLiteStorage(
+    registry_db,
+    ttl=int(os.getenv("FSM_TTL", 24 * 3600)),
+    cache_ttl=float(os.getenv("FSM_CACHE_TTL", 1.0)),
+)
 
 # Инициализация бота
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
-
-# Пути к БД
-DB_NAME = 'fitness_bot.db'
+# Исходящие запросы идут через очереди с приоритетом и общий лимит скорости
+# (OUTBOUND_RATE запросов в секунду, 0 — без ограничения): ответы пользователям
+# не ждут за рассылками
+outbound_scheduler = outbound.OutboundScheduler(rate=float(os.getenv("OUTBOUND_RATE", outbound.GLOBAL_RATE)))
+bot = Bot(token=TOKEN, session=outbound.OutboundSession(limit=int(os.getenv("OUTBOUND_POOL", outbound.POOL_SIZE))))
+outbound.setup(bot, outbound_scheduler)
+dp = Dispatcher(storage=fsm_storage)
+# Все нажатия кнопок — через один хэндлер с поиском по имени (callbacks.py)
+callbacks = CallbackRouter()
+callbacks.setup(dp.callback_query)
+# Двойные нажатия и частые нажатия отсекаются до хэндлера (throttle.py)
+throttle = ThrottleMiddleware(rate=THROTTLE_RATE, burst=THROTTLE_BURST)
+dp.callback_query.outer_middleware(throttle)
+# Подписчики доменных событий, общие для всех студий (раздел «События»)
+event_routes = EventRoutes()
+
+# Студия: настройки из реестра и свои компоненты поверх своей базы-шарда.
+# Фоновые задачи (напоминания, доставка событий, генератор, обслуживание,
+# рассылки) у каждой студии свои и работают параллельно; соединение с шардом
+# они берут из пула только на время работы.
+class Studio:
+    def __init__(self, config):
+        self.config = config
+        self.id = config.id
+        self.name = config.name
+        self.tz = ZoneInfo(config.timezone)
+        self.workout_types = list(config.workouts)
+        self.database = ShardDatabase(shard_pool, config.db_path, prepare=self._migrate)
+        self.cache = ScheduleCache()
+        self.broadcaster = Broadcaster(bot, self.database)
+        self.reminders = ReminderScheduler(self.database, self.broadcaster, REMINDER_OFFSETS, self.tz)
+        self.seat_book = SeatBook(config.workouts, waitlist=WAITLIST)
+        self.generator = ScheduleGenerator(
+            self.database, self.cache, self.tz, weeks=SCHEDULE_WEEKS, workout_types=config.workouts
+        )
+        self.analytics = Analytics(self.database, self.tz, self.seat_book.capacity_for)
+        self.importer = ScheduleImporter(self.database, self.tz, config.workouts)
+        self.maintenance = Maintenance(self.database, self.cache, retention_days=RETENTION_DAYS)
+        # Хэндлеры только меняют данные и публикуют события; кэш, напоминания,
+        # статистика, лог отписок и уведомления — подписчики
+        self.events = EventBus(self.database, event_routes, self)
+        self.started = False
+        self._start_lock = asyncio.Lock()
+
+    async def _migrate(self, database):
+        await migrate(database, self.tz)
+
+    def is_admin(self, user_id):
+        return user_id in self.config.admins
+
+    def now(self):
+        return datetime.now(self.tz)
+
+    def format_ts(self, ts):
+        return format_ts(ts, self.tz)
+
+    # Схема шарда, напоминания и кэш расписания, затем фоновые задачи.
+    # Повторный вызов ничего не делает
+    async def start(self):
+        async with self._start_lock:
+            if self.started:
+                return
+            await self.database.open()
+            async with self.database.write() as db:
+                await self.reminders.backfill(db)
+            await self.cache.load(self.database)
+            self.generator.start()
+            self.reminders.start()
+            self.maintenance.start()
+            # Доставляет и то, что осталось в outbox с прошлого запуска
+            self.events.start()
+            await self.broadcaster.resume()
+            self.started = True
+
+    async def stop(self):
+        await self.generator.stop()
+        await self.maintenance.stop()
+        await self.reminders.stop()
+        await self.events.stop()
+        await self.broadcaster.stop()
+        self.started = False
+
+    @property
+    def running(self):
+        return all(job.running for job in (self.generator, self.reminders, self.maintenance, self.events))
+
+registry = StudioRegistry(registry_db, Studio)
+
+# Снимки реестра и баз всех студий, в том числе ещё не запущенных
+backups = BackupManager(
+    BACKUP_DIR,
+    lambda: [REGISTRY_DB] + [config.db_path for config in registry.configs.values()],
+    interval=BACKUP_INTERVAL_HOURS * 3600,
+    keep=BACKUP_KEEP,
+)
+
+# Журнал апдейтов: id администраторов остаются настоящими, остальные — псевдонимы
+recorder = UpdateRecorder(
+    RECORD_DIR, salt=RECORD_SALT,
+    keep=lambda user_id: any(user_id in config.admins for config in registry.configs.values()),
+    max_bytes=RECORD_FILE_MB * 1024 * 1024,
+) if RECORD_DIR else None
+
+# Очередь апдейтов вебхука
+update_queue = UpdateQueue(
+    dp, bot,
+    workers=int(os.getenv("WEBHOOK_WORKERS", 4)),
+    maxsize=int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000)),
+    policy=os.getenv("WEBHOOK_QUEUE_POLICY", "reject"),
+)
+
+# Последние показанные экраны: повторный показ того же экрана не идёт в API
+screens = ScreenCache()
+
+# Метрики: время хэндлеров, SQL и Bot API (см. /metrics)
+metrics.setup(dp, bot, routes=callbacks.routes)
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_outbound_queue_depth', 'Исходящих запросов в очереди по полосам',
+    outbound_scheduler.depth, labels=('lane',)))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_update_queue_depth', 'Апдейтов в очереди вебхука', lambda: update_queue.depth))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_update_queue_total', 'Счётчики очереди вебхука',
+    lambda: {k: v for k, v in update_queue.stats().items() if k in (
+        'accepted', 'duplicates', 'rejected', 'dropped', 'processed', 'failed')},
+    labels=('result',), type='counter'))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_schedule_cache_total', 'Обращения к кэшу расписания',
+    lambda: {
+        'hit': sum(studio.cache.hits for studio in registry.instances()),
+        'miss': sum(studio.cache.misses for studio in registry.instances()),
+    }, labels=('result',), type='counter'))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_backup_last_success_timestamp_seconds', 'Время последнего снимка баз',
+    lambda: backups.last['created_at'] if backups.last else {}))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_recorded_updates_total', 'Апдейты в журнале для replay.py',
+    lambda: recorder.stats() if recorder else {}, labels=('result',), type='counter'))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_shards_open', 'Открытых баз студий', lambda: len(shard_pool)))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_shard_opens_total', 'Открытия и вытеснения баз студий',
+    lambda: {'opened': shard_pool.opened, 'evicted': shard_pool.evicted}, labels=('result',), type='counter'))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_callback_throttle_total', 'Нажатия кнопок: выполнены, слиты с повторным, отсечены по частоте',
+    throttle.stats, labels=('result',), type='counter'))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_callback_rejected_total', 'Нажатия кнопок, отклонённые проверкой студии или прав администратора',
+    callbacks.stats, labels=('reason',), type='counter'))
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_screen_edits_total', 'Показы экранов',
+    lambda: {'edited': screens.edits, 'skipped': screens.skipped}, labels=('result',), type='counter'))
+
+# Время в БД хранится в секундах epoch, на экран выводится в часовом поясе студии
+def to_timestamp(dt):
+    return int(dt.timestamp())
+
+# Строки для показа кэшируются: одни и те же тренировки выводятся в каждом списке
+@lru_cache(maxsize=4096)
+def format_ts(ts, tz):
+    return datetime.fromtimestamp(ts, tz).strftime('%d.%m.%Y %H:%M')
+
+def parse_input_datetime(text, tz):
+    return to_timestamp(datetime.strptime(text, '%d.%m.%Y %H:%M').replace(tzinfo=tz))
+
+@lru_cache(maxsize=4096)
+def session_label(session, tz):
+    return f"{session.workout_type} | {format_ts(session.starts_at, tz)}"
 
 # FSM для админ-действий
 class AdminStates(StatesGroup):
     waiting_for_workout_time = State()
     editing_workout_time = State()
     waiting_for_notification_message = State()
+    waiting_for_import = State()
 
-# Создание таблиц
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS schedules (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                workout_type TEXT,
-                date_time TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS registrations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                schedule_id INTEGER,
-                FOREIGN KEY(schedule_id) REFERENCES schedules(id),
-                UNIQUE(user_id, schedule_id)
-            )
-        ''')
+# Ввод в диалогах администратора принимается только от администратора студии:
+# права могли отобрать, пока диалог был открыт
+def studio_admin(message: Message, studio) -> bool:
+    return studio.is_admin(message.from_user.id)
+
+# --- События ---
+
+# Кэш расписания обновляется сразу после коммита, до ответа пользователю
+@event_routes.listen(RegistrationCreated)
+def cache_registration_created(studio, event):
+    studio.cache.add_registration(event.registration_id, event.user_id, event.schedule_id)
+
+@event_routes.listen(RegistrationCancelled)
+def cache_registration_cancelled(studio, event):
+    studio.cache.remove_registration(event.registration_id, event.user_id, event.schedule_id)
+
+@event_routes.listen(SessionChanged)
+def cache_session_changed(studio, event):
+    if event.schedule_id in studio.cache.sessions:
+        studio.cache.update_session(event.schedule_id, event.workout_type, event.starts_at, event.capacity)
+    else:
+        studio.cache.add_session(event.schedule_id, event.workout_type, event.starts_at, event.capacity)
+
+@event_routes.listen(SessionDeleted)
+def cache_session_deleted(studio, event):
+    studio.cache.remove_session(event.schedule_id)
+
+@event_routes.subscribe('reminders', RegistrationCreated, RegistrationCancelled, SessionChanged,
+                        in_transaction=True, after_commit=lambda studio: studio.reminders.wake())
+async def plan_reminders(studio, db, event):
+    if isinstance(event, SessionChanged):
+        if event.rescheduled:
+            await studio.reminders.reschedule_session(db, event.schedule_id)
+    else:
+        await studio.reminders.sync(db, event.schedule_id, event.user_id)
+
+@event_routes.subscribe('analytics', RegistrationCreated, RegistrationCancelled, WaitlistJoined,
+                        SessionChanged, SessionDeleted, in_transaction=True)
+async def count_session_stats(studio, db, event):
+    analytics = studio.analytics
+    if isinstance(event, RegistrationCreated):
+        await analytics.booked(db, event.schedule_id)
+    elif isinstance(event, RegistrationCancelled) and event.by_admin:
+        await analytics.removed(db, event.schedule_id)
+    elif isinstance(event, RegistrationCancelled):
+        await analytics.cancelled(db, event.schedule_id, event.at)
+    elif isinstance(event, SessionDeleted):
+        await analytics.forget(db, event.schedule_id)
+    else:
+        await analytics.touch(db, event.schedule_id)
+
+# Лог отписавшихся: только отмены самим пользователем
+@event_routes.subscribe('cancellations', RegistrationCancelled, in_transaction=True)
+async def log_cancellation(studio, db, event):
+    if not event.by_admin:
+        # Тренировку могли удалить до доставки события
         await db.execute('''
-            CREATE TABLE IF NOT EXISTS cancellations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                schedule_id INTEGER,
-                timestamp TEXT
-            )
-        ''')
-        await db.commit()
+            INSERT INTO cancellations (user_id, schedule_id, created_at)
+            SELECT ?, id, ? FROM schedules WHERE id = ?
+        ''', (event.user_id, event.at, event.schedule_id))
+
+@event_routes.subscribe('notifications', RegistrationCreated, RegistrationCancelled)
+async def notify_user(studio, event):
+    if isinstance(event, RegistrationCreated) and event.promoted:
+        template = "Освободилось место! Вы записаны на тренировку '{}' ({})."
+    elif isinstance(event, RegistrationCancelled) and event.by_admin:
+        template = "Ваша запись на тренировку '{}' ({}) была отменена администратором."
+    else:
+        return
+    session = studio.cache.sessions.get(event.schedule_id)
+    if session is None:
+        return
+    # Пользователь заблокировал бота или удалён — повтор не поможет;
+    # остальные ошибки уходят в повтор доставки
+    try:
+        with outbound.lane(outbound.NOTICE):
+            await bot.send_message(event.user_id, template.format(session.workout_type, studio.format_ts(session.starts_at)))
+    except (TelegramForbiddenError, TelegramBadRequest):
+        pass
+
+# Статичные клавиатуры строятся один раз; возвращаемую разметку не изменять
 
-# Начальное меню
+# Начальное меню; кнопка смены студии — когда студий несколько
 def main_menu_keyboard():
+    return _main_menu_keyboard(len(registry) > 1)
+
+@lru_cache(maxsize=None)
+def _main_menu_keyboard(switch):
     kb = InlineKeyboardBuilder()
-    kb.button(text="Записаться на тренировку", callback_data='register_start')
-    kb.button(text="Мои записи", callback_data='my_registrations')
-    kb.button(text="Отменить запись", callback_data='cancel_registration')
-    kb.button(text="Расписание на неделю", callback_data='show_schedule')
+    kb.button(text="Записаться на тренировку", callback_data=callbacks.pack('book'))
+    kb.button(text="Мои записи", callback_data=callbacks.pack('my'))
+    kb.button(text="Отменить запись", callback_data=callbacks.pack('cancel'))
+    kb.button(text="Расписание на неделю", callback_data=callbacks.pack('week'))
+    if switch:
+        kb.button(text="Сменить студию", callback_data=callbacks.pack('studios'))
     kb.adjust(1)
     return kb.as_markup()
 
 # Меню администратора
 def admin_menu_keyboard():
+    return _admin_menu_keyboard(len(registry) > 1)
+
+@lru_cache(maxsize=None)
+def _admin_menu_keyboard(switch):
     kb = InlineKeyboardBuilder()
-    kb.button(text="Кто записался?", callback_data='admin_view_registrations')
-    kb.button(text="Кто отписался?", callback_data='admin_view_cancellations')
-    kb.button(text="Редактировать расписание", callback_data='admin_edit_schedule')
-    kb.button(text="Расписание", callback_data='admin_show_schedule')
-    kb.button(text="Отменить чью-то запись", callback_data='admin_cancel_user')
-    kb.button(text="Сообщить всем", callback_data='admin_notify_custom')
-    kb.button(text="В начало", callback_data='start')
+    kb.button(text="Кто записался?", callback_data=callbacks.pack('a_regs'))
+    kb.button(text="Кто отписался?", callback_data=callbacks.pack('a_cancels'))
+    kb.button(text="Редактировать расписание", callback_data=callbacks.pack('a_edit'))
+    kb.button(text="Расписание", callback_data=callbacks.pack('a_week'))
+    kb.button(text="Отменить чью-то запись", callback_data=callbacks.pack('a_unbook'))
+    kb.button(text="Сообщить всем", callback_data=callbacks.pack('a_notify'))
+    kb.button(text="Статистика", callback_data=callbacks.pack('a_stats', 30))
+    if switch:
+        kb.button(text="Сменить студию", callback_data=callbacks.pack('studios'))
+    kb.button(text="В начало", callback_data=callbacks.pack('home'))
     kb.adjust(1)
     return kb.as_markup()
 
 # Кнопка "Назад" и "В начало"
+@lru_cache(maxsize=None)
 def back_button():
     kb = InlineKeyboardBuilder()
-    kb.button(text="В начало", callback_data='start')
-    kb.button(text="Назад", callback_data='back')
+    kb.button(text="В начало", callback_data=callbacks.pack('home'))
+    kb.button(text="Назад", callback_data=callbacks.pack('back'))
     kb.adjust(2)
     return kb.as_markup()
 
-# Отправка напоминания
-async def send_reminder():
-    now = datetime.now(TIMEZONE)
-    reminder_time = now + timedelta(hours=4)
-    reminder_str = reminder_time.strftime('%Y-%m-%d %H:%M')
+# Выбор типа тренировки для записи: в callback_data — номер типа в каталоге студии
+@lru_cache(maxsize=None)
+def workout_types_keyboard(studio):
+    kb = InlineKeyboardBuilder()
+    for i, workout_type in enumerate(studio.workout_types):
+        kb.button(text=workout_type, callback_data=callbacks.pack('book_type', i, studio=studio.id))
+    kb.button(text="В начало", callback_data=callbacks.pack('home'))
+    return kb.as_markup()
 
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT s.date_time, s.workout_type, r.user_id
-            FROM registrations r
-            JOIN schedules s ON r.schedule_id = s.id
-            WHERE s.date_time LIKE ?
-        ''', (f"{reminder_str[:16]}%",))
-        rows = await cursor.fetchall()
+# Тип тренировки по номеру из callback_data; None — такого номера нет
+def workout_type_at(studio, index):
+    if 0 <= index < len(studio.workout_types):
+        return studio.workout_types[index]
+    return None
 
-        for _, _, user_id in rows:
-            try:
-                await bot.send_message(
-                    user_id,
-                    "Напоминаем о предстоящей тренировке! Если не сможете прийти, отпишитесь."
-                )
-            except Exception:
-                pass
+# --- Студии ---
+
+def studios_keyboard():
+    kb = InlineKeyboardBuilder()
+    for studio in registry.studios():
+        kb.button(text=studio.name, callback_data=callbacks.pack('studio', studio.id))
+    kb.adjust(1)
+    return kb.as_markup()
+
+# Студия апдейта передаётся хэндлерам аргументом studio.
+# Выбирают её ссылка t.me/<бот>?start=<slug> и кнопка из списка студий;
+# пока студия не выбрана, вместо хэндлера показывается этот список.
+@dp.update.outer_middleware()
+async def studio_router(handler, event, data):
+    user = data.get('event_from_user')
+    if user is None:
+        return await handler(event, data)
+
+    chosen = None
+    if event.message is not None and (event.message.text or '').startswith('/start '):
+        chosen = registry.by_slug(event.message.text.split(None, 1)[1].strip())
+    elif event.callback_query is not None:
+        resolved = callbacks.unpack(event.callback_query.data)
+        if resolved is not None and resolved[0].name == 'studio':
+            chosen = registry.get(resolved[1][0])
+
+    studio = await registry.studio_for(user.id)
+    if chosen is not None and chosen is not studio:
+        await registry.bind(user.id, chosen.id)
+        # Незаконченный диалог относится к прежней студии
+        await data['state'].clear()
+        studio = chosen
+
+    if studio is None:
+        if event.message is not None:
+            await event.message.answer("Выберите студию:", reply_markup=studios_keyboard())
+        elif event.callback_query is not None:
+            await screens.edit(event.callback_query, "Выберите студию:", reply_markup=studios_keyboard())
+        return None
+    await studio.start()
+    data['studio'] = studio
+    return await handler(event, data)
+
+@callbacks.route('studios')
+async def choose_studio(call: CallbackQuery):
+    await screens.edit(call, "Выберите студию:", reply_markup=studios_keyboard())
+
+@callbacks.route('studio', int)
+async def studio_chosen(call: CallbackQuery, studio_id: int, studio: Studio):
+    await go_home(call, studio)
 
 @dp.message(Command("start"))
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, studio: Studio):
     user_id = message.from_user.id
     username = message.from_user.username or str(user_id)
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with studio.database.write() as db:
         await db.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
-        await db.commit()
+        # Пользователь снова пишет боту — значит, больше не заблокировал его
+        await db.execute("DELETE FROM blocked_users WHERE user_id = ?", (user_id,))
 
-    if user_id == ADMIN_ID:
-        await message.answer("Привет, администратор!", reply_markup=admin_menu_keyboard())
+    if studio.is_admin(user_id):
+        await message.answer(studio_title(studio) + "Привет, администратор!", reply_markup=admin_menu_keyboard())
     else:
-        await message.answer("Привет! Выберите действие:", reply_markup=main_menu_keyboard())
-
-@dp.callback_query(F.data == 'register_start')
-async def register_start(call: CallbackQuery):
-    workouts_kb = InlineKeyboardBuilder()
-    workouts_kb.button(text="Джампинг", callback_data='select_workout_jumping')
-    workouts_kb.button(text="Жиротопка", callback_data='select_workout_lipolitics')
-    workouts_kb.button(text="В начало", callback_data='start')
-    await call.message.edit_text("Выберите тип тренировки:", reply_markup=workouts_kb.as_markup())
-
-async def show_schedule_for_workout(call: CallbackQuery, workout_type: str):
-    now = datetime.now(TIMEZONE)
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT id, date_time FROM schedules
-            WHERE workout_type = ? AND date_time > ?
-            ORDER BY date_time
-        ''', (workout_type, now.strftime('%Y-%m-%d %H:%M')))
-        rows = await cursor.fetchall()
+        await message.answer(studio_title(studio) + "Привет! Выберите действие:", reply_markup=main_menu_keyboard())
 
-    available_sessions = []
-    for sch_id, dt in rows:
-        async with aiosqlite.connect(DB_NAME) as db:
-            cursor2 = await db.execute('''
-                SELECT COUNT(*) FROM registrations WHERE schedule_id = ?
-            ''', (sch_id,))
-            count = (await cursor2.fetchone())[0]
+# Название студии в приветствии — когда студий несколько
+def studio_title(studio):
+    return f"{studio.name}\n" if len(registry) > 1 else ""
 
-        if workout_type == 'Джампинг' and count >= 15:
-            continue  # Пропускаем полные
+@callbacks.route('book')
+async def register_start(call: CallbackQuery, studio: Studio):
+    await screens.edit(call, "Выберите тип тренировки:", reply_markup=workout_types_keyboard(studio))
 
-        available_sessions.append((sch_id, dt))
+async def show_schedule_for_workout(call: CallbackQuery, studio, workout_type: str):
+    now = studio.now()
+    cache = studio.cache
+    sessions = await cache.sessions_between(studio.database, to_timestamp(now), workout_type=workout_type)
 
     kb = InlineKeyboardBuilder()
-    for sch_id, dt in available_sessions:
-        dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-        kb.button(text=f"{dt_formatted}", callback_data=f'register_to_{sch_id}')
+    for session in sessions:
+        capacity = studio.seat_book.capacity_for(session)
+        dt_formatted = studio.format_ts(session.starts_at)
+        if capacity is not None and cache.seat_count(session.id) >= capacity:
+            # Полные показываем только с листом ожидания
+            if WAITLIST:
+                kb.button(text=f"{dt_formatted} (лист ожидания)", callback_data=callbacks.pack('waitlist', session.id, studio=studio.id))
+            continue
+        kb.button(text=f"{dt_formatted}", callback_data=callbacks.pack('book_to', session.id, studio=studio.id))
     kb.adjust(1)
-    kb.button(text="Назад", callback_data='register_start')
-    await call.message.edit_text(f"Доступные даты для {workout_type}:", reply_markup=kb.as_markup())
-
-@dp.callback_query(F.data.startswith('select_workout_'))
-async def select_workout(call: CallbackQuery):
-    if call.data == 'select_workout_jumping':
-        await show_schedule_for_workout(call, 'Джампинг')
-    elif call.data == 'select_workout_lipolitics':
-        await show_schedule_for_workout(call, 'Жиротопка')
-
-@dp.callback_query(F.data.startswith('register_to_'))
-async def register_to_workout(call: CallbackQuery):
-    sch_id = int(call.data.split('_')[-1])
-    user_id = call.from_user.id
+    kb.button(text="Назад", callback_data=callbacks.pack('book'))
+    await screens.edit(call, f"Доступные даты для {workout_type}:", reply_markup=kb.as_markup())
+
+@callbacks.route('book_type', int, scoped=True)
+async def select_workout(call: CallbackQuery, index: int, studio: Studio):
+    workout_type = workout_type_at(studio, index)
+    if workout_type is None:
+        await call.answer()
+        return
+    await show_schedule_for_workout(call, studio, workout_type)
 
-    async with aiosqlite.connect(DB_NAME) as db:
-        try:
-            await db.execute("INSERT INTO registrations (user_id, schedule_id) VALUES (?, ?)", (user_id, sch_id))
-            await db.commit()
-            await call.message.edit_text("Вы успешно записались!", reply_markup=back_button())
-        except aiosqlite.IntegrityError:
-            await call.message.edit_text("Вы уже записаны на эту тренировку.", reply_markup=back_button())
-
-@dp.callback_query(F.data == 'my_registrations')
-async def my_registrations(call: CallbackQuery):
+@callbacks.route('book_to', int, scoped=True)
+async def register_to_workout(call: CallbackQuery, sch_id: int, studio: Studio):
+    await reserve_seat(call, studio, sch_id, waitlist=False)
+
+@callbacks.route('waitlist', int, scoped=True)
+async def join_waitlist(call: CallbackQuery, sch_id: int, studio: Studio):
+    await reserve_seat(call, studio, sch_id, waitlist=True)
+
+# Проверка мест и запись — одна транзакция, переполнить тренировку нельзя
+async def reserve_seat(call: CallbackQuery, studio, sch_id, waitlist):
     user_id = call.from_user.id
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT s.workout_type, s.date_time
-            FROM registrations r
-            JOIN schedules s ON r.schedule_id = s.id
-            WHERE r.user_id = ?
-            ORDER BY s.date_time
-        ''', (user_id,))
-        rows = await cursor.fetchall()
+    events = studio.events
+
+    async with events.write() as db:
+        outcome, reg_id = await studio.seat_book.reserve(db, sch_id, user_id, waitlist=waitlist)
+        if outcome == RESERVED:
+            await events.publish(db, RegistrationCreated(reg_id, user_id, sch_id, False))
+        elif outcome == WAITLISTED:
+            await events.publish(db, WaitlistJoined(sch_id, user_id))
+
+    if outcome == RESERVED:
+        await screens.edit(call, "Вы успешно записались!", reply_markup=back_button())
+    elif outcome == ALREADY:
+        await screens.edit(call, "Вы уже записаны на эту тренировку.", reply_markup=back_button())
+    elif outcome == WAITLISTED:
+        await screens.edit(
+            call,
+            "Мест нет — вы в листе ожидания. Если место освободится, мы запишем вас и сообщим.",
+            reply_markup=back_button()
+        )
+    elif outcome == FULL and WAITLIST:
+        kb = InlineKeyboardBuilder()
+        kb.button(text="Встать в лист ожидания", callback_data=callbacks.pack('waitlist', sch_id, studio=studio.id))
+        kb.button(text="Назад", callback_data=callbacks.pack('book'))
+        kb.adjust(1)
+        await screens.edit(call, "К сожалению, мест уже нет.", reply_markup=kb.as_markup())
+    elif outcome == FULL:
+        await screens.edit(call, "К сожалению, мест уже нет.", reply_markup=back_button())
+    elif outcome == STARTED:
+        await screens.edit(call, "Тренировка уже началась, записаться на неё нельзя.", reply_markup=back_button())
+    else:
+        await screens.edit(call, "Эта тренировка больше недоступна.", reply_markup=back_button())
+
+# Освобождает место внутри studio.events.write(); места сразу получают ожидающие.
+# Возвращает (user_id, schedule_id) отменённой записи или None
+async def release_seat(studio, db, reg_id, by_admin=False):
+    row, promoted = await studio.seat_book.release(db, reg_id)
+    if row:
+        user_id, sch_id = row
+        now = to_timestamp(studio.now())
+        await studio.events.publish(db, RegistrationCancelled(reg_id, user_id, sch_id, now, by_admin))
+        await publish_promoted(studio, db, sch_id, promoted)
+    return row
+
+async def publish_promoted(studio, db, sch_id, promoted):
+    for reg_id, user_id in promoted:
+        await studio.events.publish(db, RegistrationCreated(reg_id, user_id, sch_id, True))
+
+# Тренировка создана или изменена: в событие идёт её строка после изменения
+async def publish_session(studio, db, sch_id, rescheduled=False):
+    cursor = await db.execute("SELECT workout_type, starts_at, capacity FROM schedules WHERE id = ?", (sch_id,))
+    row = await cursor.fetchone()
+    if row:
+        await studio.events.publish(db, SessionChanged(sch_id, *row, rescheduled))
+
+@callbacks.route('my')
+async def my_registrations(call: CallbackQuery, studio: Studio):
+    user_id = call.from_user.id
+    rows = await studio.cache.user_registrations(studio.database, user_id)
 
     if not rows:
-        await call.message.edit_text("У вас нет записей.", reply_markup=back_button())
+        await screens.edit(call, "У вас нет записей.", reply_markup=back_button())
         return
 
     msg = "Ваши записи:\n"
-    for t, dt in rows:
-        dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-        msg += f"- {t} | {dt_formatted}\n"
-
-    kb = InlineKeyboardBuilder()
-    kb.button(text="В начало", callback_data='start')
-    kb.button(text="Назад", callback_data='back')
-    kb.adjust(2)
+    for _, session in rows:
+        msg += f"- {session_label(session, studio.tz)}\n"
 
-    await call.message.edit_text(msg, reply_markup=kb.as_markup())
+    await screens.edit(call, msg, reply_markup=back_button())
 
-@dp.callback_query(F.data == 'cancel_registration')
-async def cancel_registration_start(call: CallbackQuery):
+@callbacks.route('cancel')
+async def cancel_registration_start(call: CallbackQuery, studio: Studio):
     user_id = call.from_user.id
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT r.id, s.workout_type, s.date_time
-            FROM registrations r
-            JOIN schedules s ON r.schedule_id = s.id
-            WHERE r.user_id = ?
-            ORDER BY s.date_time
-        ''', (user_id,))
-        rows = await cursor.fetchall()
+    rows = await studio.cache.user_registrations(studio.database, user_id)
 
     if not rows:
-        await call.message.edit_text("У вас нет записей.", reply_markup=back_button())
+        await screens.edit(call, "У вас нет записей.", reply_markup=back_button())
         return
 
     kb = InlineKeyboardBuilder()
-    for reg_id, t, dt in rows:
-        dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-        kb.button(text=f"{t} | {dt_formatted}", callback_data=f'cancel_reg_{reg_id}')
+    for reg_id, session in rows:
+        kb.button(text=session_label(session, studio.tz), callback_data=callbacks.pack('cancel_to', reg_id, studio=studio.id))
     kb.adjust(1)
-    kb.button(text="Назад", callback_data='start')
-    await call.message.edit_text("Выберите запись для отмены:", reply_markup=kb.as_markup())
-
-@dp.callback_query(F.data.startswith('cancel_reg_'))
-async def cancel_registration_final(call: CallbackQuery):
-    reg_id = int(call.data.split('_')[-1])
-    user_id = call.from_user.id
-
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Получаем данные о тренировке перед удалением
-        cursor = await db.execute('''
-            SELECT schedule_id FROM registrations WHERE id = ?
-        ''', (reg_id,))
-        row = await cursor.fetchone()
-        if row:
-            schedule_id = row[0]
-            # Записываем в лог отписавшихся
-            timestamp = datetime.now(TIMEZONE).isoformat()
-            await db.execute('''
-                INSERT INTO cancellations (user_id, schedule_id, timestamp)
-                VALUES (?, ?, ?)
-            ''', (user_id, schedule_id, timestamp))
-        
-        await db.execute("DELETE FROM registrations WHERE id = ?", (reg_id,))
-        await db.commit()
-    
-    await call.message.edit_text("Запись отменена.", reply_markup=back_button())
-
-@dp.callback_query(F.data == 'show_schedule')
-async def show_week_schedule(call: CallbackQuery):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT workout_type, date_time FROM schedules
-            WHERE date_time BETWEEN ? AND ?
-            ORDER BY date_time
-        ''', (
-            datetime.now(TIMEZONE).strftime('%Y-%m-%d %H:%M'),
-            (datetime.now(TIMEZONE) + timedelta(days=7)).strftime('%Y-%m-%d %H:%M')
-        ))
-        rows = await cursor.fetchall()
+    kb.button(text="Назад", callback_data=callbacks.pack('home'))
+    await screens.edit(call, "Выберите запись для отмены:", reply_markup=kb.as_markup())
+
+@callbacks.route('cancel_to', int, scoped=True)
+async def cancel_registration_final(call: CallbackQuery, reg_id: int, studio: Studio):
+    async with studio.events.write() as db:
+        await release_seat(studio, db, reg_id)
+    await screens.edit(call, "Запись отменена.", reply_markup=back_button())
+
+@callbacks.route('week')
+async def show_week_schedule(call: CallbackQuery, studio: Studio):
+    now = studio.now()
+    rows = await studio.cache.sessions_between(
+        studio.database,
+        to_timestamp(now),
+        to_timestamp(now + timedelta(days=7)),
+    )
 
     msg = "Расписание на неделю:\n"
-    for t, dt in rows:
-        dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-        msg += f"- {t} | {dt_formatted}\n"
+    for session in rows:
+        msg += f"- {session_label(session, studio.tz)}\n"
 
-    kb = InlineKeyboardBuilder()
-    kb.button(text="В начало", callback_data='start')
-    kb.button(text="Назад", callback_data='back')
-    kb.adjust(2)
-
-    await call.message.edit_text(msg, reply_markup=kb.as_markup())
+    await screens.edit(call, msg, reply_markup=back_button())
 
 # --- АДМИН-ФУНКЦИИ ---
 
-@dp.callback_query(F.data == 'admin_show_schedule')
-async def admin_show_schedule(call: CallbackQuery):
-    await show_week_schedule(call)
-
-@dp.callback_query(F.data == 'admin_view_registrations')
-async def admin_view_registrations(call: CallbackQuery):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT u.username, s.workout_type, s.date_time
+@callbacks.route('a_week', admin=True)
+async def admin_show_schedule(call: CallbackQuery, studio: Studio):
+    await show_week_schedule(call, studio)
+
+# --- Постраничные списки для админа ---
+
+# Сколько строк показываем на одной странице: с запасом укладываемся
+# в 4096 символов сообщения и в лимит кнопок клавиатуры
+PAGE_SIZE = 20
+
+# Фильтр по типу: 'a' — все, иначе номер типа в каталоге студии
+@lru_cache(maxsize=None)
+def type_filters(studio):
+    filters = {'a': ("Все типы", None)}
+    for i, workout_type in enumerate(studio.workout_types):
+        filters[str(i)] = (workout_type, workout_type)
+    return filters
+
+PERIOD_FILTERS = {'a': "Всё время", 'u': "Будущие", 'w': "Неделя", 'p': "Прошедшие"}
+
+# Описание списков. Запрос возвращает сначала два поля ключа сортировки
+# (по ним строится курсор), затем поля для вывода. Таблица schedules всегда под псевдонимом s.
+# line получает строку и функцию форматирования времени студии, button — строку и студию.
+ADMIN_LISTS = {
+    'reg': {
+        'select': '''
+            SELECT s.starts_at, r.id, u.username, s.workout_type
             FROM registrations r
             JOIN users u ON r.user_id = u.user_id
             JOIN schedules s ON r.schedule_id = s.id
-            ORDER BY s.date_time
-        ''')
-        rows = await cursor.fetchall()
-
-    msg = "Записавшиеся пользователи:\n"
-    if rows:
-        for u, t, dt in rows:
-            dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-            msg += f"- {u} | {t} | {dt_formatted}\n"
-    else:
-        msg = "Никто не записался."
-
-    await call.message.edit_text(msg, reply_markup=admin_menu_keyboard())
-
-@dp.callback_query(F.data == 'admin_view_cancellations')
-async def admin_view_cancellations(call: CallbackQuery):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT u.username, s.workout_type, s.date_time, c.timestamp
+        ''',
+        'key': ('s.starts_at', 'r.id'),
+        'desc': False,
+        'title': "Записавшиеся пользователи:",
+        'empty': "Никто не записался.",
+        'line': lambda row, fmt: f"- {row[2]} | {row[3]} | {fmt(row[0])}",
+        'back': 'admin',
+    },
+    'can': {
+        'select': '''
+            SELECT c.created_at, c.id, u.username, s.workout_type, s.starts_at
             FROM cancellations c
             JOIN users u ON c.user_id = u.user_id
             JOIN schedules s ON c.schedule_id = s.id
-            ORDER BY c.timestamp DESC
-        ''')
-        rows = await cursor.fetchall()
-
-    msg = "Отписавшиеся пользователи:\n"
-    if rows:
-        for u, t, dt, ts in rows:
-            dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-            ts_formatted = datetime.fromisoformat(ts).strftime('%d.%m.%Y %H:%M')
-            msg += f"- {u} | {t} | {dt_formatted} | {ts_formatted}\n"
+        ''',
+        'key': ('c.created_at', 'c.id'),
+        'desc': True,
+        'title': "Отписавшиеся пользователи:",
+        'empty': "Никто не отписался.",
+        'line': lambda row, fmt: f"- {row[2]} | {row[3]} | {fmt(row[4])} | {fmt(row[0])}",
+        'back': 'admin',
+    },
+    'del': {
+        'select': "SELECT s.starts_at, s.id, s.workout_type FROM schedules s",
+        'key': ('s.starts_at', 's.id'),
+        'desc': False,
+        'title': "Выберите тренировку для удаления:",
+        'empty': "Нет тренировок для удаления.",
+        'button': lambda row, studio: (f"{row[2]} | {studio.format_ts(row[0])}",
+                                       callbacks.pack('a_del_to', row[1], studio=studio.id)),
+        'back': 'a_edit',
+    },
+    'edt': {
+        'select': "SELECT s.starts_at, s.id, s.workout_type FROM schedules s",
+        'key': ('s.starts_at', 's.id'),
+        'desc': False,
+        'title': "Выберите тренировку для изменения:",
+        'empty': "Нет тренировок для изменения.",
+        'button': lambda row, studio: (f"{row[2]} | {studio.format_ts(row[0])}",
+                                       callbacks.pack('a_mod_to', row[1], studio=studio.id)),
+        'back': 'a_edit',
+    },
+    'acu': {
+        'select': '''
+            SELECT s.starts_at, r.id, u.username, s.workout_type
+            FROM registrations r
+            JOIN users u ON r.user_id = u.user_id
+            JOIN schedules s ON r.schedule_id = s.id
+        ''',
+        'key': ('s.starts_at', 'r.id'),
+        'desc': False,
+        'title': "Выберите запись для отмены:",
+        'empty': "Нет записей для отмены.",
+        'button': lambda row, studio: (f"{row[2]} | {row[3]} | {studio.format_ts(row[0])}",
+                                       callbacks.pack('a_unbook_to', row[1], studio=studio.id)),
+        'back': 'admin',
+    },
+}
+
+# Одна страница по курсору (keyset): читаем только PAGE_SIZE + 1 строк после
+# или до курсора, без OFFSET и без выборки всего списка
+async def fetch_admin_page(studio, spec, cursor, forward, type_code, period_code):
+    where, params = [], []
+    workout_type = type_filters(studio)[type_code][1]
+    if workout_type:
+        where.append("s.workout_type = ?")
+        params.append(workout_type)
+    now = to_timestamp(studio.now())
+    if period_code == 'u':
+        where.append("s.starts_at >= ?")
+        params.append(now)
+    elif period_code == 'w':
+        where.append("s.starts_at BETWEEN ? AND ?")
+        params.extend((now, now + 7 * 24 * 3600))
+    elif period_code == 'p':
+        where.append("s.starts_at < ?")
+        params.append(now)
+
+    k1, k2 = spec['key']
+    ascending = forward != spec['desc']
+    if cursor is not None:
+        where.append(f"({k1}, {k2}) {'>' if ascending else '<'} (?, ?)")
+        params.extend(cursor)
+    order = 'ASC' if ascending else 'DESC'
+    sql = spec['select']
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {k1} {order}, {k2} {order} LIMIT ?"
+    params.append(PAGE_SIZE + 1)
+
+    rows = await studio.database.fetchall(sql, params)
+    has_more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if not forward:
+        rows.reverse()
+    # Если пришли с соседней страницы, она точно есть
+    has_prev = cursor is not None if forward else has_more
+    has_next = has_more if forward else cursor is not None
+    return rows, has_prev, has_next
+
+async def show_admin_list(call: CallbackQuery, studio, view, cursor=None, forward=True, type_code='a', period_code='a'):
+    spec = ADMIN_LISTS[view]
+    rows, has_prev, has_next = await fetch_admin_page(studio, spec, cursor, forward, type_code, period_code)
+
+    if not rows and cursor is None and type_code == 'a' and period_code == 'a':
+        await screens.edit(call, spec['empty'], reply_markup=admin_menu_keyboard())
+        return
+
+    kb = InlineKeyboardBuilder()
+    widths = []
+    if 'button' in spec:
+        for row in rows:
+            text, data = spec['button'](row, studio)
+            kb.button(text=text, callback_data=data)
+            widths.append(1)
+        msg = spec['title'] if rows else spec['empty']
     else:
-        msg = "Никто не отписался."
+        lines = [spec['line'](row, studio.format_ts) for row in rows]
+        msg = spec['title'] + "\n" + "\n".join(lines) if rows else spec['empty']
+
+    nav = 0
+    if has_prev:
+        first = rows[0] if rows else (cursor or (0, 0))
+        kb.button(text="« Назад", callback_data=callbacks.pack(
+            'pg', view, 'p', first[0], first[1], type_code, period_code, studio=studio.id))
+        nav += 1
+    if has_next:
+        last = rows[-1] if rows else (cursor or (0, 0))
+        kb.button(text="Дальше »", callback_data=callbacks.pack(
+            'pg', view, 'n', last[0], last[1], type_code, period_code, studio=studio.id))
+        nav += 1
+    if nav:
+        widths.append(nav)
+
+    filters = type_filters(studio)
+    for code, (label, _) in filters.items():
+        mark = "• " if code == type_code else ""
+        kb.button(text=f"{mark}{label}", callback_data=callbacks.pack(
+            'pg', view, 'f', 0, 0, code, period_code, studio=studio.id))
+    # По три фильтра в ряд
+    widths.extend([3] * (len(filters) // 3) + [len(filters) % 3] * bool(len(filters) % 3))
+    for code, label in PERIOD_FILTERS.items():
+        mark = "• " if code == period_code else ""
+        kb.button(text=f"{mark}{label}", callback_data=callbacks.pack(
+            'pg', view, 'f', 0, 0, type_code, code, studio=studio.id))
+    widths.append(2)
+    widths.append(2)
+
+    kb.button(text="Назад", callback_data=callbacks.pack(spec['back']))
+    widths.append(1)
+    kb.adjust(*widths)
+    await screens.edit(call, msg, reply_markup=kb.as_markup())
+
+# pg:<студия>:<список>:<n|p|f>:<ключ1>:<ключ2>:<тип>:<период>
+@callbacks.route('pg', str, str, int, int, str, str, scoped=True, admin=True)
+async def admin_list_page(call: CallbackQuery, view: str, direction: str, k1: int, k2: int,
+                          type_code: str, period_code: str, studio: Studio):
+    if view not in ADMIN_LISTS or type_code not in type_filters(studio) or period_code not in PERIOD_FILTERS:
+        await call.answer()
+        return
+    cursor = None if direction == 'f' else (k1, k2)
+    await show_admin_list(call, studio, view, cursor, direction != 'p', type_code, period_code)
+
+@callbacks.route('a_regs', admin=True)
+async def admin_view_registrations(call: CallbackQuery, studio: Studio):
+    await show_admin_list(call, studio, 'reg')
 
-    await call.message.edit_text(msg, reply_markup=admin_menu_keyboard())
+@callbacks.route('a_cancels', admin=True)
+async def admin_view_cancellations(call: CallbackQuery, studio: Studio):
+    await show_admin_list(call, studio, 'can')
 
-@dp.callback_query(F.data == 'admin_edit_schedule')
+@callbacks.route('a_edit', admin=True)
 async def admin_edit_schedule_start(call: CallbackQuery):
     kb = InlineKeyboardBuilder()
-    kb.button(text="Добавить тренировку", callback_data='add_workout')
-    kb.button(text="Удалить тренировку", callback_data='delete_workout')
-    kb.button(text="Изменить тренировку", callback_data='edit_workout')
-    kb.button(text="Обновить расписание на неделю", callback_data='admin_reset_schedule_confirm')
-    kb.button(text="Назад", callback_data='admin_panel')
-    await call.message.edit_text("Редактирование расписания:", reply_markup=kb.as_markup())
-
-@dp.callback_query(F.data == 'admin_reset_schedule_confirm')
+    kb.button(text="Добавить тренировку", callback_data=callbacks.pack('a_add'))
+    kb.button(text="Удалить тренировку", callback_data=callbacks.pack('a_del'))
+    kb.button(text="Изменить тренировку", callback_data=callbacks.pack('a_mod'))
+    kb.button(text="Досоздать расписание по шаблонам", callback_data=callbacks.pack('a_gen'))
+    kb.button(text="Загрузить из файла", callback_data=callbacks.pack('a_import'))
+    kb.button(text="Назад", callback_data=callbacks.pack('admin'))
+    await screens.edit(call, "Редактирование расписания:", reply_markup=kb.as_markup())
+
+@callbacks.route('a_gen', admin=True)
 async def admin_reset_schedule_confirm(call: CallbackQuery):
     kb = InlineKeyboardBuilder()
-    kb.button(text="Да, обновить", callback_data='admin_reset_schedule')
-    kb.button(text="Нет, вернуться", callback_data='admin_edit_schedule')
-    await call.message.edit_text("Вы уверены, что хотите обновить расписание на следующую неделю?", reply_markup=kb.as_markup())
-
-@dp.callback_query(F.data == 'admin_reset_schedule')
-async def admin_reset_schedule(call: CallbackQuery):
-    await load_default_schedule()
-    await call.message.edit_text("Расписание обновлено на следующую неделю.", reply_markup=admin_menu_keyboard())
-
-async def load_default_schedule():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM schedules")
-        now = datetime.now(TIMEZONE)
-        week_later = now + timedelta(days=7)
-
-        schedule = []
-        for i in range((week_later - now).days):
-            day = now + timedelta(days=i)
-            d = day.strftime('%Y-%m-%d')
-            if day.weekday() == 0:  # Пн
-                schedule.append(('Джампинг', f"{d} 10:00"))
-                schedule.append(('Джампинг', f"{d} 19:30"))
-            elif day.weekday() == 2:  # Ср
-                schedule.append(('Джампинг', f"{d} 10:00"))
-                schedule.append(('Жиротопка', f"{d} 19:30"))
-            elif day.weekday() == 4:  # Пт
-                schedule.append(('Джампинг', f"{d} 10:00"))
-                schedule.append(('Джампинг', f"{d} 19:30"))
-            elif day.weekday() == 5:  # Сб
-                schedule.append(('Жиротопка', f"{d} 13:00"))
-
-        for t, dt in schedule:
-            await db.execute("INSERT INTO schedules (workout_type, date_time) VALUES (?, ?)", (t, dt))
-        await db.commit()
-
-@dp.callback_query(F.data == 'add_workout')
-async def add_workout_start(call: CallbackQuery, state: FSMContext):
+    kb.button(text="Да, обновить", callback_data=callbacks.pack('a_gen_go'))
+    kb.button(text="Нет, вернуться", callback_data=callbacks.pack('a_edit'))
+    await screens.edit(
+        call,
+        f"Создать недостающие тренировки по шаблонам на {SCHEDULE_WEEKS} нед. вперёд? "
+        "Существующие тренировки и записи не изменятся.",
+        reply_markup=kb.as_markup()
+    )
+
+@callbacks.route('a_gen_go', admin=True)
+async def admin_reset_schedule(call: CallbackQuery, studio: Studio):
+    created = await studio.generator.generate()
+    await screens.edit(call, f"Расписание обновлено, добавлено тренировок: {created}.", reply_markup=admin_menu_keyboard())
+
+@callbacks.route('a_add', admin=True)
+async def add_workout_start(call: CallbackQuery, state: FSMContext, studio: Studio):
     kb = InlineKeyboardBuilder()
-    kb.button(text="Джампинг", callback_data='choose_workout_type_add_jumping')
-    kb.button(text="Жиротопка", callback_data='choose_workout_type_add_lipolitics')
-    kb.button(text="Назад", callback_data='admin_edit_schedule')
-    await call.message.edit_text("Выберите тип тренировки для добавления:", reply_markup=kb.as_markup())
-
-@dp.callback_query(F.data.startswith('choose_workout_type_add_'))
-async def choose_workout_type_add(call: CallbackQuery, state: FSMContext):
-    workout_type = 'Джампинг' if 'jumping' in call.data else 'Жиротопка'
+    for i, workout_type in enumerate(studio.workout_types):
+        kb.button(text=workout_type, callback_data=callbacks.pack('a_add_type', i, studio=studio.id))
+    kb.button(text="Назад", callback_data=callbacks.pack('a_edit'))
+    await screens.edit(call, "Выберите тип тренировки для добавления:", reply_markup=kb.as_markup())
+
+@callbacks.route('a_add_type', int, scoped=True, admin=True)
+async def choose_workout_type_add(call: CallbackQuery, index: int, state: FSMContext, studio: Studio):
+    workout_type = workout_type_at(studio, index)
+    if workout_type is None:
+        await call.answer()
+        return
     await state.update_data(workout_type=workout_type)
-    await call.message.edit_text("Введите дату и время в формате: 01.02.2026 10:00")
+    await screens.edit(call, "Введите дату и время в формате: 01.02.2026 10:00")
     await state.set_state(AdminStates.waiting_for_workout_time)
 
-@dp.message(AdminStates.waiting_for_workout_time)
-async def handle_add_workout_input(message: Message, state: FSMContext):
+@dp.message(AdminStates.waiting_for_workout_time, studio_admin)
+async def handle_add_workout_input(message: Message, state: FSMContext, studio: Studio):
     input_text = message.text.strip()
     try:
-        dt_obj = datetime.strptime(input_text, '%d.%m.%Y %H:%M')
-        dt_str = dt_obj.strftime('%Y-%m-%d %H:%M')
+        starts_at = parse_input_datetime(input_text, studio.tz)
         data = await state.get_data()
         workout_type = data.get('workout_type', 'Неизвестно')
 
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute('''
-                INSERT INTO schedules (workout_type, date_time) VALUES (?, ?)
-            ''', (workout_type, dt_str))
-            await db.commit()
+        async with studio.events.write() as db:
+            cursor = await db.execute('''
+                INSERT INTO schedules (workout_type, starts_at) VALUES (?, ?)
+            ''', (workout_type, starts_at))
+            await publish_session(studio, db, cursor.lastrowid)
 
         await message.answer(f"Тренировка '{workout_type}' добавлена на {input_text}.", reply_markup=admin_menu_keyboard())
         await state.clear()
     except ValueError:
         await message.answer("Неверный формат. Попробуйте снова: 01.02.2026 10:00")
 
-@dp.callback_query(F.data == 'delete_workout')
-async def delete_workout_start(call: CallbackQuery):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT id, workout_type, date_time FROM schedules
-            ORDER BY date_time
-        ''')
-        rows = await cursor.fetchall()
-
-    if not rows:
-        await call.message.edit_text("Нет тренировок для удаления.", reply_markup=admin_menu_keyboard())
-        return
-
-    kb = InlineKeyboardBuilder()
-    for sch_id, t, dt in rows:
-        dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-        kb.button(text=f"{t} | {dt_formatted}", callback_data=f'delete_workout_{sch_id}')
-    kb.adjust(1)
-    kb.button(text="Назад", callback_data='admin_edit_schedule')
-    await call.message.edit_text("Выберите тренировку для удаления:", reply_markup=kb.as_markup())
-
-@dp.callback_query(F.data.startswith('delete_workout_'))
-async def delete_workout_final(call: CallbackQuery):
-    sch_id = int(call.data.split('_')[-1])
+@callbacks.route('a_del', admin=True)
+async def delete_workout_start(call: CallbackQuery, studio: Studio):
+    await show_admin_list(call, studio, 'del')
 
-    async with aiosqlite.connect(DB_NAME) as db:
+@callbacks.route('a_del_to', int, scoped=True, admin=True)
+async def delete_workout_final(call: CallbackQuery, sch_id: int, studio: Studio):
+    async with studio.events.write() as db:
+        # Записи и напоминания удаляются каскадно
         await db.execute("DELETE FROM schedules WHERE id = ?", (sch_id,))
-        await db.commit()
-
-    await call.message.edit_text("Тренировка удалена.", reply_markup=admin_menu_keyboard())
-
-@dp.callback_query(F.data == 'edit_workout')
-async def edit_workout_start(call: CallbackQuery):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT id, workout_type, date_time FROM schedules
-            ORDER BY date_time
-        ''')
-        rows = await cursor.fetchall()
+        await studio.events.publish(db, SessionDeleted(sch_id))
 
-    if not rows:
-        await call.message.edit_text("Нет тренировок для изменения.", reply_markup=admin_menu_keyboard())
-        return
+    await screens.edit(call, "Тренировка удалена.", reply_markup=admin_menu_keyboard())
 
-    kb = InlineKeyboardBuilder()
-    for sch_id, t, dt in rows:
-        dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-        kb.button(text=f"{t} | {dt_formatted}", callback_data=f'edit_workout_{sch_id}')
-    kb.adjust(1)
-    kb.button(text="Назад", callback_data='admin_edit_schedule')
-    await call.message.edit_text("Выберите тренировку для изменения:", reply_markup=kb.as_markup())
+@callbacks.route('a_mod', admin=True)
+async def edit_workout_start(call: CallbackQuery, studio: Studio):
+    await show_admin_list(call, studio, 'edt')
 
-@dp.callback_query(F.data.startswith('edit_workout_'))
-async def edit_workout_choose_field(call: CallbackQuery, state: FSMContext):
-    sch_id = int(call.data.split('_')[-1])
+@callbacks.route('a_mod_to', int, scoped=True, admin=True)
+async def edit_workout_choose_field(call: CallbackQuery, sch_id: int, state: FSMContext):
     await state.update_data(editing_sch_id=sch_id)
 
     kb = InlineKeyboardBuilder()
-    kb.button(text="Изменить тип", callback_data='edit_field_type')
-    kb.button(text="Изменить дату и время", callback_data='edit_field_datetime')
-    kb.button(text="Назад", callback_data='edit_workout')
-    await call.message.edit_text("Что вы хотите изменить?", reply_markup=kb.as_markup())
+    kb.button(text="Изменить тип", callback_data=callbacks.pack('a_mod_type'))
+    kb.button(text="Изменить дату и время", callback_data=callbacks.pack('a_mod_time'))
+    kb.button(text="Назад", callback_data=callbacks.pack('a_mod'))
+    await screens.edit(call, "Что вы хотите изменить?", reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data == 'edit_field_type')
-async def edit_workout_type(call: CallbackQuery, state: FSMContext):
+@callbacks.route('a_mod_type', admin=True)
+async def edit_workout_type(call: CallbackQuery, state: FSMContext, studio: Studio):
     kb = InlineKeyboardBuilder()
-    kb.button(text="Джампинг", callback_data='set_workout_type_jumping')
-    kb.button(text="Жиротопка", callback_data='set_workout_type_lipolitics')
-    kb.button(text="Назад", callback_data='edit_workout')
-    await call.message.edit_text("Выберите новый тип тренировки:", reply_markup=kb.as_markup())
-
-@dp.callback_query(F.data.startswith('set_workout_type_'))
-async def set_workout_type_final(call: CallbackQuery, state: FSMContext):
-    new_type = 'Джампинг' if 'jumping' in call.data else 'Жиротопка'
+    for i, workout_type in enumerate(studio.workout_types):
+        kb.button(text=workout_type, callback_data=callbacks.pack('a_mod_type_to', i, studio=studio.id))
+    kb.button(text="Назад", callback_data=callbacks.pack('a_mod'))
+    await screens.edit(call, "Выберите новый тип тренировки:", reply_markup=kb.as_markup())
+
+@callbacks.route('a_mod_type_to', int, scoped=True, admin=True)
+async def set_workout_type_final(call: CallbackQuery, index: int, state: FSMContext, studio: Studio):
+    new_type = workout_type_at(studio, index)
+    if new_type is None:
+        await call.answer()
+        return
     data = await state.get_data()
     sch_id = data.get('editing_sch_id')
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with studio.events.write() as db:
         await db.execute('''
             UPDATE schedules SET workout_type = ? WHERE id = ?
         ''', (new_type, sch_id))
-        await db.commit()
+        await publish_session(studio, db, sch_id)
 
-    await call.message.edit_text(f"Тип тренировки изменён на '{new_type}'.", reply_markup=admin_menu_keyboard())
+    await screens.edit(call, f"Тип тренировки изменён на '{new_type}'.", reply_markup=admin_menu_keyboard())
     await state.clear()
 
-@dp.callback_query(F.data == 'edit_field_datetime')
+@callbacks.route('a_mod_time', admin=True)
 async def edit_workout_datetime_start(call: CallbackQuery, state: FSMContext):
-    await call.message.edit_text("Введите новую дату и время в формате: 01.02.2026 10:00")
+    await screens.edit(call, "Введите новую дату и время в формате: 01.02.2026 10:00")
     await state.set_state(AdminStates.editing_workout_time)
 
-@dp.message(AdminStates.editing_workout_time)
-async def edit_workout_datetime_final(message: Message, state: FSMContext):
+@dp.message(AdminStates.editing_workout_time, studio_admin)
+async def edit_workout_datetime_final(message: Message, state: FSMContext, studio: Studio):
     input_text = message.text.strip()
     try:
-        dt_obj = datetime.strptime(input_text, '%d.%m.%Y %H:%M')
-        dt_str = dt_obj.strftime('%Y-%m-%d %H:%M')
+        starts_at = parse_input_datetime(input_text, studio.tz)
         data = await state.get_data()
         sch_id = data.get('editing_sch_id')
 
-        async with aiosqlite.connect(DB_NAME) as db:
+        async with studio.events.write() as db:
             await db.execute('''
-                UPDATE schedules SET date_time = ? WHERE id = ?
-            ''', (dt_str, sch_id))
-            await db.commit()
+                UPDATE schedules SET starts_at = ? WHERE id = ?
+            ''', (starts_at, sch_id))
+            await publish_session(studio, db, sch_id, rescheduled=True)
 
         await message.answer(f"Время тренировки изменено на {input_text}.", reply_markup=admin_menu_keyboard())
         await state.clear()
     except ValueError:
         await message.answer("Неверный формат. Попробуйте снова: 01.02.2026 10:00")
 
-@dp.callback_query(F.data == 'admin_notify_custom')
+@callbacks.route('a_notify', admin=True)
 async def admin_notify_custom_start(call: CallbackQuery, state: FSMContext):
-    await call.message.edit_text("Введите сообщение для отправки всем записавшимся:")
+    await screens.edit(call, "Введите сообщение для отправки всем записавшимся:")
     await state.set_state(AdminStates.waiting_for_notification_message)
 
-@dp.message(AdminStates.waiting_for_notification_message)
-async def admin_notify_custom_send(message: Message, state: FSMContext):
+@dp.message(AdminStates.waiting_for_notification_message, studio_admin)
+async def admin_notify_custom_send(message: Message, state: FSMContext, studio: Studio):
     text = message.text
-    # Получаем всех пользователей, записавшихся на любую тренировку
-    async with aiosqlite.connect(DB_NAME) as db:
+    # Получаем всех пользователей, записавшихся на любую тренировку студии
+    async with studio.database.read() as db:
         cursor = await db.execute('''
             SELECT DISTINCT r.user_id FROM registrations r
         ''')
         user_ids = [row[0] for row in await cursor.fetchall()]
 
-    for uid in user_ids:
-        try:
-            await bot.send_message(uid, f"📢 {text}")
-        except Exception:
-            pass
+    # Рассылка идёт в фоне, прогресс приходит отдельным сообщением
+    await studio.broadcaster.submit(f"📢 {text}", user_ids, report_chat_id=message.chat.id)
 
-    await message.answer("Сообщение отправлено всем записавшимся.", reply_markup=admin_menu_keyboard())
+    await message.answer("Рассылка запущена.", reply_markup=admin_menu_keyboard())
     await state.clear()
 
-@dp.callback_query(F.data == 'admin_panel')
-async def admin_panel_redirect(call: CallbackQuery):
-    await call.message.edit_text("Привет, администратор!", reply_markup=admin_menu_keyboard())
+@callbacks.route('admin', admin=True)
+async def admin_panel_redirect(call: CallbackQuery, studio: Studio):
+    await screens.edit(call, studio_title(studio) + "Привет, администратор!", reply_markup=admin_menu_keyboard())
 
-@dp.callback_query(F.data == 'start')
-async def go_home(call: CallbackQuery):
+@callbacks.route('home')
+async def go_home(call: CallbackQuery, studio: Studio):
     user_id = call.from_user.id
-    if user_id == ADMIN_ID:
-        await call.message.edit_text("Привет, администратор!", reply_markup=admin_menu_keyboard())
+    if studio.is_admin(user_id):
+        await screens.edit(call, studio_title(studio) + "Привет, администратор!", reply_markup=admin_menu_keyboard())
+    else:
+        await screens.edit(call, studio_title(studio) + "Выберите действие:", reply_markup=main_menu_keyboard())
+
+# Кнопка старого формата или из сообщения до смены меню — просто показываем начало
+@callbacks.fallback
+async def outdated_button(call: CallbackQuery, studio: Studio):
+    await go_home(call, studio)
+
+# Кнопка со строкой другой студии (пользователь с тех пор сменил студию)
+# или кнопка администратора у того, кто им не является
+@callbacks.rejected
+async def rejected_button(call: CallbackQuery, reason: str):
+    if reason == 'studio':
+        text = "Эта кнопка относится к другой студии. Откройте меню заново: /start"
     else:
-        await call.message.edit_text("Выберите действие:", reply_markup=main_menu_keyboard())
+        text = "Доступно только администратору студии."
+    try:
+        await call.answer(text, show_alert=True)
+    except TelegramBadRequest:
+        pass
 
-@dp.callback_query(F.data == 'back')
+@callbacks.route('back')
 async def go_back(call: CallbackQuery):
-    await call.message.edit_text("Выберите действие:", reply_markup=main_menu_keyboard())
+    await screens.edit(call, "Выберите действие:", reply_markup=main_menu_keyboard())
 
-@dp.callback_query(F.data == 'admin_cancel_user')
-async def admin_cancel_user_start(call: CallbackQuery):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT r.id, u.username, s.workout_type, s.date_time
-            FROM registrations r
-            JOIN users u ON r.user_id = u.user_id
-            JOIN schedules s ON r.schedule_id = s.id
-            ORDER BY s.date_time
-        ''')
-        rows = await cursor.fetchall()
+@callbacks.route('a_unbook', admin=True)
+async def admin_cancel_user_start(call: CallbackQuery, studio: Studio):
+    await show_admin_list(call, studio, 'acu')
 
-    if not rows:
-        await call.message.edit_text("Нет записей для отмены.", reply_markup=admin_menu_keyboard())
-        return
+@callbacks.route('a_unbook_to', int, scoped=True, admin=True)
+async def admin_cancel_user_final(call: CallbackQuery, reg_id: int, studio: Studio):
 
-    kb = InlineKeyboardBuilder()
-    for reg_id, u, t, dt in rows:
-        dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-        kb.button(text=f"{u} | {t} | {dt_formatted}", callback_data=f'admin_cancel_reg_{reg_id}')
-    kb.adjust(1)
-    kb.button(text="Назад", callback_data='admin_panel')
-    await call.message.edit_text("Выберите запись для отмены:", reply_markup=kb.as_markup())
+    # Пользователь получит уведомление от подписчика notifications
+    async with studio.events.write() as db:
+        await release_seat(studio, db, reg_id, by_admin=True)
 
-@dp.callback_query(F.data.startswith('admin_cancel_reg_'))
-async def admin_cancel_user_final(call: CallbackQuery):
-    reg_id = int(call.data.split('_')[-1])
+    await screens.edit(call, "Запись отменена.", reply_markup=admin_menu_keyboard())
 
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''
-            SELECT r.user_id, s.workout_type, s.date_time
-            FROM registrations r
-            JOIN schedules s ON r.schedule_id = s.id
-            WHERE r.id = ?
-        ''', (reg_id,))
-        row = await cursor.fetchone()
-        if row:
-            user_id, workout, dt = row
-            dt_formatted = datetime.strptime(dt, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
-            
-            # Удаляем запись
-            await db.execute("DELETE FROM registrations WHERE id = ?", (reg_id,))
-            await db.commit()
-
-            # Отправляем пользователю уведомление
-            try:
-                await bot.send_message(user_id, f"Ваша запись на тренировку '{workout}' ({dt_formatted}) была отменена администратором.")
-            except Exception:
-                pass
+# --- Импорт расписания из файла ---
+
+# Сколько изменений и ошибок показывать в предпросмотре
+IMPORT_PREVIEW_LINES = 15
 
-    await call.message.edit_text("Запись отменена.", reply_markup=admin_menu_keyboard())
+def import_report(plan, format_ts):
+    if plan.errors:
+        header = f"Ошибок: {len(plan.errors)}, файл не загружен."
+        items = [f"Строка {line}: {text}" if line else text for line, text in plan.errors]
+    else:
+        header = (
+            f"Новых тренировок: {len(plan.create)}, изменится вместимость: {len(plan.update)}, "
+            f"уже есть: {len(plan.unchanged)}."
+        )
+        items = [
+            f"+ {row.workout_type} | {format_ts(row.starts_at)}" + (f" | мест: {row.capacity}" if row.capacity else "")
+            for row in plan.create
+        ] + [
+            f"~ {row.workout_type} | {format_ts(row.starts_at)} | мест: {old or 'по типу'} → {row.capacity}"
+            for _, row, old in plan.update
+        ]
+    lines = [header] + items[:IMPORT_PREVIEW_LINES]
+    if len(items) > IMPORT_PREVIEW_LINES:
+        lines.append(f"… и ещё {len(items) - IMPORT_PREVIEW_LINES}")
+    return "\n".join(lines)
+
+# Одна транзакция: тренировки, новая вместимость и места из листа ожидания,
+# если вместимость выросла. Если расписание успело измениться и появились
+# конфликты, ничего не записывается
+async def apply_import(studio, rows):
+    async with studio.events.write() as db:
+        plan = await studio.importer.apply(db, rows, to_timestamp(studio.now()))
+        if plan.applied:
+            for sch_id, _, _ in plan.update:
+                await publish_session(studio, db, sch_id)
+                await publish_promoted(studio, db, sch_id, await studio.seat_book.promote(db, sch_id))
+
+    # Новые тренировки разом попадают в кэш перезагрузкой
+    if plan.applied and plan.create:
+        await studio.cache.load(studio.database)
+    return plan
+
+@callbacks.route('a_import', admin=True)
+async def admin_import_start(call: CallbackQuery, state: FSMContext, studio: Studio):
+    kb = InlineKeyboardBuilder()
+    kb.button(text="Назад", callback_data=callbacks.pack('a_edit'))
+    await screens.edit(
+        call,
+        "Пришлите файл CSV или ICS.\n\n"
+        f"CSV: дата;время;тип;вместимость, например 01.02.2026;10:00;{studio.workout_types[0]};15 "
+        "(вместимость можно не указывать).\n"
+        "ICS: событие на каждую тренировку, в названии — тип.",
+        reply_markup=kb.as_markup()
+    )
+    await state.set_state(AdminStates.waiting_for_import)
+
+@dp.message(AdminStates.waiting_for_import, F.document, studio_admin)
+async def admin_import_file(message: Message, state: FSMContext, studio: Studio):
+    if (message.document.file_size or 0) > MAX_FILE_SIZE:
+        await message.answer(f"Файл слишком большой, максимум {MAX_FILE_SIZE // 1024} КБ.")
+        return
+    content = (await bot.download(message.document)).getvalue()
+    rows, errors = studio.importer.parse(content)
+    plan = await studio.importer.preview(rows, errors, to_timestamp(studio.now()))
 
-async def main():
-    await init_db()
-    await load_default_schedule()
+    kb = InlineKeyboardBuilder()
+    if plan.errors or not (plan.create or plan.update):
+        kb.button(text="Назад", callback_data=callbacks.pack('a_edit'))
+        await message.answer(import_report(plan, studio.format_ts) + "\n\nИсправьте файл и пришлите снова.", reply_markup=kb.as_markup())
+        return
+    await state.update_data(import_rows=[list(row) for row in rows])
+    kb.button(text="Загрузить", callback_data=callbacks.pack('a_import_go'))
+    kb.button(text="Отмена", callback_data=callbacks.pack('a_edit'))
+    await message.answer(import_report(plan, studio.format_ts), reply_markup=kb.as_markup())
 
-    scheduler = AsyncIOScheduler(timezone=TIMEZONE)
-    scheduler.add_job(send_reminder, CronTrigger(hour='*/4'))
-    scheduler.start()
+@dp.message(AdminStates.waiting_for_import, studio_admin)
+async def admin_import_not_file(message: Message):
+    await message.answer("Пришлите расписание файлом CSV или ICS.")
 
-    await dp.start_polling(bot)
-# --- FastAPI app ---
-app = FastAPI()
+@callbacks.route('a_import_go', admin=True)
+async def admin_import_apply(call: CallbackQuery, state: FSMContext, studio: Studio):
+    data = await state.get_data()
+    rows = [ImportRow(*row) for row in data.get('import_rows', [])]
+    await state.clear()
+    if not rows:
+        await screens.edit(call, "Нечего загружать, пришлите файл снова.", reply_markup=admin_menu_keyboard())
+        return
 
-@app.get("/")
-def read_root():
-    return {"status": "ok"}
+    plan = await apply_import(studio, rows)
+    if plan.applied:
+        text = f"Расписание загружено: добавлено {len(plan.create)}, изменено {len(plan.update)}."
+    else:
+        text = "Расписание успело измениться.\n" + import_report(plan, studio.format_ts)
+    await screens.edit(call, text, reply_markup=admin_menu_keyboard())
 
-@app.post(f"/webhook/{TOKEN}")
-async def telegram_webhook(request: Request):
-    update_data = await request.json()
-    update = types.Update(**update_data)
-    await dp.feed_update(bot, update)
+# --- Статистика ---
 
-# --- FastAPI app ---
-app = FastAPI()
+# Периоды экрана статистики: дней назад от текущего момента
+STATS_PERIODS = {7: "Неделя", 30: "Месяц", 90: "3 месяца", 365: "Год"}
 
-@app.get("/")
-def read_root():
-    return {"status": "ok"}
+def percent(part, whole):
+    return f"{part / whole:.0%}" if whole else "—"
+
+# Прошедшие тренировки за период; всё считается по агрегатам session_stats
+@callbacks.route('a_stats', int, admin=True)
+async def admin_stats(call: CallbackQuery, days: int, studio: Studio):
+    if days not in STATS_PERIODS:
+        await call.answer()
+        return
+    now = studio.now()
+    summary = await studio.analytics.summary(to_timestamp(now - timedelta(days=days)), to_timestamp(now))
+
+    msg = f"Статистика за {days} дн., прошедших тренировок: {summary['sessions']}\n"
+    for workout_type, t in sorted(summary['types'].items()):
+        msg += f"\n{workout_type} — {t['sessions']} трен., в среднем {t['seats'] / t['sessions']:.1f} чел.\n"
+        if t.get('capacity'):
+            msg += f"  заполняемость: {percent(t['limited_seats'], t['capacity'])}\n"
+        msg += f"  отмены: {percent(t['cancelled'], t['booked'])}, поздние (< 3 ч): {percent(t['late'], t['booked'])}\n"
+        if t['removed']:
+            msg += f"  отменено администратором: {t['removed']}\n"
+        if t['waitlisted']:
+            msg += f"  лист ожидания был на {t['waitlisted']} трен.\n"
+
+    if summary['slots']:
+        msg += "\nПопулярные слоты:\n"
+        for i, (weekday, minute, workout_type, average, fill) in enumerate(summary['slots'], 1):
+            msg += f"{i}. {WEEKDAYS[weekday]} {minute // 60:02d}:{minute % 60:02d} {workout_type} — {average:.1f} чел."
+            msg += f" ({fill:.0%})\n" if fill is not None else "\n"
 
-@app.post(f"/webhook/{TOKEN}")
+    kb = InlineKeyboardBuilder()
+    for period, label in STATS_PERIODS.items():
+        mark = "• " if period == days else ""
+        kb.button(text=f"{mark}{label}", callback_data=callbacks.pack('a_stats', period))
+    kb.button(text="Назад", callback_data=callbacks.pack('admin'))
+    kb.adjust(len(STATS_PERIODS), 1)
+    await screens.edit(call, msg, reply_markup=kb.as_markup())
+
+# --- HTTP ---
+
+api = APIRouter()
+
+@api.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@api.get("/queue")
+def queue_stats():
+    return update_queue.stats()
+
+def api_authorized(token):
+    return bool(API_TOKEN) and secrets.compare_digest(token or '', API_TOKEN)
+
+# Студия запроса по параметру studio=<slug>; без него — единственная студия.
+# None — студия не найдена или не указана, хотя их несколько
+async def api_studio(slug):
+    if slug is None:
+        studios = registry.studios()
+        studio = studios[0] if len(studios) == 1 else None
+    else:
+        studio = registry.by_slug(slug)
+    if studio is not None:
+        await studio.start()
+    return studio
+
+# Выгрузка истории в CSV за даты start..end включительно (ГГГГ-ММ-ДД, время студии).
+# Ответ отдаётся потоком, строки читаются из БД пачками.
+@api.get("/export/{kind}.csv")
+async def export_csv(kind: str, start: str, end: str, studio: str = None, x_api_token: str = Header(None)):
+    if not api_authorized(x_api_token):
+        return Response(status_code=403)
+    if kind not in EXPORTS:
+        return Response(status_code=404)
+    studio = await api_studio(studio)
+    if studio is None:
+        return Response(status_code=404)
+    try:
+        since = datetime.strptime(start, '%Y-%m-%d').replace(tzinfo=studio.tz)
+        until = datetime.strptime(end, '%Y-%m-%d').replace(tzinfo=studio.tz) + timedelta(days=1)
+    except ValueError:
+        return Response(status_code=400)
+    return StreamingResponse(
+        studio.analytics.export_csv(kind, to_timestamp(since), to_timestamp(until)),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{studio.config.slug}_{kind}_{start}_{end}.csv"'},
+    )
+
+# Тело запроса не больше limit байт, иначе None. Content-Length проверяется
+# сразу, а без него (chunked) поток читается только до первого лишнего байта
+async def read_body(request, limit):
+    try:
+        if int(request.headers.get('content-length', 0)) > limit:
+            return None
+    except ValueError:
+        return None
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+# Импорт расписания: тело запроса — файл CSV или ICS не больше MAX_FILE_SIZE (иначе 413).
+# Без apply=1 только возвращает, что изменится; при ошибках — 422 и список по строкам
+@api.post("/import")
+async def import_schedule(request: Request, apply: bool = False, studio: str = None,
+                          x_api_token: str = Header(None)):
+    if not api_authorized(x_api_token):
+        return Response(status_code=403)
+    studio = await api_studio(studio)
+    if studio is None:
+        return Response(status_code=404)
+    content = await read_body(request, MAX_FILE_SIZE)
+    if content is None:
+        return Response(status_code=413)
+    rows, errors = studio.importer.parse(content)
+    if errors or not apply:
+        plan = await studio.importer.preview(rows, errors, to_timestamp(studio.now()))
+    else:
+        plan = await apply_import(studio, rows)
+    return JSONResponse(plan.as_dict(studio.format_ts), status_code=422 if plan.errors else 200)
+
+# Апдейт только ставится в очередь, ответ Telegram уходит сразу
+@api.post(f"/webhook/{TOKEN}")
 async def telegram_webhook(request: Request):
+    if not ready.is_set():
+        # Экземпляр ещё прогревается — Telegram повторит доставку
+        return Response(status_code=503)
     json = await request.json()
-    update = Update.model_validate(json, context={"bot": bot})
-    await dp.feed_update(bot, update)
+    try:
+        update = Update.model_validate(json, context={"bot": bot})
+    except ValidationError:
+        return Response(status_code=400)
+    if recorder is not None:
+        recorder.record(json)
+    if not await update_queue.submit(update):
+        # Очередь переполнена — Telegram повторит доставку позже
+        return Response(status_code=503)
+    return {"ok": True}
+
+# Живость: процесс отвечает и прогрев не упал
+@api.get("/healthz")
+def healthz():
+    if warm_up_task is not None and warm_up_task.done() and not ready.is_set():
+        return JSONResponse({"status": "failed"}, status_code=503)
+    return {"status": "ok"}
+
+# Готовность: прогрев закончен, база реестра отвечает, фоновые задачи
+# запущенных студий и очередь вебхука работают
+@api.get("/readyz")
+@api.get("/")
+async def readyz():
+    checks = {'started': ready.is_set(), 'database': False, 'scheduler': False}
+    if checks['started']:
+        try:
+            await asyncio.wait_for(registry_db.fetchone("SELECT 1"), READY_TIMEOUT)
+            checks['database'] = True
+        except Exception:
+            logger.exception("Проверка готовности: БД не отвечает")
+        checks['scheduler'] = (
+            update_queue.running
+            and (backups.running or not BACKUP_INTERVAL_HOURS)
+            and all(studio.running for studio in registry.instances() if studio.started)
+        )
+    status = 200 if all(checks.values()) else 503
+    return JSONResponse({'checks': checks, 'startup': startup_phases}, status_code=status)
 
 # --- Запуск ---
-async def run_scheduler():
-    scheduler = AsyncIOScheduler(timezone=TIMEZONE)
-    scheduler.add_job(send_reminder, CronTrigger(hour='*/4'))
-    scheduler.start()
 
-async def main():
-    await init_db()
-    await run_scheduler()
+# Секунды от запуска процесса до каждой фазы старта (см. /readyz и /metrics)
+startup_phases = {}
+ready = asyncio.Event()
+warm_up_task = None
+
+def startup_phase(name):
+    if name not in startup_phases:
+        startup_phases[name] = round(time.perf_counter() - STARTED_AT, 3)
+        logger.info("Старт: %s через %.3f с", name, startup_phases[name])
+
+metrics.REGISTRY.register(metrics.Gauge(
+    'bot_startup_seconds', 'Время от запуска процесса до фазы старта',
+    lambda: dict(startup_phases), labels=('phase',)))
 
+# Время до первого обработанного апдейта — главное число холодного старта
+@dp.update.outer_middleware()
+async def first_update_timer(handler, event, data):
+    try:
+        return await handler(event, data)
+    finally:
+        startup_phase('first_update')
+
+# Студии стартуют параллельно, но не больше, чем шардов может быть открыто.
+# Студия, которая не поднялась, не мешает остальным: её запустит первый апдейт
+async def start_studios():
+    limit = asyncio.Semaphore(shard_pool.max_open)
+
+    async def start(studio):
+        async with limit:
+            try:
+                await studio.start()
+            except Exception:
+                logger.exception("Студия %s не запустилась", studio.config.slug)
+
+    await asyncio.gather(*(start(studio) for studio in registry.studios()))
+
+# Прогрев: реестр студий, затем у каждой студии миграции, кэш расписания и
+# фоновые задачи, потом очередь вебхука.
+# Вебхук регистрируется последним — Telegram пишет только готовому экземпляру
+async def warm_up():
+    try:
+        await registry.open(DEFAULT_STUDIO)
+        startup_phase('database')
+        await start_studios()
+        startup_phase('studios')
+        if BACKUP_INTERVAL_HOURS:
+            backups.start()
+        if recorder is not None:
+            recorder.start()
+        update_queue.start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(f"{WEBHOOK_URL}/webhook/{TOKEN}", allowed_updates=dp.resolve_used_update_types())
+    except Exception:
+        logger.exception("Прогрев не удался")
+        raise
+    ready.set()
+    startup_phase('ready')
+
+async def shut_down():
+    ready.clear()
+    await update_queue.stop()
+    if recorder is not None:
+        await recorder.stop()
+    await backups.stop()
+    for studio in registry.instances():
+        await studio.stop()
+    await fsm_storage.close()
+    await shard_pool.close_all()
+    await registry_db.close()
+    await bot.session.close()
+
+# Сервер начинает принимать запросы сразу; пока идёт прогрев, /readyz отвечает 503
+@asynccontextmanager
+async def lifespan(app):
+    global warm_up_task
+    warm_up_task = asyncio.create_task(warm_up())
+    try:
+        yield
+    finally:
+        warm_up_task.cancel()
+        await asyncio.gather(warm_up_task, return_exceptions=True)
+        await shut_down()
+
+def create_app():
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(api)
+    return app
+
+app = create_app()
+startup_phase('imports')
+
+def main():
+    # uvicorn нужен только при запуске сервером
+    import uvicorn
+    logging.basicConfig(level=logging.INFO)
     port = int(os.environ.get("PORT", 8000))
-    uvicorn_config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info")
-    server = uvicorn.Server(uvicorn_config)
-    await server.serve()
+    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
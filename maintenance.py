@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from metrics import JOB_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Сколько тренировок обрабатывать за одну транзакцию
+BATCH = 200
+# Страниц, возвращаемых ОС за один шаг incremental_vacuum
+VACUUM_PAGES = 2000
+# Первый проход — не сразу после старта студии, а через столько секунд
+FIRST_RUN_DELAY = 600
+
+
+# Обслуживание БД, раз в interval секунд:
+#  1. у прошедших тренировок (старше finished_after) записи переносятся
+#     в registrations_archive и удаляются из живой таблицы вместе с напоминаниями
+#     и листом ожидания; тренировки без единой записи получают пустую строку
+#     session_stats (счётчики ведёт analytics.py);
+#  2. отписки старше retention_days переносятся в cancellations_archive,
+#     сами тренировки, завершённые рассылки и недоставленные события outbox
+#     старше этого срока удаляются;
+#  3. incremental_vacuum и PRAGMA optimize (ANALYZE по необходимости).
+#     Базы, созданные до режима auto_vacuum = INCREMENTAL, переводятся в него
+#     полным VACUUM отдельно, при остановленном боте: python maintenance.py convert.
+# Всё идёт короткими транзакциями, SQLite работает в потоке aiosqlite,
+# так что event loop не блокируется, а писатель освобождается между пачками.
+class Maintenance:
+    def __init__(self, database, cache, retention_days=180, finished_after=86400, interval=86400,
+                 first_run_delay=FIRST_RUN_DELAY):
+        self.database = database
+        self.cache = cache
+        self.retention = retention_days * 86400
+        self.finished_after = finished_after
+        self.interval = interval
+        self.first_run_delay = first_run_delay
+        self._task = None
+
+    async def run(self):
+        started = time.perf_counter()
+        now = int(time.time())
+        stats = {
+            'sessions_closed': await self._close_finished(now - self.finished_after),
+            'cancellations_archived': await self._archive_cancellations(now - self.retention),
+            'sessions_deleted': await self._delete_old_sessions(now - self.retention),
+            'broadcasts_deleted': await self._delete_old_broadcasts(now - self.retention),
+            'events_deleted': await self._delete_dead_events(now - self.retention),
+        }
+        if stats['sessions_closed'] or stats['sessions_deleted']:
+            await self.cache.load(self.database)
+        await self._vacuum()
+        JOB_SECONDS.observe(time.perf_counter() - started, 'maintenance')
+        return stats
+
+    async def _close_finished(self, cutoff):
+        total = 0
+        while True:
+            async with self.database.write() as db:
+                cursor = await db.execute('''
+                    SELECT id FROM schedules s
+                    WHERE starts_at < ?
+                      AND (EXISTS (SELECT 1 FROM registrations WHERE schedule_id = s.id)
+                           OR EXISTS (SELECT 1 FROM reminders WHERE schedule_id = s.id)
+                           OR EXISTS (SELECT 1 FROM waitlist WHERE schedule_id = s.id)
+                           OR NOT EXISTS (SELECT 1 FROM session_stats WHERE schedule_id = s.id))
+                    ORDER BY starts_at
+                    LIMIT ?
+                ''', (cutoff, BATCH))
+                ids = await cursor.fetchall()
+                if not ids:
+                    return total
+
+                await db.executemany('''
+                    INSERT OR IGNORE INTO session_stats (schedule_id, workout_type, starts_at, capacity)
+                    SELECT id, workout_type, starts_at, capacity FROM schedules WHERE id = ?
+                ''', ids)
+                await db.executemany('''
+                    INSERT INTO registrations_archive (id, user_id, schedule_id, workout_type, starts_at)
+                    SELECT r.id, r.user_id, r.schedule_id, s.workout_type, s.starts_at
+                    FROM registrations r JOIN schedules s ON r.schedule_id = s.id
+                    WHERE r.schedule_id = ?
+                ''', ids)
+                await db.executemany("DELETE FROM registrations WHERE schedule_id = ?", ids)
+                await db.executemany("DELETE FROM reminders WHERE schedule_id = ?", ids)
+                await db.executemany("DELETE FROM waitlist WHERE schedule_id = ?", ids)
+            total += len(ids)
+            await asyncio.sleep(0)
+
+    async def _archive_cancellations(self, cutoff):
+        total = 0
+        while True:
+            async with self.database.write() as db:
+                cursor = await db.execute(
+                    "SELECT id FROM cancellations WHERE created_at < ? ORDER BY created_at LIMIT ?",
+                    (cutoff, BATCH * 10)
+                )
+                ids = [(c_id,) for (c_id,) in await cursor.fetchall()]
+                if not ids:
+                    return total
+                await db.executemany('''
+                    INSERT INTO cancellations_archive (id, user_id, schedule_id, workout_type, starts_at, created_at)
+                    SELECT c.id, c.user_id, c.schedule_id, s.workout_type, s.starts_at, c.created_at
+                    FROM cancellations c JOIN schedules s ON c.schedule_id = s.id
+                    WHERE c.id = ?
+                ''', ids)
+                await db.executemany("DELETE FROM cancellations WHERE id = ?", ids)
+            total += len(ids)
+            await asyncio.sleep(0)
+
+    # Тренировки старше срока хранения: всё нужное уже в session_stats и архивах
+    async def _delete_old_sessions(self, cutoff):
+        total = 0
+        while True:
+            async with self.database.write() as db:
+                cursor = await db.execute('''
+                    DELETE FROM schedules WHERE id IN (
+                        SELECT id FROM schedules s
+                        WHERE starts_at < ?
+                          AND NOT EXISTS (SELECT 1 FROM registrations WHERE schedule_id = s.id)
+                          AND NOT EXISTS (SELECT 1 FROM cancellations WHERE schedule_id = s.id)
+                        LIMIT ?
+                    )
+                ''', (cutoff, BATCH))
+                deleted = cursor.rowcount
+            total += deleted
+            if deleted < BATCH:
+                return total
+            await asyncio.sleep(0)
+
+    # Завершённые рассылки вместе со списками получателей (каскадом)
+    async def _delete_old_broadcasts(self, cutoff):
+        async with self.database.write() as db:
+            cursor = await db.execute(
+                "DELETE FROM broadcasts WHERE status = 'done' AND created_at < ?", (cutoff,)
+            )
+            return cursor.rowcount
+
+    # События, по которым исчерпаны попытки доставки (см. events.EventBus)
+    async def _delete_dead_events(self, cutoff):
+        async with self.database.write() as db:
+            cursor = await db.execute(
+                "DELETE FROM outbox WHERE available_at IS NULL AND created_at < ?", (cutoff,)
+            )
+            return cursor.rowcount
+
+    async def _vacuum(self):
+        async with self.database.exclusive() as db:
+            cursor = await db.execute("PRAGMA auto_vacuum")
+            mode = (await cursor.fetchone())[0]
+            if mode != 2:
+                # Полный VACUUM держал бы писателя всё время перестройки файла
+                logger.warning("%s без auto_vacuum = INCREMENTAL, место не возвращается; "
+                               "переведите базу: python maintenance.py convert", self.database.path)
+            else:
+                # Прагма освобождает по странице на шаг — результат нужно дочитать
+                cursor = await db.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+                await cursor.fetchall()
+            await db.execute("PRAGMA analysis_limit = 400")
+            await db.execute("PRAGMA optimize")
+
+    # --- Фоновый запуск ---
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        await asyncio.sleep(self.first_run_delay)
+        while True:
+            try:
+                stats = await self.run()
+                logger.info("Обслуживание БД: %s", stats)
+            except Exception:
+                logger.exception("Обслуживание БД не удалось")
+            await asyncio.sleep(self.interval)
+
+
+# Перевод базы в auto_vacuum = INCREMENTAL полным VACUUM. Файл перестраивается
+# целиком и всё это время заблокирован — только при остановленном боте.
+# Возвращает True, если база переведена, False — если уже в этом режиме
+def convert(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
+
+# Из командной строки, при остановленном боте:
+#   python maintenance.py convert                       # реестр и базы всех студий
+#   python maintenance.py convert studio_yoga.db ...
+def main():
+    from backup import registry_sources
+
+    parser = argparse.ArgumentParser(description="Обслуживание баз бота")
+    parser.add_argument("--registry", default="studios.db", help="файл базы реестра")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert_cmd = commands.add_parser("convert", help="перевести базы в auto_vacuum = INCREMENTAL")
+    convert_cmd.add_argument("paths", nargs="*", help="файлы баз (по умолчанию все из реестра)")
+    args = parser.parse_args()
+
+    for path in args.paths or registry_sources(args.registry):
+        if not os.path.exists(path):
+            print(f"{path}: нет файла")
+            continue
+        started = time.perf_counter()
+        try:
+            changed = convert(path)
+        except sqlite3.Error as e:
+            print(f"{path}: {e}")
+            continue
+        status = f"переведена за {time.perf_counter() - started:.1f} с" if changed else "уже в режиме INCREMENTAL"
+        print(f"{path}: {status}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+import logging
+import os
+import re
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from aiogram import BaseMiddleware
+from aiogram.filters import Command
+from aiogram.types import BotCommand
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Хэндлеры дольше этого порога пишутся в лог (мс, 0 — не писать)
+SLOW_HANDLER_MS = float(os.getenv("SLOW_HANDLER_MS", 0))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+# Метрики в памяти процесса и их вывод в текстовом формате Prometheus.
+# Своя маленькая реализация вместо prometheus_client: нужны только
+# счётчики, гистограммы и значения, снимаемые в момент запроса.
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(buckets)
+        self.values = {}    # labels -> [счётчики по корзинам..., sum, count]
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 2)
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self):
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {series[-2]}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {series[-1]}"
+
+
+# Значение, которое вычисляется при каждом запросе /metrics.
+# fn возвращает число или словарь {значения меток: число}.
+# type='counter' — для счётчиков, которые ведут сами объекты (очередь, кэш).
+class Gauge:
+    def __init__(self, name, help, fn, labels=(), type='gauge'):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, v in value.items():
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            yield f"{self.name}{_labels(self.label_names, labels)} {v}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    'bot_handler_seconds', 'Время обработки апдейта', ('handler', 'prefix')))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    'bot_handler_errors_total', 'Исключения в хэндлерах', ('handler', 'prefix', 'error')))
+SQL_SECONDS = REGISTRY.register(Histogram(
+    'bot_sql_seconds', 'Время выполнения SQL-запроса', ('statement',)))
+SQL_ROWS = REGISTRY.register(Histogram(
+    'bot_sql_rows', 'Строк прочитано или изменено запросом', ('statement',), buckets=ROWS_BUCKETS))
+API_SECONDS = REGISTRY.register(Histogram(
+    'bot_api_seconds', 'Время вызова Bot API', ('method',)))
+API_ERRORS = REGISTRY.register(Counter(
+    'bot_api_errors_total', 'Ошибки Bot API', ('method', 'error')))
+OUTBOUND_WAIT = REGISTRY.register(Histogram(
+    'bot_outbound_wait_seconds', 'Ожидание исходящего запроса в очереди своей полосы', ('lane',)))
+EVENT_SECONDS = REGISTRY.register(Histogram(
+    'bot_event_seconds', 'Обработка доменного события подписчиком', ('subscriber',)))
+EVENT_ERRORS = REGISTRY.register(Counter(
+    'bot_event_errors_total', 'Неудачные попытки доставки события', ('subscriber', 'error')))
+JOB_SECONDS = REGISTRY.register(Histogram(
+    'bot_job_seconds', 'Время выполнения фоновой задачи', ('job',),
+    buckets=LATENCY_BUCKETS + (30, 60, 300, 900)))
+
+
+# "2book_to:1:15" -> "book_to", "2pg:1:reg:n:0:0:a:a" -> "pg" (формат см. callbacks.py);
+# кнопки старого формата: "register_to_15" -> "register_to".
+# С routes (имена колбэков callbacks.CallbackRouter) всё, чего там нет, — "other":
+# callback_data присылает клиент, и число значений метки не должно расти от него
+@lru_cache(maxsize=1024)
+def callback_prefix(data, routes=None):
+    name = (data or '').split(':', 1)[0]
+    name = re.sub(r'^\d+|[_:]?-?\d.*$', '', name) or '-'
+    return name if routes is None or name in routes else 'other'
+
+
+# Команды, на которые есть хэндлеры сообщений: "/start" и т. п.
+def registered_commands(dp):
+    commands = set()
+    for router in dp.chain_tail:
+        for handler in router.message.handlers:
+            for f in handler.filters or ():
+                if isinstance(f.callback, Command):
+                    commands.update(
+                        f.callback.prefix[0] + getattr(c, 'command', c)
+                        for c in f.callback.commands if isinstance(c, (str, BotCommand))
+                    )
+    return frozenset(commands)
+
+
+# "SELECT ... FROM registrations r JOIN ..." -> "SELECT registrations"
+@lru_cache(maxsize=1024)
+def statement_label(sql):
+    words = sql.split(None, 1)
+    if not words:
+        return '-'
+    verb = words[0].upper()
+    match = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)', sql, re.IGNORECASE)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+# Внешний middleware апдейтов: время и ошибки по хэндлеру и префиксу callback_data.
+# Имя хэндлера известно только после фильтров, его сообщает HandlerNameMiddleware.
+# Метка prefix берёт значения только из известного набора: команды с хэндлерами
+# (остальные — "command"), имена колбэков routes (остальные — "other").
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self, dp=None, routes=None):
+        self.dp = dp
+        self.routes = routes
+        self._commands = None
+        self._route_names = None
+
+    # Наборы собираются при первом апдейте, когда все хэндлеры уже зарегистрированы
+    def _known(self):
+        if self._commands is None:
+            self._commands = registered_commands(self.dp) if self.dp is not None else frozenset()
+            self._route_names = frozenset(self.routes) if self.routes is not None else None
+
+    async def __call__(self, handler, event, data):
+        ctx = data['metrics'] = {'handler': 'unhandled'}
+        self._known()
+        if event.callback_query is not None:
+            prefix = callback_prefix(event.callback_query.data, self._route_names)
+        elif event.message is not None:
+            text = event.message.text or ''
+            if text.startswith('/'):
+                command = text.split(None, 1)[0].split('@', 1)[0]
+                prefix = command if command in self._commands else 'command'
+            else:
+                prefix = 'message'
+        else:
+            prefix = event.event_type
+
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(ctx['handler'], prefix, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, ctx['handler'], prefix)
+            if SLOW_HANDLER_MS and elapsed * 1000 >= SLOW_HANDLER_MS:
+                logger.warning("Медленный хэндлер %s (%s): %.0f мс", ctx['handler'], prefix, elapsed * 1000)
+
+
+# Внутренний middleware сообщений и колбэков: запоминает имя сработавшего хэндлера
+class HandlerNameMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        ctx = data.get('metrics')
+        if ctx is not None:
+            ctx['handler'] = getattr(data['handler'].callback, '__name__', 'handler')
+        return await handler(event, data)
+
+
+# Middleware сессии бота: время и ошибки каждого вызова Bot API
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, name)
+
+
+# routes — имена колбэков (callbacks.CallbackRouter.routes) для метки prefix
+def setup(dp, bot, routes=None):
+    dp.update.outer_middleware(HandlerMetricsMiddleware(dp, routes))
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(HandlerNameMiddleware())
+    bot.session.middleware(ApiMetricsMiddleware())
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,413 @@
+from datetime import datetime
+
+
+# Версия 1 — схема, которая создавалась в init_db до появления миграций.
+# IF NOT EXISTS: на старых базах таблицы уже есть, миграция лишь фиксирует версию.
+async def _initial_schema(db, tz):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            workout_type TEXT,
+            date_time TEXT
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS registrations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            schedule_id INTEGER,
+            FOREIGN KEY(schedule_id) REFERENCES schedules(id),
+            UNIQUE(user_id, schedule_id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cancellations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            schedule_id INTEGER,
+            timestamp TEXT
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            text TEXT,
+            status TEXT,
+            report_chat_id INTEGER,
+            progress_message_id INTEGER,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at INTEGER
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS blocked_users (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            created_at INTEGER
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            schedule_id INTEGER,
+            user_id INTEGER,
+            offset_minutes INTEGER,
+            fire_at INTEGER,
+            sent INTEGER DEFAULT 0,
+            PRIMARY KEY (schedule_id, user_id, offset_minutes)
+        )
+    ''')
+
+
+# Версия 2 — время в секундах epoch вместо строк, индексы под горячие запросы
+# и внешние ключи с ON DELETE CASCADE. SQLite не умеет менять столбцы,
+# поэтому таблицы пересоздаются и данные копируются.
+async def _epoch_timestamps(db, tz):
+    def to_epoch(text):
+        return int(datetime.strptime(text, '%Y-%m-%d %H:%M').replace(tzinfo=tz).timestamp())
+
+    def iso_to_epoch(text):
+        return int(datetime.fromisoformat(text).timestamp())
+
+    cursor = await db.execute("SELECT id, workout_type, date_time FROM schedules")
+    schedules = [(i, t, to_epoch(dt)) for i, t, dt in await cursor.fetchall() if dt]
+    cursor = await db.execute("SELECT id, user_id, schedule_id, timestamp FROM cancellations")
+    cancellations = [(i, u, s, iso_to_epoch(ts)) for i, u, s, ts in await cursor.fetchall() if ts]
+
+    await db.execute("DROP TABLE schedules")
+    await db.execute('''
+        CREATE TABLE schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            workout_type TEXT NOT NULL,
+            starts_at INTEGER NOT NULL
+        )
+    ''')
+    await db.executemany("INSERT INTO schedules (id, workout_type, starts_at) VALUES (?, ?, ?)", schedules)
+
+    await db.execute("ALTER TABLE registrations RENAME TO registrations_old")
+    await db.execute('''
+        CREATE TABLE registrations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            schedule_id INTEGER NOT NULL REFERENCES schedules(id) ON DELETE CASCADE,
+            UNIQUE(user_id, schedule_id)
+        )
+    ''')
+    await db.execute('''
+        INSERT INTO registrations (id, user_id, schedule_id)
+        SELECT id, user_id, schedule_id FROM registrations_old
+        WHERE schedule_id IN (SELECT id FROM schedules)
+    ''')
+    await db.execute("DROP TABLE registrations_old")
+
+    await db.execute("DROP TABLE cancellations")
+    await db.execute('''
+        CREATE TABLE cancellations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            schedule_id INTEGER NOT NULL REFERENCES schedules(id) ON DELETE CASCADE,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    await db.executemany('''
+        INSERT INTO cancellations (id, user_id, schedule_id, created_at)
+        SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM schedules WHERE id = ?)
+    ''', [(i, u, s, ts, s) for i, u, s, ts in cancellations])
+
+    await db.execute("ALTER TABLE reminders RENAME TO reminders_old")
+    await db.execute('''
+        CREATE TABLE reminders (
+            schedule_id INTEGER NOT NULL REFERENCES schedules(id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            offset_minutes INTEGER NOT NULL,
+            fire_at INTEGER NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (schedule_id, user_id, offset_minutes)
+        )
+    ''')
+    await db.execute('''
+        INSERT INTO reminders
+        SELECT * FROM reminders_old WHERE schedule_id IN (SELECT id FROM schedules)
+    ''')
+    await db.execute("DROP TABLE reminders_old")
+
+    await db.execute("ALTER TABLE broadcast_recipients RENAME TO broadcast_recipients_old")
+    await db.execute('''
+        CREATE TABLE broadcast_recipients (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+    ''')
+    await db.execute("INSERT INTO broadcast_recipients SELECT * FROM broadcast_recipients_old")
+    await db.execute("DROP TABLE broadcast_recipients_old")
+
+    # Индексы: диапазоны по времени, подсчёт мест, выборки по пользователю
+    await db.execute("CREATE INDEX idx_schedules_starts_at ON schedules (starts_at)")
+    await db.execute("CREATE INDEX idx_schedules_type_starts_at ON schedules (workout_type, starts_at)")
+    await db.execute("CREATE INDEX idx_registrations_schedule ON registrations (schedule_id, user_id)")
+    await db.execute("CREATE INDEX idx_cancellations_created_at ON cancellations (created_at)")
+    await db.execute("CREATE INDEX idx_cancellations_schedule ON cancellations (schedule_id)")
+    await db.execute("CREATE INDEX idx_reminders_due ON reminders (fire_at) WHERE sent = 0")
+    await db.execute("CREATE INDEX idx_broadcasts_status ON broadcasts (status)")
+
+
+# Версия 3 — состояния FSM (storage.SQLiteStorage)
+async def _fsm_states(db, tz):
+    await db.execute('''
+        CREATE TABLE fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    await db.execute("CREATE INDEX idx_fsm_states_updated_at ON fsm_states (updated_at)")
+
+
+# Версия 4 — вместимость конкретной тренировки (NULL — по типу) и лист ожидания
+async def _capacity_waitlist(db, tz):
+    await db.execute("ALTER TABLE schedules ADD COLUMN capacity INTEGER")
+    await db.execute('''
+        CREATE TABLE waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            schedule_id INTEGER NOT NULL REFERENCES schedules(id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            UNIQUE(schedule_id, user_id)
+        )
+    ''')
+
+
+# Версия 5 — шаблоны регулярного расписания вместо захардкоженной недели.
+# start_minute — минуты от полуночи по времени студии, weekday: 0 — понедельник.
+# Только схема: шаблоны у каждой студии свои (tenants.py add --template, template-add).
+async def _schedule_templates(db, tz):
+    await db.execute('''
+        CREATE TABLE schedule_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            weekday INTEGER NOT NULL CHECK (weekday BETWEEN 0 AND 6),
+            start_minute INTEGER NOT NULL CHECK (start_minute BETWEEN 0 AND 1439),
+            workout_type TEXT NOT NULL,
+            capacity INTEGER,
+            active INTEGER NOT NULL DEFAULT 1,
+            generated_until INTEGER,
+            UNIQUE(weekday, start_minute, workout_type)
+        )
+    ''')
+    await db.execute('''
+        ALTER TABLE schedules
+        ADD COLUMN template_id INTEGER REFERENCES schedule_templates(id) ON DELETE SET NULL
+    ''')
+    await db.execute("CREATE UNIQUE INDEX idx_schedules_template ON schedules (template_id, starts_at)")
+
+
+# Версия 6 — итоги по прошедшим тренировкам и архивы (maintenance.Maintenance).
+# В архивах тип и время тренировки хранятся копией: сами тренировки со временем удаляются.
+async def _rollups_archive(db, tz):
+    await db.execute('''
+        CREATE TABLE daily_stats (
+            schedule_id INTEGER PRIMARY KEY,
+            day TEXT NOT NULL,
+            workout_type TEXT NOT NULL,
+            registrations INTEGER NOT NULL,
+            cancellations INTEGER NOT NULL
+        )
+    ''')
+    await db.execute("CREATE INDEX idx_daily_stats_day ON daily_stats (day, workout_type)")
+    await db.execute('''
+        CREATE TABLE registrations_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            schedule_id INTEGER NOT NULL,
+            workout_type TEXT NOT NULL,
+            starts_at INTEGER NOT NULL
+        )
+    ''')
+    await db.execute("CREATE INDEX idx_registrations_archive_user ON registrations_archive (user_id)")
+    await db.execute('''
+        CREATE TABLE cancellations_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            schedule_id INTEGER NOT NULL,
+            workout_type TEXT NOT NULL,
+            starts_at INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    await db.execute("CREATE INDEX idx_cancellations_archive_created_at ON cancellations_archive (created_at)")
+
+
+
+# Версия 7 — session_stats вместо daily_stats: счётчики по каждой тренировке,
+# которые обновляются при каждой записи и отмене (см. analytics.py).
+# Заполняется по живым таблицам и архивам; поздняя отмена — менее чем за 3 часа.
+async def _session_stats(db, tz):
+    await db.execute('''
+        CREATE TABLE session_stats (
+            schedule_id INTEGER PRIMARY KEY,
+            workout_type TEXT NOT NULL,
+            starts_at INTEGER NOT NULL,
+            capacity INTEGER,
+            booked INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            late_cancelled INTEGER NOT NULL DEFAULT 0,
+            removed INTEGER NOT NULL DEFAULT 0,
+            waitlist_peak INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    await db.execute("CREATE INDEX idx_session_stats_starts_at ON session_stats (starts_at)")
+    await db.execute('''
+        INSERT INTO session_stats (schedule_id, workout_type, starts_at, capacity,
+                                   booked, cancelled, late_cancelled, waitlist_peak)
+        WITH sessions AS (
+            SELECT id AS schedule_id, workout_type, starts_at, capacity FROM schedules
+            UNION ALL
+            SELECT schedule_id, workout_type, starts_at, NULL FROM (
+                SELECT schedule_id, workout_type, starts_at FROM registrations_archive
+                UNION
+                SELECT schedule_id, workout_type, starts_at FROM cancellations_archive
+            )
+            WHERE schedule_id NOT IN (SELECT id FROM schedules)
+            GROUP BY schedule_id
+        ),
+        regs AS (
+            SELECT schedule_id, COUNT(*) AS n FROM (
+                SELECT schedule_id FROM registrations
+                UNION ALL
+                SELECT schedule_id FROM registrations_archive
+            ) GROUP BY schedule_id
+        ),
+        cancels AS (
+            SELECT c.schedule_id, COUNT(*) AS n, SUM(c.created_at > s.starts_at - 10800) AS late
+            FROM (
+                SELECT schedule_id, created_at FROM cancellations
+                UNION ALL
+                SELECT schedule_id, created_at FROM cancellations_archive
+            ) c
+            JOIN sessions s ON s.schedule_id = c.schedule_id
+            GROUP BY c.schedule_id
+        ),
+        waiting AS (
+            SELECT schedule_id, COUNT(*) AS n FROM waitlist GROUP BY schedule_id
+        )
+        SELECT s.schedule_id, s.workout_type, s.starts_at, s.capacity,
+               COALESCE(r.n, 0) + COALESCE(c.n, 0), COALESCE(c.n, 0), COALESCE(c.late, 0), COALESCE(w.n, 0)
+        FROM sessions s
+        LEFT JOIN regs r ON r.schedule_id = s.schedule_id
+        LEFT JOIN cancels c ON c.schedule_id = s.schedule_id
+        LEFT JOIN waiting w ON w.schedule_id = s.schedule_id
+    ''')
+    await db.execute("DROP TABLE daily_stats")
+    # Для выгрузки по диапазону дат
+    await db.execute(
+        "CREATE INDEX idx_registrations_archive_starts_at ON registrations_archive (starts_at, id)"
+    )
+
+# Версия 8 — outbox доменных событий (events.EventBus): строка на пару
+# (событие, подписчик), удаляется после доставки.
+# available_at IS NULL — попытки исчерпаны, строка оставлена для разбора.
+async def _outbox(db, tz):
+    await db.execute('''
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subscriber TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at INTEGER,
+            last_error TEXT
+        )
+    ''')
+    await db.execute("CREATE INDEX idx_outbox_available_at ON outbox (available_at)")
+
+# Список миграций: (версия, функция). Новые добавляются только в конец.
+MIGRATIONS = [
+    (1, _initial_schema),
+    (2, _epoch_timestamps),
+    (3, _fsm_states),
+    (4, _capacity_waitlist),
+    (5, _schedule_templates),
+    (6, _rollups_archive),
+    (7, _session_stats),
+    (8, _outbox),
+]
+
+
+# Реестр студий (tenants.StudioRegistry) — отдельная небольшая база:
+# студии с настройками, привязка пользователей к студиям и состояния FSM.
+# admins — JSON-список user_id, workouts — JSON-список пар [тип, вместимость].
+async def _registry_schema(db, tz):
+    await db.execute('''
+        CREATE TABLE studios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            slug TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            timezone TEXT NOT NULL,
+            admins TEXT NOT NULL,
+            workouts TEXT NOT NULL,
+            db_path TEXT NOT NULL UNIQUE,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE user_studios (
+            user_id INTEGER PRIMARY KEY,
+            studio_id INTEGER NOT NULL REFERENCES studios(id) ON DELETE CASCADE,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    await _fsm_states(db, tz)
+
+REGISTRY_MIGRATIONS = [
+    (1, _registry_schema),
+]
+
+
+# Версия читается и все недостающие миграции применяются в одной транзакции
+# (BEGIN IMMEDIATE): либо схема обновлена целиком, либо осталась как была, а
+# процесс, стартовавший одновременно с другим, дождётся его, увидит новую
+# версию и ничего не повторит. Внешние ключи выключены, чтобы можно было
+# пересоздавать таблицы, и проверяются в конце.
+async def migrate(database, tz, migrations=MIGRATIONS):
+    async with database.write(foreign_keys=False) as db:
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at INTEGER NOT NULL
+            )
+        ''')
+        cursor = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        current = (await cursor.fetchone())[0]
+        pending = [(v, m) for v, m in migrations if v > current]
+        if not pending:
+            return
+
+        for version, migration in pending:
+            await migration(db, tz)
+            await db.execute(
+                "INSERT INTO schema_version (version, applied_at) VALUES (?, strftime('%s', 'now'))",
+                (version,)
+            )
+        cursor = await db.execute("PRAGMA foreign_key_check")
+        violations = await cursor.fetchall()
+        if violations:
+            raise RuntimeError(f"Миграция нарушает внешние ключи: {violations[:5]}")
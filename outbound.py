@@ -0,0 +1,177 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, GetFile, GetMe, GetUpdates
+from metrics import OUTBOUND_WAIT
+
+# Полосы исходящих запросов по убыванию приоритета:
+#  interactive — ответы на нажатия и сообщения пользователя;
+#  notice      — одиночные уведомления (место из листа ожидания, отмена администратором);
+#  bulk        — рассылки и напоминания.
+INTERACTIVE = 'interactive'
+NOTICE = 'notice'
+BULK = 'bulk'
+LANES = (INTERACTIVE, NOTICE, BULK)
+
+# Общий бюджет на все полосы: Telegram пропускает ~30 сообщений в секунду
+GLOBAL_RATE = 28
+BURST = 10
+# Сколько жетонов рассылки оставляют нетронутыми — под всплеск нажатий
+BULK_RESERVE = 3
+
+# Пул соединений к api.telegram.org: keep-alive дольше стандартных 15 с,
+# чтобы соединения переживали паузы между апдейтами
+POOL_SIZE = 40
+KEEPALIVE_TIMEOUT = 60
+DNS_TTL = 300
+
+# Не расходуют лимит сообщений
+EXEMPT = (GetUpdates, GetMe, GetFile, AnswerCallbackQuery)
+
+current_lane = ContextVar('outbound_lane', default=INTERACTIVE)
+
+
+# Запросы внутри блока идут по указанной полосе
+@contextmanager
+def lane(name):
+    token = current_lane.set(name)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+# Планировщик исходящих запросов: один token bucket на всех и очереди по полосам.
+# Ответы пользователям не ждут вовсе, но тратят жетоны (бюджет может уйти в долг
+# не глубже burst), поэтому уведомления и рассылки получают только остаток.
+# Освободившийся жетон достаётся самой приоритетной непустой очереди.
+# После RetryAfter на паузу встаёт только bulk.
+# rate=0 — без ограничения скорости (пауза bulk после RetryAfter остаётся).
+class OutboundScheduler:
+    def __init__(self, rate=GLOBAL_RATE, burst=BURST, bulk_reserve=BULK_RESERVE):
+        if rate < 0:
+            raise ValueError(f"Скорость исходящих запросов не может быть отрицательной: {rate}")
+        self.rate = rate
+        self.burst = burst
+        self.bulk_reserve = bulk_reserve
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._waiters = {name: deque() for name in LANES}
+        self._bulk_paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._pump_task = None
+
+    def depth(self):
+        return {name: len(waiters) for name, waiters in self._waiters.items()}
+
+    def pause(self, seconds):
+        self._bulk_paused_until = max(self._bulk_paused_until, time.monotonic() + seconds)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _available(self, name):
+        if name == BULK:
+            return self.tokens >= 1 + self.bulk_reserve and time.monotonic() >= self._bulk_paused_until
+        return self.tokens >= 1
+
+    def _delay(self, name):
+        need = 1 + (self.bulk_reserve if name == BULK else 0) - self.tokens
+        delay = max(need, 0) / self.rate
+        if name == BULK:
+            delay = max(delay, self._bulk_paused_until - time.monotonic())
+        return delay
+
+    async def acquire(self, name):
+        started = time.monotonic()
+        if not self.rate:
+            if name == BULK and self._bulk_paused_until > started:
+                await asyncio.sleep(self._bulk_paused_until - started)
+            OUTBOUND_WAIT.observe(time.monotonic() - started, name)
+            return
+        self._refill()
+        if name == INTERACTIVE:
+            self.tokens = max(self.tokens - 1, -self.burst)
+            OUTBOUND_WAIT.observe(0.0, name)
+            return
+        ahead = LANES[:LANES.index(name) + 1]
+        if not any(self._waiters[n] for n in ahead) and self._available(name):
+            self.tokens -= 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters[name].append(waiter)
+            self._wakeup.set()
+            if self._pump_task is None or self._pump_task.done():
+                self._pump_task = asyncio.create_task(self._pump())
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters[name]:
+                    self._waiters[name].remove(waiter)
+                raise
+        OUTBOUND_WAIT.observe(time.monotonic() - started, name)
+
+    def _next_lane(self):
+        for name in LANES:
+            waiters = self._waiters[name]
+            while waiters and waiters[0].done():
+                waiters.popleft()
+            if waiters:
+                return name
+        return None
+
+    async def _pump(self):
+        while True:
+            name = self._next_lane()
+            if name is None:
+                return
+            self._refill()
+            if self._available(name):
+                self.tokens -= 1
+                self._waiters[name].popleft().set_result(None)
+                continue
+            # Ждём жетон, но просыпаемся сразу, если пришёл запрос приоритетнее
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._delay(name))
+            except asyncio.TimeoutError:
+                pass
+
+
+# Middleware сессии Bot API: каждый запрос сначала получает жетон своей полосы
+class OutboundMiddleware(BaseRequestMiddleware):
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, EXEMPT):
+            await self.scheduler.acquire(current_lane.get())
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.scheduler.pause(e.retry_after)
+            raise
+
+
+# Сессия aiohttp с настроенным пулом соединений
+class OutboundSession(AiohttpSession):
+    def __init__(self, limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        # Параметры TCPConnector, который aiogram создаёт при первом запросе
+        self._connector_init.update(
+            limit_per_host=limit,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=DNS_TTL,
+        )
+
+
+# Регистрировать до metrics.setup: тогда bot_api_seconds не включает ожидание в очереди
+def setup(bot, scheduler):
+    bot.session.middleware(OutboundMiddleware(scheduler))
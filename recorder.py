@@ -0,0 +1,254 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# Сжатый размер файла журнала, после которого начинается следующий
+MAX_BYTES = 64 * 1024 * 1024
+# Сколько законченных файлов хранить
+KEEP_FILES = 20
+# Раз в столько секунд накопленные апдейты уходят на диск
+FLUSH_INTERVAL = 1.0
+# Столько апдейтов ждёт записи; сверх этого (диск не успевает) новые не пишутся
+MAX_BUFFER = 100_000
+# Псевдонимы лежат выше любых настоящих id Telegram и с ними не пересекаются
+PSEUDONYM_BASE = 10 ** 14
+PREFIX = 'updates-'
+SUFFIX = '.jsonl.gz'
+# Файл, в который сейчас идёт запись
+CURRENT = '.current'
+
+CHAT_TYPES = frozenset({'private', 'group', 'supergroup', 'channel'})
+# Не пишутся никогда: разметка и цитаты повторяют тексты экранов (там имена
+# участников), в пересылках и ответах — чужие сообщения
+ALWAYS_DROPPED = frozenset({
+    'reply_markup', 'entities', 'caption_entities', 'reply_to_message', 'external_reply',
+    'quote', 'forward_origin', 'pinned_message',
+})
+# Пишутся только от администраторов: контакты, геопозиция, файлы
+PRIVATE = frozenset({
+    'contact', 'location', 'venue', 'photo', 'video', 'voice', 'video_note', 'audio',
+    'animation', 'sticker', 'document',
+})
+# Из таблиц копии базы для воспроизведения: колонки с id пользователей и чатов
+ID_COLUMNS = frozenset({'user_id', 'chat_id', 'report_chat_id'})
+
+
+# Постоянный псевдоним id пользователя или чата: зависит только от id и соли
+def pseudonym(value, salt):
+    digest = hashlib.blake2b(str(abs(value)).encode(), key=salt, digest_size=5).digest()
+    result = PSEUDONYM_BASE + int.from_bytes(digest, 'big')
+    return -result if value < 0 else result
+
+
+def _salt(salt):
+    return salt if isinstance(salt, bytes) else salt.encode()
+
+
+def _sender(event):
+    user = (event.get('from') or event.get('from_user')) if isinstance(event, dict) else None
+    return user.get('id') if isinstance(user, dict) else None
+
+
+# Обезличенная копия апдейта (JSON от Telegram).
+# id пользователей и чатов заменяются псевдонимами, кроме тех, для кого keep(id)
+# истинно (администраторы студий: их id есть в настройках и нужны для прав).
+# От пользователей и чатов остаются только id и тип, от текстов участников — "…",
+# кроме команд (/start <slug> нужен для выбора студии). Текст и файлы
+# администратора сохраняются: это ввод времени, импорт расписания.
+def anonymize(raw, salt, keep=lambda user_id: False):
+    salt = _salt(salt)
+    result = {}
+    for key, event in raw.items():
+        trusted = _sender(event) is not None and keep(_sender(event))
+        result[key] = _scrub(event, salt, keep, trusted)
+    return result
+
+
+def _scrub(obj, salt, keep, trusted=False):
+    if isinstance(obj, list):
+        return [_scrub(item, salt, keep) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if 'id' in obj and 'is_bot' in obj:
+        user_id = obj['id']
+        return {
+            'id': user_id if keep(user_id) else pseudonym(user_id, salt),
+            'is_bot': obj['is_bot'],
+            'first_name': "User",
+        }
+    if 'id' in obj and obj.get('type') in CHAT_TYPES:
+        chat_id = obj['id']
+        return {'id': chat_id if keep(chat_id) else pseudonym(chat_id, salt), 'type': obj['type']}
+    result = {}
+    for key, value in obj.items():
+        if key in ALWAYS_DROPPED or (key in PRIVATE and not trusted):
+            continue
+        if key in ('text', 'caption') and isinstance(value, str):
+            result[key] = value if trusted or value.startswith('/') else "…"
+        else:
+            result[key] = _scrub(value, salt, keep)
+    return result
+
+
+# Журнал входящих апдейтов для воспроизведения под нагрузкой (replay.py).
+# record() только обезличивает апдейт и кладёт строку в буфер; на диск буфер
+# пишет фоновая задача раз в FLUSH_INTERVAL, в отдельном потоке. Формат —
+# JSON-строки {"t": время получения, "u": апдейт} в gzip. Файл пишется как
+# updates-<время>.jsonl.gz.current, после MAX_BYTES сжатых байт закрывается
+# без .current и начинается следующий; хранятся keep_files последних.
+# Каждая порция дописывается с flush, так что после падения файл читается
+# до последней записанной порции.
+# salt — секрет для псевдонимов; без него берётся случайный, и псевдонимы
+# не совпадут ни между рестартами, ни с копией базы в replay.py --salt.
+class UpdateRecorder:
+    def __init__(self, directory, salt=None, keep=None, max_bytes=MAX_BYTES, keep_files=KEEP_FILES):
+        if not salt:
+            logger.warning("Запись апдейтов без RECORD_SALT: псевдонимы будут случайными")
+            salt = secrets.token_bytes(16)
+        self.directory = directory
+        self.salt = _salt(salt)
+        self.keep = keep or (lambda user_id: False)
+        self.max_bytes = max_bytes
+        self.keep_files = keep_files
+        self._buffer = []
+        self._raw = None            # файл на диске
+        self._file = None           # gzip поверх него
+        self._path = None
+        self._task = None
+        self.recorded = 0
+        self.dropped = 0
+
+    def stats(self):
+        return {'recorded': self.recorded, 'dropped': self.dropped}
+
+    def record(self, raw, received_at=None):
+        if len(self._buffer) >= MAX_BUFFER:
+            self.dropped += 1
+            return
+        try:
+            line = json.dumps(
+                {'t': round(received_at or time.time(), 3), 'u': anonymize(raw, self.salt, self.keep)},
+                ensure_ascii=False, separators=(',', ':'),
+            )
+        except Exception:
+            logger.exception("Апдейт не записан")
+            self.dropped += 1
+            return
+        self._buffer.append(line)
+        self.recorded += 1
+
+    async def flush(self):
+        lines, self._buffer = self._buffer, []
+        if lines:
+            await asyncio.to_thread(self._write, lines)
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Файлы, которые не закрылись из-за падения, считаются законченными
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX + CURRENT):
+                os.replace(os.path.join(self.directory, name),
+                           os.path.join(self.directory, name[:-len(CURRENT)]))
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        stamp += f"-{time.time_ns() // 1_000_000 % 1000:03d}"
+        self._path = os.path.join(self.directory, PREFIX + stamp + SUFFIX + CURRENT)
+        self._raw = open(self._path, 'ab')
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='wb', compresslevel=6)
+
+    def _write(self, lines):
+        if self._file is None:
+            self._open()
+        self._file.write(('\n'.join(lines) + '\n').encode())
+        self._file.flush()
+        if self._raw.tell() >= self.max_bytes:
+            self._close()
+
+    def _close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._raw.close()
+        os.replace(self._path, self._path[:-len(CURRENT)])
+        self._file = self._raw = self._path = None
+        for path in log_files(self.directory)[:-self.keep_files]:
+            os.remove(path)
+
+    # --- Фоновый запуск ---
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        await asyncio.to_thread(self._close)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Журнал апдейтов не записан")
+
+
+# Файлы журнала от старых к новым, включая тот, что ещё пишется
+def log_files(directory):
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith(PREFIX) and (name.endswith(SUFFIX) or name.endswith(SUFFIX + CURRENT))
+    )
+    return [os.path.join(directory, name) for name in names]
+
+
+# (время получения, апдейт) по порядку файлов. Оборванный конец файла
+# (процесс упал или файл ещё пишется) пропускается
+def read_log(paths):
+    for path in paths:
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    yield record['t'], record['u']
+        except (EOFError, json.JSONDecodeError):
+            logger.warning("Журнал %s оборван, читаем до места обрыва", path)
+
+
+# Заменяет id пользователей и чатов в копии базы теми же псевдонимами, что в
+# журнале, — тогда воспроизведённые участники видят свои записи. Только для копии!
+def pseudonymize_database(path, salt, keep=frozenset()):
+    salt = _salt(salt)
+    conn = sqlite3.connect(path)
+    conn.create_function(
+        'pseudonym', 1, lambda value: value if value is None or value in keep else pseudonym(value, salt),
+        deterministic=True,
+    )
+    try:
+        with conn:
+            tables = [name for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            )]
+            for table in tables:
+                for column in [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]:
+                    if column in ID_COLUMNS:
+                        conn.execute(f'UPDATE "{table}" SET "{column}" = pseudonym("{column}")')
+    finally:
+        conn.close()
@@ -0,0 +1,158 @@
+import asyncio
+import time
+from datetime import datetime
+from metrics import JOB_SECONDS
+
+# Предел ожидания таймера: раз в столько секунд перепроверяем очередь в любом случае
+MAX_SLEEP = 300
+
+
+# Напоминания о тренировках.
+# На каждую запись и каждый сдвиг (например, за 24 ч и за 2 ч) хранится строка
+# в reminders с моментом срабатывания fire_at. Фоновая задача спит до ближайшего
+# fire_at, помечает наступившие напоминания отправленными и в той же транзакции
+# ставит их в рассылку — поэтому после рестарта ничего не уходит повторно.
+class ReminderScheduler:
+    def __init__(self, database, broadcaster, offsets, tz):
+        self.database = database
+        self.broadcaster = broadcaster
+        self.offsets = offsets      # сдвиги в минутах до начала тренировки
+        self.tz = tz
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def _rows_for(self, sch_id, user_id, starts_at, now):
+        rows = []
+        for offset in self.offsets:
+            fire_at = starts_at - offset * 60
+            if fire_at > now:
+                rows.append((sch_id, user_id, offset, fire_at))
+        return rows
+
+    # --- Вызываются внутри транзакций записи ---
+
+    async def plan(self, db, sch_id, user_id):
+        cursor = await db.execute("SELECT starts_at FROM schedules WHERE id = ?", (sch_id,))
+        row = await cursor.fetchone()
+        if row is None:
+            return
+        await db.executemany('''
+            INSERT OR IGNORE INTO reminders (schedule_id, user_id, offset_minutes, fire_at)
+            VALUES (?, ?, ?, ?)
+        ''', self._rows_for(sch_id, user_id, row[0], int(time.time())))
+
+    async def cancel(self, db, sch_id, user_id):
+        await db.execute(
+            "DELETE FROM reminders WHERE schedule_id = ? AND user_id = ?", (sch_id, user_id)
+        )
+
+    # Приводит напоминания пользователя к его текущей записи: есть запись — планирует,
+    # нет — удаляет. Не зависит от порядка и повторов событий записи и отмены
+    async def sync(self, db, sch_id, user_id):
+        cursor = await db.execute(
+            "SELECT 1 FROM registrations WHERE schedule_id = ? AND user_id = ?", (sch_id, user_id)
+        )
+        if await cursor.fetchone():
+            await self.plan(db, sch_id, user_id)
+        else:
+            await self.cancel(db, sch_id, user_id)
+
+    # Время тренировки изменилось — пересчитываем напоминания всех записавшихся
+    async def reschedule_session(self, db, sch_id):
+        await db.execute("DELETE FROM reminders WHERE schedule_id = ?", (sch_id,))
+        cursor = await db.execute('''
+            SELECT r.user_id, s.starts_at
+            FROM registrations r
+            JOIN schedules s ON r.schedule_id = s.id
+            WHERE s.id = ?
+        ''', (sch_id,))
+        now = int(time.time())
+        rows = []
+        for user_id, starts_at in await cursor.fetchall():
+            rows.extend(self._rows_for(sch_id, user_id, starts_at, now))
+        await db.executemany('''
+            INSERT INTO reminders (schedule_id, user_id, offset_minutes, fire_at)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+
+    # Досоздаёт недостающие напоминания для существующих записей (идемпотентно)
+    async def backfill(self, db):
+        now = int(time.time())
+        cursor = await db.execute('''
+            SELECT r.schedule_id, r.user_id, s.starts_at
+            FROM registrations r
+            JOIN schedules s ON r.schedule_id = s.id
+            WHERE s.starts_at > ?
+        ''', (now,))
+        rows = []
+        for sch_id, user_id, starts_at in await cursor.fetchall():
+            rows.extend(self._rows_for(sch_id, user_id, starts_at, now))
+        await db.executemany('''
+            INSERT OR IGNORE INTO reminders (schedule_id, user_id, offset_minutes, fire_at)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+
+    # Будит таймер после изменения очереди
+    def wake(self):
+        self._wakeup.set()
+
+    # --- Таймер ---
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            self._wakeup.clear()
+            row = await self.database.fetchone("SELECT MIN(fire_at) FROM reminders WHERE sent = 0")
+            next_at = row[0] if row else None
+            delay = MAX_SLEEP if next_at is None else min(next_at - time.time(), MAX_SLEEP)
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.fire_due()
+
+    async def fire_due(self):
+        started = time.perf_counter()
+        now = int(time.time())
+        jobs = []
+        async with self.database.write() as db:
+            cursor = await db.execute('''
+                SELECT m.schedule_id, m.user_id, s.workout_type, s.starts_at
+                FROM reminders m
+                JOIN schedules s ON m.schedule_id = s.id
+                WHERE m.sent = 0 AND m.fire_at <= ?
+            ''', (now,))
+            groups = {}
+            for sch_id, user_id, workout_type, starts_at in await cursor.fetchall():
+                # Тренировка уже началась, пока бот был выключен — напоминать поздно
+                if starts_at <= now:
+                    continue
+                groups.setdefault((sch_id, workout_type, starts_at), []).append(user_id)
+            await db.execute("UPDATE reminders SET sent = 1 WHERE sent = 0 AND fire_at <= ?", (now,))
+
+            for (_, workout_type, starts_at), user_ids in groups.items():
+                dt_formatted = datetime.fromtimestamp(starts_at, self.tz).strftime('%d.%m.%Y %H:%M')
+                text = (
+                    f"Напоминаем о тренировке «{workout_type}» {dt_formatted}! "
+                    "Если не сможете прийти, отпишитесь."
+                )
+                jobs.append(await self.broadcaster.create(db, text, set(user_ids), kind='reminder'))
+
+        for job_id in jobs:
+            self.broadcaster.start(job_id)
+        JOB_SECONDS.observe(time.perf_counter() - started, 'send_reminders')
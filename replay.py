@@ -0,0 +1,214 @@
+"""Воспроизведение записанного трафика (RECORD_DIR, recorder.py) на копии баз.
+
+Апдейты из журнала подаются в бота с теми же интервалами, что пришли в
+продакшене (--speed 1), быстрее (--speed 10) или без пауз (--speed 0, не больше
+--concurrency одновременно — так меряется предел пропускной способности).
+Базы копируются снимком из backup.py: из рабочих файлов или из готового снимка.
+Bot API подменён той же локальной сессией, что в bench.py, отчёт — тот же:
+задержка по хэндлерам и пропускная способность, --out/--compare для сравнения релизов.
+
+    python replay.py --log records --registry studios.db --out replay.json
+    python replay.py --log records --snapshot 20260101-030000 --speed 0 --compare replay.json
+    python replay.py --log records --registry studios.db --salt "$RECORD_SALT" --mode direct
+
+С --salt (значение RECORD_SALT бота) id участников в копии баз заменяются теми же
+псевдонимами, что в журнале, и участники видят свои записи.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+from backup import BackupManager, list_snapshots, registry_sources, restore
+from bench import Bench, make_session, print_report, git_commit, summarize
+from recorder import log_files, pseudonymize_database, read_log
+
+
+# Копия реестра и баз студий в workdir; пути баз в реестре копии — на файлы в workdir
+async def copy_databases(args, workdir):
+    if args.snapshot:
+        backup_dir = args.backup_dir
+        stamp = args.snapshot
+    else:
+        backup_dir = os.path.join(workdir, 'snapshot')
+        manager = BackupManager(backup_dir, lambda: registry_sources(args.registry), keep=1)
+        stamp = (await manager.run())['snapshot']
+    restored = dict(restore(backup_dir, stamp, target_dir=workdir))
+
+    registry = next((target for source, target in restored.items()
+                     if os.path.basename(source) == os.path.basename(args.registry)), None)
+    if registry is None:
+        raise SystemExit(f"В снимке {stamp} нет базы реестра {os.path.basename(args.registry)}")
+    conn = sqlite3.connect(registry)
+    try:
+        with conn:
+            rows = conn.execute("SELECT id, db_path, admins FROM studios").fetchall()
+            conn.executemany("UPDATE studios SET db_path = ? WHERE id = ?",
+                             [(os.path.basename(restored[path]), studio_id)
+                              for studio_id, path, _ in rows if path in restored])
+    finally:
+        conn.close()
+
+    if args.salt:
+        admins = frozenset(user_id for *_, admins in rows for user_id in json.loads(admins))
+        for path in [registry] + [restored[path] for _, path, _ in rows if path in restored]:
+            pseudonymize_database(path, args.salt, admins)
+    return registry
+
+
+async def replay(bench, records, args, send):
+    from aiogram.types import Update
+    from pydantic import ValidationError
+
+    stats = {'updates': 0, 'duplicates': 0, 'invalid': 0, 'span_s': 0}
+    limit = asyncio.Semaphore(args.concurrency) if not args.speed and args.concurrency else None
+    seen = set()
+    tasks = set()
+
+    async def deliver(update):
+        try:
+            await send(update)
+        finally:
+            if limit is not None:
+                limit.release()
+
+    started = time.perf_counter()
+    first = None
+    for received_at, raw in records:
+        if args.limit and stats['updates'] >= args.limit:
+            break
+        # Повторы Telegram (например, после 503) — как в UpdateQueue, один раз
+        if raw.get('update_id') in seen:
+            stats['duplicates'] += 1
+            continue
+        seen.add(raw.get('update_id'))
+        try:
+            update = Update.model_validate(raw, context={"bot": bench.main.bot})
+        except ValidationError:
+            stats['invalid'] += 1
+            continue
+        if first is None:
+            first = received_at
+        stats['span_s'] = round(received_at - first, 3)
+        if args.speed:
+            delay = (received_at - first) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif limit is not None:
+            await limit.acquire()
+        task = asyncio.create_task(deliver(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        stats['updates'] += 1
+    await asyncio.gather(*tasks)
+    return time.perf_counter() - started, stats
+
+
+async def run(args):
+    paths = log_files(os.path.abspath(args.log))
+    if not paths:
+        raise SystemExit(f"В {args.log} нет журналов апдейтов")
+    if args.snapshot:
+        args.backup_dir = os.path.abspath(args.backup_dir)
+    args.registry = os.path.abspath(args.registry)
+
+    workdir = tempfile.mkdtemp(prefix="fitnes_replay_")
+    registry_path = await copy_databases(args, workdir)
+    os.chdir(workdir)
+    os.environ["REGISTRY_DB"] = os.path.basename(registry_path)
+    # Копия не пишет свой журнал и не делает снимков
+    os.environ.pop("RECORD_DIR", None)
+    os.environ["BACKUP_INTERVAL_HOURS"] = "0"
+    import main
+
+    for name in ('aiogram', 'ingest'):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+
+    rng = random.Random(args.seed)
+    main.bot.session = make_session(args.latency / 1000, args.jitter, 0.0, rng)
+    main.outbound.setup(main.bot, main.outbound_scheduler)
+    main.bot.session.middleware(main.metrics.ApiMetricsMiddleware())
+    bench = Bench(main, args)
+    main.dp.update.outer_middleware(bench.rec.outer)
+    main.dp.message.middleware(bench.rec.inner)
+    main.dp.callback_query.middleware(bench.rec.inner)
+
+    # Как при обычном старте, с фоновыми задачами студий: они тоже нагружают базы
+    await main.registry.open(main.DEFAULT_STUDIO)
+    await main.start_studios()
+    main.ready.set()
+    if args.mode == 'webhook':
+        main.update_queue.start()
+
+    send = bench.send_direct if args.mode == 'direct' else bench.send_webhook
+    try:
+        elapsed, stats = await replay(bench, read_log(paths), args, send)
+    finally:
+        if args.mode == 'webhook':
+            await main.update_queue.stop()
+        for studio in main.registry.instances():
+            await studio.stop()
+        await main.fsm_storage.close()
+        await main.shard_pool.close_all()
+        await main.registry_db.close()
+
+    result = summarize(bench.rec, elapsed)
+    result.update({
+        'api_calls': sum(main.bot.session.calls.values()),
+        'retry_after': 0,
+        'log': stats,
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов на копии баз")
+    parser.add_argument("--log", default=os.getenv("RECORD_DIR") or "records", help="каталог журнала (RECORD_DIR)")
+    parser.add_argument("--registry", default=os.getenv("REGISTRY_DB", "studios.db"), help="база реестра бота")
+    parser.add_argument("--snapshot", help="взять базы из снимка backup.py вместо рабочих файлов")
+    parser.add_argument("--backup-dir", default=os.getenv("BACKUP_DIR", "backups"), help="каталог снимков")
+    parser.add_argument("--salt", help="RECORD_SALT бота: псевдонимы id в копии баз")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение; 0 — без пауз")
+    parser.add_argument("--concurrency", type=int, default=100, help="апдейтов одновременно при --speed 0")
+    parser.add_argument("--limit", type=int, default=0, help="не больше стольких апдейтов")
+    parser.add_argument("--mode", choices=("direct", "webhook"), default="webhook")
+    parser.add_argument("--latency", type=float, default=30.0, help="задержка Bot API, мс")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс задержки, доля")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    if args.snapshot and args.snapshot not in dict(list_snapshots(args.backup_dir)):
+        raise SystemExit(f"Снимка {args.snapshot} нет в {args.backup_dir}")
+    out = os.path.abspath(args.out) if args.out else None
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    result = asyncio.run(run(args))
+    log = result['log']
+    print(f"Журнал: {log['updates']} апдейтов за {log['span_s']} с записи, "
+          f"повторов {log['duplicates']}, не разобрано {log['invalid']}")
+    print_report('replay', result, (baseline or {}).get('modes', {}).get('replay'))
+
+    if out:
+        params = {k: v for k, v in vars(args).items() if k not in ('out', 'compare', 'salt')}
+        with open(out, 'w') as f:
+            json.dump({'commit': git_commit(), 'created_at': int(time.time()), 'params': params,
+                       'modes': {'replay': result}}, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты: {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import time
+
+# Итог попытки записи
+RESERVED = 'reserved'        # место занято
+ALREADY = 'already'          # пользователь уже записан
+FULL = 'full'                # мест нет
+WAITLISTED = 'waitlisted'    # мест нет, пользователь в листе ожидания
+GONE = 'gone'                # тренировка удалена
+STARTED = 'started'          # тренировка уже началась
+
+
+# Бронирование мест.
+# Проверка вместимости и вставка — один условный INSERT внутри транзакции записи
+# (BEGIN IMMEDIATE), поэтому одновременные нажатия не могут превысить лимит
+# ни в одном процессе. Освобождённое место в той же транзакции отдаётся первому
+# из листа ожидания.
+# Вместимость: schedules.capacity, если задана, иначе значение по типу тренировки.
+# На начавшуюся тренировку не записывают ни кнопкой со старого сообщения, ни из
+# листа ожидания: лист такой тренировки очищается при первом освобождении места.
+class SeatBook:
+    def __init__(self, default_capacity, waitlist=True):
+        self.default_capacity = default_capacity    # workout_type -> мест (None — без ограничения)
+        self.waitlist = waitlist
+
+    def capacity_for(self, session):
+        if session.capacity is not None:
+            return session.capacity
+        return self.default_capacity.get(session.workout_type)
+
+    # --- Вызываются внутри транзакций записи ---
+
+    # Возвращает (итог, reg_id); reg_id — новая запись для RESERVED,
+    # существующая для ALREADY, иначе None
+    async def reserve(self, db, sch_id, user_id, waitlist=False):
+        cursor = await db.execute('''
+            SELECT s.workout_type, s.capacity, s.starts_at, r.id
+            FROM schedules s
+            LEFT JOIN registrations r ON r.schedule_id = s.id AND r.user_id = ?
+            WHERE s.id = ?
+        ''', (user_id, sch_id))
+        row = await cursor.fetchone()
+        if row is None:
+            return GONE, None
+        workout_type, capacity, starts_at, existing = row
+        if existing is not None:
+            return ALREADY, existing
+        if starts_at <= time.time():
+            return STARTED, None
+
+        if capacity is None:
+            capacity = self.default_capacity.get(workout_type)
+        cursor = await db.execute('''
+            INSERT INTO registrations (user_id, schedule_id)
+            SELECT ?, ?
+            WHERE ? IS NULL OR (SELECT COUNT(*) FROM registrations WHERE schedule_id = ?) < ?
+        ''', (user_id, sch_id, capacity, sch_id, capacity))
+        if cursor.rowcount:
+            await db.execute("DELETE FROM waitlist WHERE schedule_id = ? AND user_id = ?", (sch_id, user_id))
+            return RESERVED, cursor.lastrowid
+
+        if waitlist and self.waitlist:
+            await db.execute('''
+                INSERT OR IGNORE INTO waitlist (schedule_id, user_id, created_at) VALUES (?, ?, ?)
+            ''', (sch_id, user_id, int(time.time())))
+            return WAITLISTED, None
+        return FULL, None
+
+    # Удаляет запись и отдаёт место первым из листа ожидания.
+    # Возвращает (user_id, schedule_id) удалённой записи или None
+    # и список повышенных [(reg_id, user_id)].
+    async def release(self, db, reg_id):
+        cursor = await db.execute("SELECT user_id, schedule_id FROM registrations WHERE id = ?", (reg_id,))
+        row = await cursor.fetchone()
+        if row is None:
+            return None, []
+        await db.execute("DELETE FROM registrations WHERE id = ?", (reg_id,))
+        return row, await self.promote(db, row[1])
+
+    async def promote(self, db, sch_id):
+        promoted = []
+        if not self.waitlist:
+            return promoted
+        cursor = await db.execute("SELECT starts_at FROM schedules WHERE id = ?", (sch_id,))
+        row = await cursor.fetchone()
+        if row is None or row[0] <= time.time():
+            await db.execute("DELETE FROM waitlist WHERE schedule_id = ?", (sch_id,))
+            return promoted
+        cursor = await db.execute(
+            "SELECT user_id FROM waitlist WHERE schedule_id = ? ORDER BY created_at, id", (sch_id,)
+        )
+        for (user_id,) in await cursor.fetchall():
+            outcome, reg_id = await self.reserve(db, sch_id, user_id)
+            if outcome == FULL:
+                break
+            if outcome == RESERVED:
+                promoted.append((reg_id, user_id))
+            else:
+                await db.execute("DELETE FROM waitlist WHERE schedule_id = ? AND user_id = ?", (sch_id, user_id))
+        return promoted
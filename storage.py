@@ -0,0 +1,138 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повтором, если запись в БД не удалась
+RETRY_DELAY = 1.0
+
+
+# FSM-хранилище aiogram поверх таблицы fsm_states (в базе реестра студий).
+# Состояния переживают рестарт и видны всем процессам, работающим с одной БД.
+#  - перед таблицей стоит LRU-кэш; запись из кэша считается актуальной cache_ttl секунд,
+#    после этого перечитывается из БД (другой процесс мог её изменить);
+#  - изменения копятся flush_interval секунд и пишутся одной транзакцией; если
+#    запись не удалась, они остаются в очереди и пишутся повторно;
+#  - записи, не менявшиеся дольше ttl, считаются пустыми и периодически удаляются.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, database, ttl=24 * 3600, cache_size=1024, cache_ttl=1.0,
+                 flush_interval=0.05, purge_interval=600, key_builder=None):
+        self.database = database
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = OrderedDict()     # key -> (state, data, время чтения)
+        self._pending = {}              # key -> (state, data, время изменения)
+        self._flush_task = None
+        self._purged_at = time.monotonic()
+
+    async def _record(self, key):
+        k = self.key_builder.build(key)
+        if k in self._pending:
+            state, data, _ = self._pending[k]
+            return k, state, data
+        cached = self._cache.get(k)
+        if cached is not None and time.monotonic() - cached[2] < self.cache_ttl:
+            self._cache.move_to_end(k)
+            return k, cached[0], cached[1]
+
+        row = await self.database.fetchone(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (k,)
+        )
+        if row is None or row[2] < time.time() - self.ttl:
+            state, data = None, {}
+        else:
+            state, data = row[0], json.loads(row[1]) if row[1] else {}
+        self._remember(k, state, data)
+        return k, state, data
+
+    def _remember(self, k, state, data):
+        self._cache[k] = (state, data, time.monotonic())
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _put(self, k, state, data):
+        self._pending[k] = (state, data, int(time.time()))
+        self._remember(k, state, data)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def set_state(self, key, state=None):
+        k, _, data = await self._record(key)
+        self._put(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key):
+        _, state, _ = await self._record(key)
+        return state
+
+    async def set_data(self, key, data):
+        k, state, _ = await self._record(key)
+        self._put(k, state, dict(data))
+
+    async def get_data(self, key):
+        _, _, data = await self._record(key)
+        return dict(data)
+
+    # Пишет, пока есть что писать: изменения, сделанные во время записи,
+    # уходят следующей транзакцией, а не ждут следующего _put
+    async def _flush_later(self):
+        delay = self.flush_interval
+        while self._pending:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                delay = self.flush_interval
+            except Exception:
+                logger.exception("Состояния FSM не записаны (%d), повтор", len(self._pending))
+                delay = RETRY_DELAY
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        try:
+            await self._write(pending)
+        except BaseException:
+            # Возвращаем пачку в очередь; более новые изменения тех же ключей важнее
+            for k, record in pending.items():
+                self._pending.setdefault(k, record)
+            raise
+
+    async def _write(self, pending):
+        upserts = []
+        deletes = []
+        for k, (state, data, updated_at) in pending.items():
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), updated_at))
+
+        purge = time.monotonic() - self._purged_at > self.purge_interval
+        if not upserts and not deletes and not purge:
+            return
+        async with self.database.write() as db:
+            if upserts:
+                await db.executemany('''
+                    INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+                ''', upserts)
+            if deletes:
+                await db.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+            if purge:
+                await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (int(time.time() - self.ttl),))
+        if purge:
+            self._purged_at = time.monotonic()
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import json
+import re
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import asynccontextmanager
+from zoneinfo import ZoneInfo
+from db import Database
+from migrations import migrate, REGISTRY_MIGRATIONS
+from generator import ScheduleGenerator
+from analytics import WEEKDAYS
+
+# Настройки студии из реестра.
+#  admins   — frozenset user_id администраторов;
+#  workouts — тип тренировки -> вместимость (None — без ограничения), в порядке показа;
+#  db_path  — файл базы-шарда студии.
+StudioConfig = namedtuple('StudioConfig', 'id slug name timezone admins workouts db_path')
+
+# Сколько привязок пользователь -> студия держать в памяти
+USER_CACHE_SIZE = 100_000
+# slug идёт в ссылку t.me/<бот>?start=<slug>: Telegram пропускает только такие символы
+SLUG_RE = re.compile(r'[A-Za-z0-9_-]{1,32}')
+
+
+def _config(row):
+    studio_id, slug, name, timezone, admins, workouts, db_path = row
+    return StudioConfig(
+        studio_id, slug, name, timezone,
+        frozenset(json.loads(admins)),
+        {t: capacity for t, capacity in json.loads(workouts)},
+        db_path,
+    )
+
+
+# Реестр студий.
+# Настройки всех студий читаются при старте, привязка пользователя к студии —
+# при первом обращении, дальше из LRU-кэша. Объект студии — factory(config):
+# компоненты поверх своей базы-шарда — создаётся один раз на процесс.
+# Привязку меняет только этот процесс: при нескольких процессах она видна
+# другим после вытеснения из кэша.
+class StudioRegistry:
+    def __init__(self, database, factory, user_cache_size=USER_CACHE_SIZE):
+        self.database = database
+        self.factory = factory
+        self.user_cache_size = user_cache_size
+        self.configs = {}               # id -> StudioConfig
+        self._slugs = {}                # slug -> id
+        self._studios = {}              # id -> объект студии
+        self._users = OrderedDict()     # user_id -> id студии или None (не привязан)
+
+    def __len__(self):
+        return len(self.configs)
+
+    # Открывает базу реестра; в пустой реестр добавляет студию default
+    async def open(self, default=None):
+        await self.database.open()
+        await migrate(self.database, None, REGISTRY_MIGRATIONS)
+        await self.load()
+        if not self.configs and default is not None:
+            await self.add(**default)
+
+    async def load(self):
+        rows = await self.database.fetchall('''
+            SELECT id, slug, name, timezone, admins, workouts, db_path FROM studios ORDER BY id
+        ''')
+        self.configs = {row[0]: _config(row) for row in rows}
+        self._slugs = {c.slug: c.id for c in self.configs.values()}
+
+    # templates — начальные шаблоны расписания (generator.ScheduleGenerator.seed):
+    # пишутся в базу студии, если шаблонов там ещё нет
+    async def add(self, slug, name, timezone, admins, workouts, db_path, templates=()):
+        if not SLUG_RE.fullmatch(slug):
+            raise ValueError(f"slug может содержать только латиницу, цифры, _ и -: {slug}")
+        ZoneInfo(timezone)      # неизвестный пояс — ошибка сразу, а не при первом показе
+        types = {t for t, _ in workouts}
+        unknown = {t[2] for t in templates} - types
+        if unknown:
+            raise ValueError(f"Шаблоны с типами не из каталога студии: {', '.join(sorted(unknown))}")
+        async with self.database.write() as db:
+            cursor = await db.execute('''
+                INSERT INTO studios (slug, name, timezone, admins, workouts, db_path, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (slug, name, timezone, json.dumps(list(admins)),
+                  json.dumps(list(workouts), ensure_ascii=False), db_path, int(time.time())))
+        await self.load()
+        config = self.configs[cursor.lastrowid]
+        if templates:
+            async with studio_generator(config) as generator:
+                await generator.seed(templates)
+        return config
+
+    # --- Студии ---
+
+    def get(self, studio_id):
+        config = self.configs.get(studio_id)
+        if config is None:
+            return None
+        studio = self._studios.get(studio_id)
+        if studio is None:
+            studio = self._studios[studio_id] = self.factory(config)
+        return studio
+
+    def by_slug(self, slug):
+        return self.get(self._slugs.get(slug))
+
+    def studios(self):
+        return [self.get(studio_id) for studio_id in self.configs]
+
+    # Уже созданные объекты студий — для метрик и остановки
+    def instances(self):
+        return list(self._studios.values())
+
+    # --- Пользователи ---
+
+    def _remember(self, user_id, studio_id):
+        self._users[user_id] = studio_id
+        self._users.move_to_end(user_id)
+        if len(self._users) > self.user_cache_size:
+            self._users.popitem(last=False)
+
+    # Студия пользователя: выбранная им, иначе единственная в реестре,
+    # иначе та, где он администратор. None — пусть выберет сам
+    async def studio_for(self, user_id):
+        if user_id in self._users:
+            studio_id = self._users[user_id]
+            self._users.move_to_end(user_id)
+        else:
+            row = await self.database.fetchone("SELECT studio_id FROM user_studios WHERE user_id = ?", (user_id,))
+            studio_id = row[0] if row else None
+            self._remember(user_id, studio_id)
+        if studio_id in self.configs:
+            return self.get(studio_id)
+        if len(self.configs) == 1:
+            # Привязываем сразу: когда появится вторая студия, пользователь останется в своей
+            studio_id = next(iter(self.configs))
+            await self.bind(user_id, studio_id)
+            return self.get(studio_id)
+        for config in self.configs.values():
+            if user_id in config.admins:
+                return self.get(config.id)
+        return None
+
+    async def bind(self, user_id, studio_id):
+        async with self.database.write() as db:
+            await db.execute('''
+                INSERT INTO user_studios (user_id, studio_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET studio_id = excluded.studio_id, updated_at = excluded.updated_at
+            ''', (user_id, studio_id, int(time.time())))
+        self._remember(user_id, studio_id)
+
+
+# Генератор расписания поверх отдельного соединения с базой студии — для
+# управления шаблонами вне бота. Схема базы доводится до текущей
+@asynccontextmanager
+async def studio_generator(config):
+    tz = ZoneInfo(config.timezone)
+    database = Database(config.db_path, readers=1)
+    await database.open()
+    try:
+        await migrate(database, tz)
+        yield ScheduleGenerator(database, None, tz, workout_types=config.workouts)
+    finally:
+        await database.close()
+
+
+# "Пн 10:00 Хатха" или "1 19:30 Хатха:12" -> (weekday, start_minute, тип, вместимость)
+def parse_template(text):
+    try:
+        day, at, rest = text.split(None, 2)
+        names = [d.lower() for d in WEEKDAYS]
+        weekday = names.index(day.lower()) if day.lower() in names else int(day) - 1
+        hours, minutes = (int(part) for part in at.split(':'))
+        if not (0 <= weekday <= 6 and 0 <= hours <= 23 and 0 <= minutes <= 59):
+            raise ValueError(text)
+        workout_type, _, capacity = rest.partition(':')
+        return weekday, hours * 60 + minutes, workout_type.strip(), int(capacity) if capacity else None
+    except ValueError:
+        raise ValueError(f"Шаблон в формате 'Пн 10:00 тип[:вместимость]': {text!r}") from None
+
+
+# Управление реестром из командной строки:
+#   python tenants.py add yoga "Йога на Ленина" Asia/Yekaterinburg --admin 123 --workout "Хатха:12" --workout "Нидра"
+#       --template "Пн 10:00 Хатха" --template "Ср 19:30 Нидра"
+#   python tenants.py list
+# Шаблоны регулярного расписания студии (новые тренировки по ним генератор
+# создаёт в течение часа или по кнопке «Досоздать расписание по шаблонам»):
+#   python tenants.py templates yoga
+#   python tenants.py template-add yoga "Пт 18:00 Хатха:10"
+#   python tenants.py template-remove yoga 3
+async def _cli(args):
+    database = Database(args.registry, readers=1)
+    registry = StudioRegistry(database, factory=None)
+    await registry.open()
+    try:
+        if args.command == 'add':
+            workouts = []
+            for item in args.workout:
+                workout_type, _, capacity = item.partition(':')
+                workouts.append((workout_type.strip(), int(capacity) if capacity else None))
+            config = await registry.add(
+                args.slug, args.name, args.timezone, args.admin, workouts,
+                args.db_path or f"studio_{args.slug}.db",
+                templates=[parse_template(item) for item in args.template],
+            )
+            print(f"Студия {config.id} добавлена, ссылка для записи: https://t.me/<бот>?start={config.slug}")
+        elif args.command in ('templates', 'template-add', 'template-remove'):
+            config = next((c for c in registry.configs.values() if c.slug == args.slug), None)
+            if config is None:
+                raise SystemExit(f"Студии {args.slug} нет в реестре")
+            async with studio_generator(config) as generator:
+                if args.command == 'template-add':
+                    template_id = await generator.add_template(*parse_template(args.template))
+                    print(f"Шаблон {template_id} добавлен")
+                elif args.command == 'template-remove':
+                    if not await generator.remove_template(args.id):
+                        raise SystemExit(f"Шаблона {args.id} нет")
+                    print(f"Шаблон {args.id} удалён, созданные по нему тренировки остались")
+                else:
+                    for template_id, weekday, minute, workout_type, capacity, active in await generator.templates():
+                        print(f"{template_id}\t{WEEKDAYS[weekday]} {minute // 60:02d}:{minute % 60:02d}\t"
+                              f"{workout_type}\t{capacity or '-'}" + ("" if active else "\tвыключен"))
+        else:
+            for c in registry.configs.values():
+                workouts = ", ".join(f"{t}:{cap or '-'}" for t, cap in c.workouts.items())
+                print(f"{c.id}\t{c.slug}\t{c.name}\t{c.timezone}\t{c.db_path}\t{sorted(c.admins)}\t{workouts}")
+    finally:
+        await database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Реестр студий")
+    parser.add_argument("--registry", default="studios.db", help="файл базы реестра")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="добавить студию")
+    add.add_argument("slug", help="короткое имя для ссылки t.me/<бот>?start=<slug>")
+    add.add_argument("name")
+    add.add_argument("timezone", help="например Asia/Yekaterinburg")
+    add.add_argument("--admin", type=int, action="append", default=[], help="user_id администратора")
+    add.add_argument("--workout", action="append", required=True, help="тип[:вместимость]")
+    add.add_argument("--db-path", help="файл базы студии (по умолчанию studio_<slug>.db)")
+    add.add_argument("--template", action="append", default=[], help="'Пн 10:00 тип[:вместимость]'")
+    commands.add_parser("list", help="список студий")
+    templates = commands.add_parser("templates", help="шаблоны расписания студии")
+    templates.add_argument("slug")
+    template_add = commands.add_parser("template-add", help="добавить шаблон расписания")
+    template_add.add_argument("slug")
+    template_add.add_argument("template", help="'Пн 10:00 тип[:вместимость]'")
+    template_remove = commands.add_parser("template-remove", help="удалить шаблон расписания")
+    template_remove.add_argument("slug")
+    template_remove.add_argument("id", type=int)
+    try:
+        asyncio.run(_cli(parser.parse_args()))
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+
+if __name__ == '__main__':
+    main()
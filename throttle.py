@@ -0,0 +1,104 @@
+import logging
+import time
+from collections import OrderedDict
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramBadRequest
+
+logger = logging.getLogger(__name__)
+
+# Нажатий в секунду на пользователя в среднем и сколько можно нажать подряд
+RATE = 2.0
+BURST = 8
+# Столько секунд после выполнения повтор того же нажатия на том же сообщении
+# считается двойным нажатием, если между ними на сообщении не нажимали другую
+# кнопку. Нужно для вебхука: там апдейты одного пользователя идут по очереди,
+# и второе нажатие приходит уже после первого
+WINDOW = 1.0
+# Сколько корзин пользователей держать в памяти
+USERS = 100_000
+TOO_FAST = "Слишком часто, подождите секунду"
+
+
+# Защита от частых нажатий, внешний middleware колбэков.
+#  - Повтор нажатия, которое ещё выполняется (или только что выполнилось),
+#    не запускает хэндлер второй раз: двойное «Записаться» не пишет в базу дважды.
+#  - Сверх корзины токенов (RATE в секунду, не больше BURST подряд) нажатие
+#    получает только call.answer, без базы и без edit_text.
+# Сообщения не ограничиваются: в диалогах это ввод администратора.
+# Повтор определяется по пользователю, сообщению и callback_data.
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self, rate=RATE, burst=BURST, window=WINDOW, users=USERS):
+        self.rate = rate            # 0 — без ограничения частоты
+        self.burst = burst
+        self.window = window
+        self.users = users
+        self._buckets = OrderedDict()   # user_id -> [токены, время]
+        self._running = set()           # (пользователь, сообщение, data) выполняющихся нажатий
+        self._recent = OrderedDict()    # (пользователь, сообщение) -> (data, время окончания)
+        self.passed = 0
+        self.coalesced = 0
+        self.throttled = 0
+
+    def stats(self):
+        return {'passed': self.passed, 'coalesced': self.coalesced, 'throttled': self.throttled}
+
+    def _allow(self, user_id, now):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.burst, now]
+            if len(self._buckets) > self.users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def _duplicate(self, key, now):
+        while self._recent:
+            oldest, (_, finished) = next(iter(self._recent.items()))
+            if now - finished < self.window:
+                break
+            del self._recent[oldest]
+        if key in self._running:
+            return True
+        last = self._recent.get(key[:2])
+        return last is not None and last[0] == key[2]
+
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        message = event.message
+        key = (user.id, message.message_id if message else event.inline_message_id, event.data)
+        now = time.monotonic()
+        ctx = data.get('metrics')
+
+        if self._duplicate(key, now):
+            self.coalesced += 1
+            return await self._answer(event, None, ctx, 'coalesced')
+        if self.rate and not self._allow(user.id, now):
+            self.throttled += 1
+            return await self._answer(event, TOO_FAST, ctx, 'throttled')
+
+        self.passed += 1
+        self._running.add(key)
+        # Другая кнопка на сообщении: прежнее нажатие больше не повтор
+        self._recent.pop(key[:2], None)
+        try:
+            return await handler(event, data)
+        finally:
+            self._running.discard(key)
+            self._recent[key[:2]] = (key[2], time.monotonic())
+            self._recent.move_to_end(key[:2])
+
+    @staticmethod
+    async def _answer(call, text, ctx, name):
+        if ctx is not None:
+            ctx['handler'] = name
+        try:
+            await call.answer(text)
+        except TelegramBadRequest:
+            # query is too old — ответ уже не нужен
+            pass
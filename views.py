@@ -0,0 +1,52 @@
+import hashlib
+from collections import OrderedDict
+from aiogram.exceptions import TelegramBadRequest
+
+
+# Последний показанный экран для каждого сообщения с кнопками.
+# Экран — текст и клавиатура; запоминается их хэш по (chat_id, message_id).
+# Если повторное нажатие рисует то же самое, edit_text не вызывается:
+# Telegram всё равно ответил бы "message is not modified", а так
+# экономим запрос к API и просто гасим часики на кнопке.
+class ScreenCache:
+    def __init__(self, size=10000):
+        self.size = size
+        self._hashes = OrderedDict()
+        self.edits = 0
+        self.skipped = 0
+
+    @staticmethod
+    def digest(text, reply_markup=None):
+        h = hashlib.blake2b(text.encode(), digest_size=16)
+        if reply_markup is not None:
+            h.update(reply_markup.model_dump_json(exclude_none=True).encode())
+        return h.digest()
+
+    def _remember(self, key, digest):
+        self._hashes[key] = digest
+        self._hashes.move_to_end(key)
+        if len(self._hashes) > self.size:
+            self._hashes.popitem(last=False)
+
+    async def edit(self, call, text, reply_markup=None):
+        key = (call.message.chat.id, call.message.message_id)
+        digest = self.digest(text, reply_markup)
+        if self._hashes.get(key) == digest:
+            self.skipped += 1
+            await call.answer()
+            return
+
+        try:
+            await call.message.edit_text(text, reply_markup=reply_markup)
+        except TelegramBadRequest as e:
+            # Экран уже такой, но мы его не видели (например, после рестарта)
+            if "message is not modified" not in e.message:
+                raise
+            self.skipped += 1
+            await call.answer()
+        else:
+            self.edits += 1
+        self._remember(key, digest)
+
+    def stats(self):
+        return {'edits': self.edits, 'skipped': self.skipped, 'tracked': len(self._hashes)}